@@ -1,8 +1,6 @@
-from flask import Flask, render_template, request, send_file, jsonify, session, send_from_directory, redirect, url_for, flash
+from flask import Flask, render_template, request, send_file, jsonify, session, send_from_directory, redirect, url_for, flash, Response, stream_with_context, has_request_context
 from werkzeug.utils import secure_filename
 import fitz
-import pytesseract
-from PIL import Image, ImageEnhance
 import io
 import os
 import logging
@@ -23,11 +21,15 @@ import queue
 import json
 import re
 import base64
-import subprocess
-import numpy as np
+import unicodedata
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, FIRST_EXCEPTION, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
 from google import genai
 from google.genai import types as genai_types
 import database
+import cache_compartilhado
+import ocr_servico
 from database import (
     gerar_doc_id, gerar_hash_conteudo, gerar_hash_ip,
     registrar_validacao, buscar_validacao,
@@ -39,15 +41,13 @@ from database import (
 )
 # Importar gerador de PDF melhorado
 from gerador_pdf import gerar_pdf_simplificado as gerar_pdf_melhorado
-
-# Tentativa de importar OpenCV
-try:
-    import cv2
-    CV2_AVAILABLE = True
-    logging.info("OpenCV disponível para processamento avançado de imagens")
-except ImportError:
-    CV2_AVAILABLE = False
-    logging.warning("OpenCV não disponível - usando processamento básico")
+# Pipeline de OCR (roda também nos processos dos pools de OCR)
+from pipeline_ocr import (
+    TESSERACT_AVAILABLE, TESSERACT_MOTOR,
+    configuracao_ocr, prazo_ocr_documento, pos_processar_texto_ocr,
+    processar_imagem_local, ocr_pagina_pdf,
+    contexto_processos_ocr, iniciar_processo_ocr
+)
 
 # Tentativa de importar edge-tts (vozes neurais do Microsoft Edge, gratuitas).
 # Se indisponível, o frontend cai automaticamente no Web Speech API do navegador.
@@ -310,8 +310,32 @@ cleanup_lock = threading.Lock()
 results_cache = {}
 CACHE_EXPIRATION = 3600
 
+# Cache anônimo (opt-in): análises de documentos idênticos compartilhadas entre
+# sessões, liberado só após o conteúdo chegar de N sessões distintas
+CACHE_ANONIMO_ENABLED = os.getenv("CACHE_ANONIMO_ENABLED", "false").lower() == "true"
+CACHE_ANONIMO_MIN_SESSOES = int(os.getenv("CACHE_ANONIMO_MIN_SESSOES", "3"))
+
 # Estatísticas de uso dos modelos
-model_usage_stats = {model["name"]: {"attempts": 0, "successes": 0, "failures": 0} for model in GEMINI_MODELS}
+# hedges: vezes em que o modelo estourou o orçamento de latência e disparou o próximo em paralelo
+model_usage_stats = {
+    model["name"]: {"attempts": 0, "successes": 0, "failures": 0, "hedges": 0, "hedge_rate": 0.0}
+    for model in GEMINI_MODELS
+}
+# Atualizadas também pelas threads do hedge_executor
+model_stats_lock = threading.Lock()
+
+# Hedging (requisições em corrida, opt-in): se o modelo em andamento não responder
+# dentro do orçamento (≈ p95 de latência), o próximo modelo é disparado em paralelo e
+# vence a primeira resposta válida. A chamada perdedora não pode ser cancelada: segue
+# até o fim e é cobrada, então cada hedge pode dobrar o custo e a quota da análise.
+# Desligado (padrão) = fallback sequencial.
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() == "true"
+GEMINI_HEDGE_DELAY = float(os.getenv("GEMINI_HEDGE_DELAY", "20"))
+# Worker sync atende uma requisição por vez: uma corrida usa no máximo uma thread por
+# modelo. O dobro cobre as perdedoras da corrida anterior, que ainda ocupam threads,
+# sem que o primário da próxima análise fique na fila atrás delas.
+GEMINI_HEDGE_MAX_PARALELO = int(os.getenv("GEMINI_HEDGE_MAX_PARALELO", str(2 * len(GEMINI_MODELS))))
+hedge_executor = ThreadPoolExecutor(max_workers=max(1, GEMINI_HEDGE_MAX_PARALELO), thread_name_prefix="gemini-hedge")
 
 # Log dos modelos configurados
 logging.info(f"🤖 Sistema multi-modelo configurado com {len(GEMINI_MODELS)} modelos:")
@@ -462,6 +486,11 @@ def limpar_arquivos_expirados():
     if arquivos_removidos > 0:
         logging.info(f"✅ LGPD: {arquivos_removidos} arquivo(s) removido(s)")
 
+    # Texto de OCR/extração e PDFs em cache também são dados pessoais: mesmo prazo curto
+    cache_compartilhado.limpar_ocr_expirado()
+    cache_compartilhado.limpar_extracao_expirada()
+    cache_compartilhado.limpar_pdf_expirado()
+
     return arquivos_removidos
 
 def iniciar_limpeza_automatica():
@@ -475,31 +504,6 @@ def iniciar_limpeza_automatica():
     thread.start()
     logging.info("🔄 Sistema de limpeza automática LGPD iniciado")
 
-iniciar_limpeza_automatica()
-
-def verificar_tesseract():
-    """Verifica se o Tesseract está disponível"""
-    try:
-        result = subprocess.run(['tesseract', '--version'],
-                              capture_output=True, text=True, check=True, timeout=10)
-        version = result.stdout.split('\n')[0]
-        logging.info(f"Tesseract detectado: {version}")
-
-        langs_result = subprocess.run(['tesseract', '--list-langs'],
-                                    capture_output=True, text=True, check=True, timeout=10)
-        langs = langs_result.stdout.strip().split('\n')[1:]
-        logging.info(f"Idiomas disponíveis: {langs}")
-
-        if 'por' not in langs:
-            logging.warning("Português não disponível no Tesseract")
-
-        return True, version, langs
-    except Exception as e:
-        logging.error(f"Tesseract não está disponível: {e}")
-        return False, None, []
-
-TESSERACT_AVAILABLE, TESSERACT_VERSION, TESSERACT_LANGS = verificar_tesseract()
-
 def cleanup_old_requests():
     with cleanup_lock:
         now = datetime.now()
@@ -869,6 +873,49 @@ LEMBRE-SE: Seu output final deve conter APENAS o documento simplificado seguindo
 
 # ============= VALIDAÇÃO DE OUTPUT =============
 
+# Padrões que NÃO devem aparecer no documento final (vazamento de instruções do prompt)
+PADROES_PROIBIDOS_OUTPUT = [
+    # Marcadores de instrução
+    r'🚨\s*\*\*LEMBRETE CRÍTICO',
+    r'🚨\s*\*\*REGRA CRÍTICA',
+    r'■\s*LEMBRETE',
+    r'■\s*REGRA',
+    r'═+',  # Linhas de separação
+    r'╔═+╗',  # Caixas de aviso
+    r'║.*║',  # Linhas de caixas
+    r'╚═+╝',
+
+    # Textos de instrução específicos
+    r'LEMBRETE CRÍTICO ANTES DE ESCREVER:',
+    r'REGRA CRÍTICA #\d+',
+    r'INSTRUÇÕES PARA',
+    r'VERIFICAÇÃO OBRIGATÓRIA',
+    r'CHECKLIST ANTES DE GERAR',
+    r'Aplique isso em TODAS as seções abaixo!',
+    r'não copie isso para o texto final',
+    r'ESTAS SÃO INSTRUÇÕES - NÃO COPIE',
+    r'NÃO INCLUIR NO TEXTO SIMPLIFICADO',
+
+    # Checkboxes e listas de verificação
+    r'□\s*Verifiquei',
+    r'\[\s*\]\s*ADOLESCENTE',
+    r'\[\s*\]\s*ADULTO',
+
+    # Exemplos de instrução
+    r'❌\s*ERRADO\s*\(O QUE VOCÊ NÃO DEVE FAZER\):',
+    r'✅\s*CORRETO\s*\(O QUE VOCÊ DEVE FAZER\):',
+    r'EXEMPLO REAL - CASO.*\(USE COMO REFERÊNCIA\):',
+
+    # Instruções de perspectiva
+    r'Antes de escrever cada seção, releia as INSTRUÇÕES DE PERSPECTIVA',
+]
+
+
+def linha_tem_vazamento(linha):
+    """True se a linha contém algum padrão proibido (usado no streaming, linha a linha)."""
+    return any(re.search(padrao, linha, re.IGNORECASE) for padrao in PADROES_PROIBIDOS_OUTPUT)
+
+
 def validar_e_limpar_output(texto_simplificado):
     """
     Valida e remove qualquer vazamento de instruções do texto simplificado.
@@ -877,45 +924,8 @@ def validar_e_limpar_output(texto_simplificado):
     texto_original = texto_simplificado
     vazamentos_encontrados = False
 
-    # Lista de padrões que NÃO devem aparecer no documento final
-    padroes_proibidos = [
-        # Marcadores de instrução
-        r'🚨\s*\*\*LEMBRETE CRÍTICO',
-        r'🚨\s*\*\*REGRA CRÍTICA',
-        r'■\s*LEMBRETE',
-        r'■\s*REGRA',
-        r'═+',  # Linhas de separação
-        r'╔═+╗',  # Caixas de aviso
-        r'║.*║',  # Linhas de caixas
-        r'╚═+╝',
-
-        # Textos de instrução específicos
-        r'LEMBRETE CRÍTICO ANTES DE ESCREVER:',
-        r'REGRA CRÍTICA #\d+',
-        r'INSTRUÇÕES PARA',
-        r'VERIFICAÇÃO OBRIGATÓRIA',
-        r'CHECKLIST ANTES DE GERAR',
-        r'Aplique isso em TODAS as seções abaixo!',
-        r'não copie isso para o texto final',
-        r'ESTAS SÃO INSTRUÇÕES - NÃO COPIE',
-        r'NÃO INCLUIR NO TEXTO SIMPLIFICADO',
-
-        # Checkboxes e listas de verificação
-        r'□\s*Verifiquei',
-        r'\[\s*\]\s*ADOLESCENTE',
-        r'\[\s*\]\s*ADULTO',
-
-        # Exemplos de instrução
-        r'❌\s*ERRADO\s*\(O QUE VOCÊ NÃO DEVE FAZER\):',
-        r'✅\s*CORRETO\s*\(O QUE VOCÊ DEVE FAZER\):',
-        r'EXEMPLO REAL - CASO.*\(USE COMO REFERÊNCIA\):',
-
-        # Instruções de perspectiva
-        r'Antes de escrever cada seção, releia as INSTRUÇÕES DE PERSPECTIVA',
-    ]
-
     # Remover padrões proibidos
-    for padrao in padroes_proibidos:
+    for padrao in PADROES_PROIBIDOS_OUTPUT:
         if re.search(padrao, texto_simplificado, re.IGNORECASE):
             vazamentos_encontrados = True
             # Remover linha inteira que contém o padrão
@@ -1185,40 +1195,453 @@ def validar_discriminacao_valores(texto_simplificado, valores_json):
 
     return passou, avisos
 
-# ============= ANÁLISE COMPLETA COM GEMINI =============
+# ============= CIRCUIT BREAKER DOS MODELOS =============
+# Estado por modelo: "fechado" (normal), "aberto" (pulado até aberto_ate) e
+# "meio_aberto" (uma única chamada de sonda liberada; sucesso fecha, falha reabre).
+# Compartilhado entre a análise (bloqueante, hedging e streaming) e o /chat.
+
+CIRCUIT_FALHAS_PARA_ABRIR = int(os.getenv("CIRCUIT_FALHAS_PARA_ABRIR", "3"))  # erros 5xx consecutivos
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))  # segundos, quando a API não sugere retry
+CIRCUIT_COOLDOWN_MAX = 300
+CIRCUIT_SONDA_TIMEOUT = 120  # sonda "perdida" (worker reciclado, exceção) libera nova sonda
+
+circuit_lock = threading.Lock()
+circuit_breakers = {
+    model["name"]: {
+        "estado": "fechado",
+        "falhas_consecutivas": 0,
+        "aberto_ate": 0.0,
+        "cooldown": CIRCUIT_COOLDOWN,
+        "sonda_desde": None,
+        "aberturas": 0,
+        "motivo": None,
+    }
+    for model in GEMINI_MODELS
+}
+
+
+def classificar_erro_gemini(erro_msg):
+    """Classifica o erro para o circuit breaker: 'quota' (429), 'servidor' (5xx) ou None
+    (erros de formato/parse da resposta não indicam saúde do modelo)."""
+    erro_lower = erro_msg.lower()
+    if "quota" in erro_lower or "429" in erro_msg or "resource" in erro_lower:
+        return "quota"
+    if re.search(r'\b50[0-4]\b', erro_msg) or "unavailable" in erro_lower or "overloaded" in erro_lower or "internal" in erro_lower:
+        return "servidor"
+    return None
+
+
+def _abrir_circuito(nome, cb, segundos, motivo):
+    cb["estado"] = "aberto"
+    cb["aberto_ate"] = time.time() + segundos
+    cb["sonda_desde"] = None
+    cb["aberturas"] += 1
+    cb["motivo"] = motivo
+    logging.warning(f"🔌 Circuito ABERTO para {nome} por {segundos:.0f}s ({motivo})")
+
+
+def circuito_disponivel(nome):
+    """True se o modelo pode entrar na rota (sem efeitos colaterais)."""
+    cb = circuit_breakers.get(nome)
+    if not cb:
+        return True
+    with circuit_lock:
+        if cb["estado"] == "fechado":
+            return True
+        if cb["estado"] == "aberto":
+            return time.time() >= cb["aberto_ate"]
+        # meio_aberto: disponível só se não há sonda em andamento
+        return cb["sonda_desde"] is None or time.time() - cb["sonda_desde"] > CIRCUIT_SONDA_TIMEOUT
+
+
+def circuito_permite_chamada(nome):
+    """Chamado imediatamente antes de usar o modelo. Em estado aberto com janela
+    vencida, passa para meio_aberto e reserva a sonda para esta chamada."""
+    cb = circuit_breakers.get(nome)
+    if not cb:
+        return True
+    with circuit_lock:
+        agora = time.time()
+        if cb["estado"] == "fechado":
+            return True
+        if cb["estado"] == "aberto":
+            if agora < cb["aberto_ate"]:
+                return False
+            cb["estado"] = "meio_aberto"
+            cb["sonda_desde"] = None
+        if cb["sonda_desde"] is not None and agora - cb["sonda_desde"] <= CIRCUIT_SONDA_TIMEOUT:
+            return False
+        cb["sonda_desde"] = agora
+        logging.info(f"🔌 Circuito MEIO-ABERTO para {nome} - enviando sonda")
+        return True
+
+
+def registrar_sucesso_circuito(nome):
+    cb = circuit_breakers.get(nome)
+    if not cb:
+        return
+    with circuit_lock:
+        if cb["estado"] != "fechado":
+            logging.info(f"🔌 Circuito FECHADO para {nome} (sonda bem-sucedida)")
+        cb["estado"] = "fechado"
+        cb["falhas_consecutivas"] = 0
+        cb["cooldown"] = CIRCUIT_COOLDOWN
+        cb["sonda_desde"] = None
+        cb["motivo"] = None
+
+
+def registrar_erro_circuito(nome, erro_msg):
+    """Registra 429/5xx. Quota abre o circuito na hora, pela janela do `retry in Xs`;
+    5xx abre após CIRCUIT_FALHAS_PARA_ABRIR falhas seguidas. Falha da sonda reabre
+    com cooldown dobrado (até CIRCUIT_COOLDOWN_MAX)."""
+    cb = circuit_breakers.get(nome)
+    tipo = classificar_erro_gemini(erro_msg)
+    if not cb:
+        return
+    with circuit_lock:
+        if tipo is None:
+            # Erro que não indica saúde: apenas libera a sonda (se houver)
+            if cb["estado"] == "meio_aberto":
+                cb["sonda_desde"] = None
+            return
+
+        cb["falhas_consecutivas"] += 1
+        retry_match = re.search(r'retry\s+in\s+([\d.]+)s', erro_msg, re.IGNORECASE)
+        janela = float(retry_match.group(1)) if retry_match else cb["cooldown"]
+
+        if cb["estado"] == "meio_aberto":
+            cb["cooldown"] = min(cb["cooldown"] * 2, CIRCUIT_COOLDOWN_MAX)
+            _abrir_circuito(nome, cb, max(janela, cb["cooldown"]), f"sonda falhou: {tipo}")
+        elif tipo == "quota":
+            _abrir_circuito(nome, cb, janela, "quota")
+        elif cb["falhas_consecutivas"] >= CIRCUIT_FALHAS_PARA_ABRIR:
+            _abrir_circuito(nome, cb, janela, "servidor")
+
+
+def modelos_roteados():
+    """Modelos em ordem de prioridade, sem os que estão com circuito aberto."""
+    modelos_ordenados = sorted(GEMINI_MODELS, key=lambda x: x["priority"])
+    roteados = [m for m in modelos_ordenados if circuito_disponivel(m["name"])]
+    if len(roteados) < len(modelos_ordenados):
+        pulados = [m["name"] for m in modelos_ordenados if m not in roteados]
+        logging.info(f"🔌 Roteador pulando modelos com circuito aberto: {', '.join(pulados)}")
+    return roteados
+
+
+def erros_circuitos_abertos():
+    """Motivos por modelo, no formato de erros_por_modelo, para quando todos os circuitos estão abertos."""
+    with circuit_lock:
+        return {nome: f"circuito aberto ({cb['motivo']})" for nome, cb in circuit_breakers.items()}
+
+
+def estado_circuitos():
+    """Resumo do circuit breaker para o /health (modo debug)."""
+    agora = time.time()
+    with circuit_lock:
+        return {
+            nome: {
+                "estado": cb["estado"],
+                "falhas_consecutivas": cb["falhas_consecutivas"],
+                "reabre_em_s": max(0, round(cb["aberto_ate"] - agora, 1)) if cb["estado"] == "aberto" else 0,
+                "aberturas": cb["aberturas"],
+                "motivo": cb["motivo"],
+            }
+            for nome, cb in circuit_breakers.items()
+        }
+
+
+# ============= ANÁLISE MAP-REDUCE (DOCUMENTOS LONGOS) =============
+# Documentos acima de LIMITE_ANALISE não são mais cortados no meio: o texto é
+# dividido em blocos (fronteiras de seção/parágrafo), cada bloco vira uma lista
+# de fatos em paralelo (map) e a análise completa roda sobre os fatos (reduce).
+# A latência passa a depender do bloco mais lento, não do tamanho do documento.
+
+# 60000 chars ≈ 15000 tokens: folga suficiente para o prompt completo de análise
+LIMITE_ANALISE = 60000
+MAP_REDUCE_ENABLED = os.getenv("MAP_REDUCE_ENABLED", "true").lower() == "true"
+MAP_REDUCE_BLOCO_CHARS = int(os.getenv("MAP_REDUCE_BLOCO_CHARS", "20000"))
+MAP_REDUCE_MAX_PARALELO = int(os.getenv("MAP_REDUCE_MAX_PARALELO", "4"))
+map_reduce_executor = ThreadPoolExecutor(max_workers=MAP_REDUCE_MAX_PARALELO, thread_name_prefix="map-reduce")
+
+# Cabeçalhos de seção de peças judiciais: fronteiras preferidas entre blocos
+REGEX_INICIO_SECAO = re.compile(
+    r'^\s*(RELAT[ÓO]RIO|FUNDAMENTA[ÇC][ÃA]O|DISPOSITIVO|EMENTA|AC[ÓO]RD[ÃA]O|VOTO|'
+    r'DECIS[ÃA]O|SENTEN[ÇC]A|DESPACHO|MANDADO|CERTID[ÃA]O|TERMO DE AUDI[ÊE]NCIA|'
+    r'ANTE O EXPOSTO|DIANTE DO EXPOSTO|[ÉE] O RELAT[ÓO]RIO)\b'
+)
+
 
-def analisar_documento_completo_gemini(texto, perspectiva="nao_informado", session_id=None):
+def dividir_texto_em_blocos(texto, tamanho_max=None):
     """
-    ANÁLISE COMPLETA DO DOCUMENTO EM 1 ÚNICA CHAMADA GEMINI
-    Retorna dict com análise técnica + texto simplificado
+    Divide o texto em blocos de até `tamanho_max` chars, cortando em parágrafos
+    e preferindo começar um bloco novo num cabeçalho de seção.
+    Parágrafos maiores que o bloco são quebrados por linha. Trechos só com
+    espaços são descartados (cada bloco custa uma chamada de map).
+    """
+    tamanho_max = tamanho_max or MAP_REDUCE_BLOCO_CHARS
+    paragrafos = []
+    for paragrafo in re.split(r'\n\s*\n', texto):
+        if not paragrafo.strip():
+            continue
+        if len(paragrafo) <= tamanho_max:
+            paragrafos.append(paragrafo)
+            continue
+        atual = ""
+        for linha in paragrafo.split("\n"):
+            while len(linha) > tamanho_max:
+                if linha[:tamanho_max].strip():
+                    paragrafos.append(linha[:tamanho_max])
+                linha = linha[tamanho_max:]
+            if len(atual) + len(linha) + 1 > tamanho_max:
+                if atual.strip():
+                    paragrafos.append(atual)
+                atual = ""
+            atual = f"{atual}\n{linha}" if atual else linha
+        if atual.strip():
+            paragrafos.append(atual)
+
+    blocos = []
+    atual = []
+    tamanho_atual = 0
+    for paragrafo in paragrafos:
+        inicio_secao = bool(REGEX_INICIO_SECAO.match(paragrafo))
+        estouraria = tamanho_atual + len(paragrafo) + 2 > tamanho_max
+        # Seção nova com o bloco já na metade: melhor fechar aqui que cortar a seção
+        if atual and (estouraria or (inicio_secao and tamanho_atual >= tamanho_max // 2)):
+            blocos.append("\n\n".join(atual))
+            atual, tamanho_atual = [], 0
+        atual.append(paragrafo)
+        tamanho_atual += len(paragrafo) + 2
+    if atual:
+        blocos.append("\n\n".join(atual))
+    return blocos
+
+
+def gerar_texto_gemini(prompt, max_output_tokens=2048):
+    """Chamada simples de texto (sem JSON) com roteamento pelo circuit breaker.
+    Usada pelas etapas auxiliares (map). Registra os tokens consumidos sem
+    contar uma requisição a mais: a análise final do documento já conta."""
+    ultimo_erro = None
+    for modelo_config in modelos_roteados():
+        modelo_nome = modelo_config["name"]
+        if not circuito_permite_chamada(modelo_nome):
+            continue
+        try:
+            try:
+                response = gemini_client.models.generate_content(
+                    model=modelo_nome,
+                    contents=prompt,
+                    config=genai_types.GenerateContentConfig(
+                        temperature=0,
+                        max_output_tokens=max_output_tokens,
+                    ),
+                )
+            except Exception as e:
+                registrar_erro_circuito(modelo_nome, str(e))
+                raise
+            registrar_sucesso_circuito(modelo_nome)
 
-    🔥 VERSÃO CORRIGIDA - Perspectiva aplicada corretamente
+            texto_resposta = (response.text or "").strip()
+            if not texto_resposta:
+                raise ValueError(f"Resposta vazia do modelo {modelo_nome}")
 
-    Parâmetros:
-        texto: texto do documento
-        perspectiva: autor|reu|nao_informado
-        session_id: identificador de sessão — isola o cache entre usuários
-                    para evitar que um usuário veja o resultado de outro.
+            usage = getattr(response, 'usage_metadata', None)
+            try:
+                if usage:
+                    registrar_uso_tokens(tokens_input=getattr(usage, 'prompt_token_count', 0) or 0,
+                                         tokens_output=getattr(usage, 'candidates_token_count', 0) or 0,
+                                         contar_requisicao=False)
+                else:
+                    registrar_uso_tokens(tokens_input=len(prompt) // 4, tokens_output=len(texto_resposta) // 4,
+                                         contar_requisicao=False)
+            except Exception as e:
+                logging.warning(f"⚠️ Erro ao registrar tokens: {e}")
+            return texto_resposta
+        except Exception as e:
+            ultimo_erro = e
+            logging.warning(f"⚠️ Map: erro em {modelo_nome}: {str(e)[:100]}")
+            continue
+    raise Exception(f"Nenhum modelo disponível para a etapa auxiliar. Último erro: {ultimo_erro}")
+
+
+def extrair_fatos_bloco(bloco, numero, total):
+    """Etapa map: extrai os fatos relevantes de um bloco, sem interpretar."""
+    prompt = f"""Você está lendo o TRECHO {numero} de {total} de um documento judicial longo.
+Liste, em tópicos curtos e objetivos, SOMENTE o que estiver escrito NESTE trecho:
+- tipo de peça/seção (relatório, fundamentação, dispositivo, ementa, mandado, certidão...)
+- partes e seus papéis (autor, réu, vítima...), juiz(a)/relator(a), número do processo
+- valores, com a que se referem (copie os números exatamente)
+- prazos, datas, audiências (com links, se houver)
+- pedidos e fundamentos decisivos
+- decisão/dispositivo: copie LITERALMENTE frases com "JULGO", "Ante o exposto", "DETERMINO", "CONDENO", "CUMPRA-SE"
+- menções a segredo de justiça, justiça gratuita, ato infracional/ECA
+
+NÃO invente, NÃO resuma o que não está no trecho. Se não houver nada relevante, responda apenas: SEM CONTEÚDO RELEVANTE.
+
+{delimitar_texto_usuario(bloco)}"""
+    return gerar_texto_gemini(prompt, max_output_tokens=2048)
+
+
+def condensar_documento_longo(texto):
     """
+    Map-reduce: divide o documento em blocos e extrai os fatos de cada um em
+    paralelo (map_reduce_executor). O resultado, em ordem, substitui o texto
+    original no prompt de análise (reduce).
+
+    Returns:
+        tuple: (texto_condensado, quantidade_de_blocos)
+    """
+    blocos = dividir_texto_em_blocos(texto)
+    total = len(blocos)
+    inicio = time.monotonic()
+    logging.info(f"🧩 Map-reduce: {len(texto)} chars em {total} blocos (paralelo: {MAP_REDUCE_MAX_PARALELO})")
+
+    futuros = [map_reduce_executor.submit(extrair_fatos_bloco, bloco, i, total) for i, bloco in enumerate(blocos, 1)]
+    # Na primeira falha o map-reduce inteiro é abandonado (cai no truncamento):
+    # os blocos ainda na fila não chegam a chamar o Gemini
+    wait(futuros, return_when=FIRST_EXCEPTION)
+    if any(f.done() and not f.cancelled() and f.exception() for f in futuros):
+        for f in futuros:
+            f.cancel()
+    fatos = [f.result() for f in futuros]  # ordem original preservada; levanta a falha
+
+    partes = [
+        f"=== TRECHO {i}/{total} ===\n{conteudo}"
+        for i, conteudo in enumerate(fatos, 1)
+        if "SEM CONTEÚDO RELEVANTE" not in conteudo.upper()[:40]
+    ]
+    condensado = (
+        f"[DOCUMENTO LONGO ({len(texto)} CARACTERES) PROCESSADO EM {total} TRECHOS. "
+        "Abaixo estão os fatos extraídos de cada trecho, NA ORDEM ORIGINAL. "
+        "Use APENAS estas informações; NÃO invente nada que não esteja aqui.]\n\n"
+        + "\n\n".join(partes)
+    )
+    logging.info(f"✅ Map-reduce: {len(texto)} -> {len(condensado)} chars em {time.monotonic() - inicio:.1f}s")
+    return condensado, total
+
+
+def preparar_texto_analise(texto):
+    """
+    Texto que vai para o prompt de análise. Documentos enormes passam primeiro
+    pela seleção de seções relevantes (SELECAO_MAX_TOKENS); se o resultado ainda
+    passar de LIMITE_ANALISE, é condensado via map-reduce. Se o map-reduce
+    falhar, cai no truncamento início/fim de montar_prompt_analise.
+
+    Returns:
+        tuple: (texto_para_prompt, info) - info vai para a análise final
+    """
+    info = {"blocos_map_reduce": 0, "selecao_secoes": None}
+
+    if SELECAO_SECOES_ENABLED:
+        texto, info["selecao_secoes"] = selecionar_secoes_relevantes(texto)
+
+    if not MAP_REDUCE_ENABLED or len(texto) <= LIMITE_ANALISE:
+        return texto, info
+    try:
+        texto, info["blocos_map_reduce"] = condensar_documento_longo(texto)
+    except Exception as e:
+        logging.error(f"❌ Map-reduce falhou, usando truncamento: {e}")
+    return texto, info
+
+
+# ============= SELEÇÃO DE SEÇÕES RELEVANTES =============
+# Processos com centenas de páginas: antes de qualquer chamada ao Gemini, as
+# seções são pontuadas localmente (marcadores judiciais) e só as mais relevantes
+# seguem, dentro de SELECAO_MAX_TOKENS. O cabeçalho (partes, nº do processo) sempre vai.
+
+SELECAO_SECOES_ENABLED = os.getenv("SELECAO_SECOES_ENABLED", "true").lower() == "true"
+SELECAO_MAX_TOKENS = int(os.getenv("SELECAO_MAX_TOKENS", "40000"))
+SELECAO_SECAO_CHARS = 3000  # granularidade das seções pontuadas
+
+# Marcadores além dos judiciais de MARCADORES_JUDICIAIS: (regex, peso)
+MARCADORES_RELEVANCIA = [
+    (r'\bEMENTA\b', 4),
+    (r'\bDISPOSITIVO\b', 4),
+    (r'\bMANDADO\s+DE\s+(?:INTIMA[ÇC][ÃA]O|CITA[ÇC][ÃA]O|NOTIFICA[ÇC][ÃA]O|PENHORA|PRIS[ÃA]O)', 4),
+    (r'\b(?:INTIME|CITE|NOTIFIQUE|PUBLIQUE|REGISTRE)[\s-]*SE\b', 2),
+    (r'\bPRAZO\s+DE\s+\d+', 2),
+    (r'\bAUDI[ÊE]NCIA\b', 2),
+    (r'\b\d{7}-\d{2}\.\d{4}\.\d\.\d{2}\.\d{4}\b', 2),  # número CNJ
+    (r'R\$\s*[\d.]+,\d{2}', 1),
+]
+
+
+def pontuar_secao(secao):
+    """Pontuação de relevância de uma seção (soma dos pesos dos marcadores presentes)."""
+    secao_upper = secao.upper()
+    pontos = 0
+    for padrao, peso, _, _ in MARCADORES_JUDICIAIS:
+        if re.search(padrao, secao_upper):
+            pontos += peso
+    for padrao, peso in MARCADORES_RELEVANCIA:
+        if re.search(padrao, secao_upper):
+            pontos += peso
+    return pontos
 
-    # Verificar cache antes de chamar Gemini
-    # O session_id é incluído na chave para isolar cache entre usuários (anti cross-session leak)
-    sid = session_id or ""
-    cache_key = hashlib.sha256(f"{sid}:{perspectiva}:{texto}".encode()).hexdigest()
-    with cleanup_lock:
-        if cache_key in results_cache:
-            cache_entry = results_cache[cache_key]
-            if time.time() - cache_entry["timestamp"] < CACHE_EXPIRATION:
-                logging.info(f"✅ Cache hit! Retornando resultado em cache (key={cache_key[:8]}...)")
-                return cache_entry["result"]
-            else:
-                del results_cache[cache_key]
-                logging.info(f"🗑️ Cache expirado removido (key={cache_key[:8]}...)")
+
+def selecionar_secoes_relevantes(texto, max_tokens=None):
+    """
+    Mantém as seções de maior pontuação até o orçamento de tokens (≈ 4 chars/token),
+    na ordem original e com marcador de omissão entre trechos não contíguos.
+
+    Returns:
+        tuple: (texto_selecionado, info) - info é None se nada precisou ser cortado
+    """
+    max_tokens = max_tokens or SELECAO_MAX_TOKENS
+    orcamento_chars = max_tokens * 4
+    if len(texto) <= orcamento_chars:
+        return texto, None
+
+    secoes = dividir_texto_em_blocos(texto, SELECAO_SECAO_CHARS)
+    if not secoes:  # só espaços: não há o que pontuar
+        return texto.strip(), None
+    pontuacoes = [pontuar_secao(s) for s in secoes]
+
+    # Cabeçalho sempre; depois maior pontuação (empate: a mais ao fim, onde fica o dispositivo)
+    ordem = [0] + sorted(range(1, len(secoes)), key=lambda i: (pontuacoes[i], i), reverse=True)
+    escolhidas = set()
+    usados = 0
+    for i in ordem:
+        if usados + len(secoes[i]) > orcamento_chars:
+            continue
+        escolhidas.add(i)
+        usados += len(secoes[i])
+
+    partes = []
+    anterior = -1
+    for i in sorted(escolhidas):
+        if i != anterior + 1:
+            partes.append("[... trechos de menor relevância omitidos ...]")
+        partes.append(secoes[i])
+        anterior = i
+    if anterior != len(secoes) - 1:
+        partes.append("[... trechos de menor relevância omitidos ...]")
+
+    texto_selecionado = "\n\n".join(partes)
+    info = {
+        "secoes_total": len(secoes),
+        "secoes_enviadas": len(escolhidas),
+        "chars_original": len(texto),
+        "chars_enviados": len(texto_selecionado),
+    }
+    logging.info(f"🎯 Seleção de seções: {len(escolhidas)}/{len(secoes)} seções, {len(texto)} -> {len(texto_selecionado)} chars (orçamento {max_tokens} tokens)")
+    return texto_selecionado, info
+
+
+# ============= ANÁLISE COMPLETA COM GEMINI =============
+
+def montar_prompt_analise(texto, perspectiva="nao_informado"):
+    """
+    Monta o prompt completo de análise (JSON técnico + texto simplificado).
+    Compartilhado entre a análise bloqueante e a versão em streaming.
+
+    Returns:
+        tuple: (prompt, texto_truncado)
+    """
 
     # Limite aumentado: os modelos Flash 2.0/2.5 suportam até 1M tokens de input.
-    # 60000 chars ≈ 15000 tokens, folga suficiente para o prompt completo.
-    # Se ultrapassar, truncamos mantendo início e fim, com aviso explícito no output.
-    LIMITE_ANALISE = 60000
+    # Documentos maiores chegam aqui já condensados (preparar_texto_analise); se
+    # ainda ultrapassar, truncamos mantendo início e fim, com aviso explícito no output.
     texto_truncado = False
     if len(texto) > LIMITE_ANALISE:
         metade = LIMITE_ANALISE // 2
@@ -1580,365 +2003,941 @@ Responda EXATAMENTE neste formato:
 [TEXTO SIMPLIFICADO EM MARKDOWN AQUI - RESPEITANDO A PERSPECTIVA ESCOLHIDA]
 """
 
-    # Tentar cada modelo em ordem de prioridade
-    modelos_ordenados = sorted(GEMINI_MODELS, key=lambda x: x["priority"])
-    total_modelos = len(modelos_ordenados)
-    ultimo_erro = None
-    erros_por_modelo = {}
-
-    logging.info(f"🔄 Sistema multi-modelo: {total_modelos} modelos disponíveis para fallback")
+    return prompt, texto_truncado
 
-    for idx, modelo_config in enumerate(modelos_ordenados, 1):
-        modelo_nome = modelo_config["name"]
 
-        try:
-            logging.info(f"🤖 [{idx}/{total_modelos}] Tentando modelo: {modelo_nome} - {modelo_config.get('description', '')}")
+def gerar_chave_cache_analise(texto, perspectiva, session_id=None):
+    """Chave do cache de análises. O session_id entra na chave para isolar
+    o cache entre usuários (anti cross-session leak)."""
+    sid = session_id or ""
+    return hashlib.sha256(f"{sid}:{perspectiva}:{texto}".encode()).hexdigest()
 
-            # Chamada com timeout implícito
-            # max_output_tokens aumentado para 8192 (máximo dos Flash) — evita truncamento
-            # da análise em documentos complexos com muitas seções e valores discriminados.
-            response = gemini_client.models.generate_content(
-                model=modelo_nome,
-                contents=prompt,
-                config=genai_types.GenerateContentConfig(
-                    temperature=0,
-                    max_output_tokens=8192,
-                ),
-            )
 
-            # Verificar se a resposta contém texto válido
-            texto_resposta = response.text
-            if not texto_resposta:
-                raise ValueError(f"Resposta vazia ou bloqueada do modelo {modelo_nome}")
-            resposta_completa = texto_resposta.strip()
-            if not resposta_completa:
-                raise ValueError(f"Resposta em branco do modelo {modelo_nome}")
-            logging.info(f"✅ Resposta recebida do {modelo_nome} ({len(resposta_completa)} chars)")
-
-            # Separar JSON e texto simplificado
-            if "---SEPARADOR---" in resposta_completa:
-                partes = resposta_completa.split("---SEPARADOR---", 1)
-                json_texto = partes[0].strip()
-                texto_simplificado = partes[1].strip()
-                logging.info("✅ Separador encontrado na resposta")
+def buscar_analise_cache(cache_key):
+    """Retorna a análise em cache (ou None se ausente/expirada).
+    1º nível: results_cache do worker; 2º nível: cache_compartilhado (todos os workers)."""
+    with cleanup_lock:
+        if cache_key in results_cache:
+            cache_entry = results_cache[cache_key]
+            if time.time() - cache_entry["timestamp"] < CACHE_EXPIRATION:
+                logging.info(f"✅ Cache hit! Retornando resultado em cache (key={cache_key[:8]}...)")
+                return cache_entry["result"]
             else:
-                logging.warning("⚠️ Separador não encontrado, tentando regex fallback")
-                # Fallback: tentar extrair JSON
-                json_match = re.search(r'```json\s*(\{.*?\})\s*```', resposta_completa, re.DOTALL)
-                if json_match:
-                    json_texto = json_match.group(1)
-                    texto_simplificado = resposta_completa.replace(json_match.group(0), "").strip()
-                    logging.info("✅ JSON extraído via regex")
-                else:
-                    logging.error("❌ Formato de resposta inválido - separador não encontrado")
-                    logging.error(f"Primeiros 500 chars da resposta: {resposta_completa[:500]}")
-                    raise ValueError("Formato de resposta inválido")
-
-            # Limpar e parsear JSON
-            json_texto = json_texto.replace("```json", "").replace("```", "").strip()
+                del results_cache[cache_key]
+                logging.info(f"🗑️ Cache expirado removido (key={cache_key[:8]}...)")
 
-            # Tentar parsear
-            try:
-                analise = json.loads(json_texto)
-                logging.info(f"✅ JSON parseado com sucesso")
-            except json.JSONDecodeError as e:
-                logging.error(f"❌ Erro ao parsear JSON: {e}")
-                logging.error(f"JSON recebido (primeiros 500 chars): {json_texto[:500]}")
-                raise ValueError(f"Gemini retornou JSON inválido: {e}")
-
-            # Validar e limpar texto simplificado
-            texto_simplificado, teve_vazamentos = validar_e_limpar_output(texto_simplificado)
-
-            # Adicionar texto simplificado
-            analise["texto_simplificado"] = texto_simplificado
-            analise["modelo_usado"] = modelo_nome
-            analise["tentativa_numero"] = idx  # 1=primário, 2=fallback1, etc (métricas admin)
-            analise["perspectiva_aplicada"] = perspectiva  # 🔥 NOVO - registrar perspectiva
-            analise["teve_vazamentos"] = teve_vazamentos  # 🔥 NOVO - flag de vazamentos
-            analise["documento_truncado"] = texto_truncado  # aviso de truncamento para o frontend
-
-            # 🔥 VALIDAÇÃO DE DISCRIMINAÇÃO DE VALORES
-            valores = analise.get("valores_principais", {})
-
-            # Log para debug
-            if valores.get("danos_materiais_discriminado") and len(valores.get("danos_materiais_discriminado", [])) > 1:
-                logging.info(f"✅ Discriminação de danos materiais detectada: {len(valores['danos_materiais_discriminado'])} itens")
-
-            if valores.get("danos_morais_discriminado") and len(valores.get("danos_morais_discriminado", [])) > 1:
-                logging.info(f"✅ Discriminação de danos morais detectada: {len(valores['danos_morais_discriminado'])} beneficiários")
-
-            # Validar discriminação usando função robusta
-            passou_validacao, avisos_validacao = validar_discriminacao_valores(texto_simplificado, valores)
-            analise["validacao_discriminacao"] = {
-                "passou": passou_validacao,
-                "avisos": avisos_validacao
-            }
+    analise = cache_compartilhado.obter(cache_key)
+    if analise is not None:
+        logging.info(f"✅ Cache hit (compartilhado)! key={cache_key[:8]}...")
+        salvar_analise_cache(cache_key, analise, compartilhar=False)
+    return analise
 
-            # Atualizar estatísticas de sucesso
-            model_usage_stats[modelo_nome]["attempts"] += 1
-            model_usage_stats[modelo_nome]["successes"] += 1
 
-            # 📊 REGISTRAR TOKENS CONSUMIDOS
-            try:
-                usage = getattr(response, 'usage_metadata', None)
-                if usage:
-                    tokens_in = getattr(usage, 'prompt_token_count', 0) or 0
-                    tokens_out = getattr(usage, 'candidates_token_count', 0) or 0
-                    registrar_uso_tokens(tokens_input=tokens_in, tokens_output=tokens_out)
-                    analise["tokens_usados"] = {"input": tokens_in, "output": tokens_out, "total": tokens_in + tokens_out}
-                    logging.info(f"📊 Tokens: input={tokens_in:,}, output={tokens_out:,}, total={tokens_in + tokens_out:,}")
-                else:
-                    # Estimar tokens se metadata não disponível (~4 chars = 1 token)
-                    tokens_est_in = len(prompt) // 4
-                    tokens_est_out = len(resposta_completa) // 4
-                    registrar_uso_tokens(tokens_input=tokens_est_in, tokens_output=tokens_est_out)
-                    analise["tokens_usados"] = {"input": tokens_est_in, "output": tokens_est_out, "total": tokens_est_in + tokens_est_out, "estimado": True}
-                    logging.info(f"📊 Tokens (estimado): input≈{tokens_est_in:,}, output≈{tokens_est_out:,}")
-            except Exception as e:
-                logging.warning(f"⚠️ Erro ao registrar tokens: {e}")
+def invalidar_analise_cache(cache_key):
+    """Remove a análise dos dois níveis de cache (força nova chamada ao Gemini)."""
+    with cleanup_lock:
+        results_cache.pop(cache_key, None)
+    cache_compartilhado.remover(cache_key)
 
-            logging.info(f"✅ Análise completa com {modelo_nome}: tipo={analise.get('tipo_documento')}, confiança={analise.get('confianca_tipo')}, perspectiva={perspectiva}")
 
-            # Salvar resultado no cache
-            with cleanup_lock:
-                results_cache[cache_key] = {
-                    "result": analise,
-                    "timestamp": time.time()
-                }
-                # Limitar tamanho do cache (máx 50 entradas)
-                if len(results_cache) > 50:
-                    oldest_key = min(results_cache, key=lambda k: results_cache[k]["timestamp"])
-                    del results_cache[oldest_key]
-            logging.info(f"📦 Resultado salvo em cache (key={cache_key[:8]}..., total={len(results_cache)})")
+def invalidar_analise_documento(texto, perspectiva, session_id):
+    """Re-análise forçada: remove a análise do documento da sessão e também a
+    entrada do cache anônimo (sem session_id), senão o Gemini não é chamado de novo."""
+    invalidar_analise_cache(gerar_chave_cache_analise(texto, perspectiva, session_id))
+    cache_compartilhado.remover(gerar_chave_cache_anonimo(texto, perspectiva))
 
-            return analise
 
-        except Exception as e:
-            ultimo_erro = e
-            erro_msg = str(e)
-            erros_por_modelo[modelo_nome] = erro_msg[:200]
+def salvar_analise_cache(cache_key, analise, compartilhar=True, chave_anonima=None):
+    """Salva a análise no cache (máx 50 entradas, remove a mais antiga)
+    e, por padrão, também no cache compartilhado entre workers.
+    chave_anonima só vem preenchida quando o conteúdo é elegível ao cache anônimo."""
+    if compartilhar:
+        cache_compartilhado.salvar(cache_key, analise)
+    if chave_anonima:
+        cache_compartilhado.salvar(chave_anonima, analise)
+    with cleanup_lock:
+        results_cache[cache_key] = {
+            "result": analise,
+            "timestamp": time.time()
+        }
+        # Limitar tamanho do cache (máx 50 entradas)
+        if len(results_cache) > 50:
+            oldest_key = min(results_cache, key=lambda k: results_cache[k]["timestamp"])
+            del results_cache[oldest_key]
+    logging.info(f"📦 Resultado salvo em cache (key={cache_key[:8]}..., total={len(results_cache)})")
 
-            # Atualizar estatísticas de falha
-            if modelo_nome in model_usage_stats:
-                model_usage_stats[modelo_nome]["attempts"] += 1
-                model_usage_stats[modelo_nome]["failures"] += 1
 
-            # Identificar tipo de erro
-            is_quota_error = "quota" in erro_msg.lower() or "429" in erro_msg or "resource" in erro_msg.lower()
+def gerar_chave_cache_anonimo(texto, perspectiva):
+    """Chave do cache anônimo: só perspectiva + texto normalizado (sem session_id)."""
+    normalizado = re.sub(r'\s+', ' ', unicodedata.normalize('NFC', texto)).strip()
+    return "anon:" + hashlib.sha256(f"{perspectiva}:{normalizado}".encode()).hexdigest()
 
-            if is_quota_error:
-                logging.error(f"❌ [{idx}/{total_modelos}] Quota excedida em {modelo_nome}")
 
-                # Extrair tempo de retry sugerido pela API (ex: "retry in 2.7s")
-                retry_match = re.search(r'retry\s+in\s+([\d.]+)s', erro_msg, re.IGNORECASE)
-                if retry_match and idx < total_modelos:
-                    wait_time = min(float(retry_match.group(1)), 5.0)  # Máximo 5 segundos
-                    logging.info(f"⏳ Aguardando {wait_time:.1f}s antes do próximo modelo...")
-                    time.sleep(wait_time)
-            else:
-                logging.error(f"❌ [{idx}/{total_modelos}] Erro em {modelo_nome}: {erro_msg[:100]}")
+def buscar_analise_cache_anonimo(texto, perspectiva, session_id):
+    """
+    Cache anônimo (opt-in via CACHE_ANONIMO_ENABLED) para documentos emitidos em
+    massa (mesmo mandado/intimação para centenas de partes). Só é usado quando o
+    mesmo conteúdo já veio de CACHE_ANONIMO_MIN_SESSOES sessões distintas - o que
+    descarta documentos com dados de um único usuário.
 
-            if idx < total_modelos:
-                logging.warning(f"⚠️ Tentando próximo modelo ({idx+1}/{total_modelos})...")
+    Returns:
+        tuple: (analise ou None, chave_anonima ou None se o conteúdo não é elegível)
+    """
+    if not CACHE_ANONIMO_ENABLED or not session_id:
+        return None, None
 
-            continue
+    chave_anonima = gerar_chave_cache_anonimo(texto, perspectiva)
+    sessao_hash = hashlib.sha256(session_id.encode()).hexdigest()
+    sessoes = cache_compartilhado.registrar_sessao_conteudo(chave_anonima, sessao_hash)
+    if sessoes < CACHE_ANONIMO_MIN_SESSOES:
+        return None, None
 
-    # Se chegou aqui, todos os modelos falharam
-    logging.error(f"❌ TODOS OS {total_modelos} MODELOS FALHARAM!")
-    logging.error(f"📊 Resumo de erros por modelo:")
-    for modelo, erro in erros_por_modelo.items():
-        logging.error(f"  - {modelo}: {erro}")
-    logging.error(f"📊 Estatísticas dos modelos: {model_usage_stats}")
+    analise = cache_compartilhado.obter(chave_anonima)
+    try:
+        database.registrar_cache_anonimo(hit=analise is not None)
+    except Exception as e:
+        logging.warning(f"⚠️ Erro ao registrar contador do cache anônimo: {e}")
+    if analise is not None:
+        logging.info(f"✅ Cache anônimo hit (conteúdo visto em {sessoes} sessões, key={chave_anonima[5:13]}...)")
+    return analise, chave_anonima
 
-    # Mensagem de erro amigável baseada no tipo de erro
-    todos_quota = all("quota" in err.lower() or "429" in err for err in erros_por_modelo.values())
-    if todos_quota:
-        raise Exception(
-            "O limite de uso da API Gemini foi atingido para todos os modelos disponíveis. "
-            "Isso geralmente acontece no plano gratuito. "
-            "Aguarde alguns minutos e tente novamente. "
-            "Se o problema persistir, verifique sua cota em https://ai.google.dev/gemini-api/docs/rate-limits"
-        )
-    else:
-        raise Exception(f"Erro ao processar documento com IA. Último erro: {ultimo_erro}")
 
-# ============= FUNÇÕES AUXILIARES =============
+def parsear_json_analise(json_texto):
+    """Limpa as cercas ```json e faz o parse do bloco de análise técnica.
+    Lança ValueError se o JSON for inválido."""
+    json_texto = json_texto.replace("```json", "").replace("```", "").strip()
+    try:
+        analise = json.loads(json_texto)
+        logging.info(f"✅ JSON parseado com sucesso")
+    except json.JSONDecodeError as e:
+        logging.error(f"❌ Erro ao parsear JSON: {e}")
+        logging.error(f"JSON recebido (primeiros 500 chars): {json_texto[:500]}")
+        raise ValueError(f"Gemini retornou JSON inválido: {e}")
+    return analise
 
-def extrair_numero_processo_regex(texto):
-    """Extração simples de número de processo com regex"""
-    processo_patterns = [
-        r'\d{7}-\d{2}\.\d{4}\.\d\.\d{2}\.\d{4}',  # CNJ
-        r'Processo\s+n[º°]?\s*([\d\.\-\/]+)'
-    ]
-    for pattern in processo_patterns:
-        match = re.search(pattern, texto, re.IGNORECASE)
-        if match:
-            return match.group()
-    return None
 
-def gerar_perguntas_sugeridas(dados):
-    """Gera perguntas baseadas nos dados extraídos"""
-    perguntas = []
+def separar_resposta_gemini(resposta_completa):
+    """
+    Separa a resposta do Gemini em análise (dict) e texto simplificado.
+    Usa o ---SEPARADOR--- e, na falta dele, extrai o bloco ```json via regex.
 
-    valores = dados.get("valores", {})
-    if valores.get("total_a_receber") or valores.get("danos_morais") or valores.get("danos_materiais"):
-        perguntas.append("Quanto vou receber?")
+    Returns:
+        tuple: (analise, texto_simplificado)
+    """
+    if "---SEPARADOR---" in resposta_completa:
+        partes = resposta_completa.split("---SEPARADOR---", 1)
+        json_texto = partes[0].strip()
+        texto_simplificado = partes[1].strip()
+        logging.info("✅ Separador encontrado na resposta")
+    else:
+        logging.warning("⚠️ Separador não encontrado, tentando regex fallback")
+        # Fallback: tentar extrair JSON
+        json_match = re.search(r'```json\s*(\{.*?\})\s*```', resposta_completa, re.DOTALL)
+        if json_match:
+            json_texto = json_match.group(1)
+            texto_simplificado = resposta_completa.replace(json_match.group(0), "").strip()
+            logging.info("✅ JSON extraído via regex")
+        else:
+            logging.error("❌ Formato de resposta inválido - separador não encontrado")
+            logging.error(f"Primeiros 500 chars da resposta: {resposta_completa[:500]}")
+            raise ValueError("Formato de resposta inválido")
 
-    if dados.get("prazos"):
-        perguntas.append("Quais são os prazos importantes?")
+    return parsear_json_analise(json_texto), texto_simplificado
 
-    if dados.get("audiencias"):
-        perguntas.append("Quando é a audiência?")
 
-    if dados.get("decisao"):
-        perguntas.append("Eu ganhei ou perdi?")
+def finalizar_analise(analise, texto_simplificado, modelo_nome, tentativa, perspectiva, texto_truncado, info_preparo=None):
+    """Limpa o texto simplificado, anexa metadados do modelo e valida
+    a discriminação de valores. Retorna o próprio dict `analise`."""
+    # Validar e limpar texto simplificado
+    texto_simplificado, teve_vazamentos = validar_e_limpar_output(texto_simplificado)
 
-    return perguntas[:4]
+    # Adicionar texto simplificado
+    analise["texto_simplificado"] = texto_simplificado
+    analise["modelo_usado"] = modelo_nome
+    analise["tentativa_numero"] = tentativa  # 1=primário, 2=fallback1, etc (métricas admin)
+    analise["perspectiva_aplicada"] = perspectiva  # 🔥 NOVO - registrar perspectiva
+    analise["teve_vazamentos"] = teve_vazamentos  # 🔥 NOVO - flag de vazamentos
+    analise["documento_truncado"] = texto_truncado  # aviso de truncamento para o frontend
+    # Preparo do texto: blocos do map-reduce (0 = sem) e seleção de seções (None = documento inteiro)
+    analise.update(info_preparo or {"blocos_map_reduce": 0, "selecao_secoes": None})
 
-# ============= PROCESSAMENTO DE IMAGENS E PDFs =============
+    # 🔥 VALIDAÇÃO DE DISCRIMINAÇÃO DE VALORES
+    valores = analise.get("valores_principais", {})
 
-def processar_imagem_para_texto(image_bytes, formato='PNG'):
-    """Extrai texto de imagem usando OCR"""
-    texto = ""
-    metadados = {
-        "tipo": "imagem",
-        "formato": formato,
-        "usou_ocr": True,
-        "dimensoes": None,
-        "qualidade_ocr": "indefinida",
-        "tesseract_disponivel": TESSERACT_AVAILABLE
-    }
+    # Log para debug
+    if valores.get("danos_materiais_discriminado") and len(valores.get("danos_materiais_discriminado", [])) > 1:
+        logging.info(f"✅ Discriminação de danos materiais detectada: {len(valores['danos_materiais_discriminado'])} itens")
 
-    if not TESSERACT_AVAILABLE:
-        raise ValueError("OCR não está disponível neste servidor")
+    if valores.get("danos_morais_discriminado") and len(valores.get("danos_morais_discriminado", [])) > 1:
+        logging.info(f"✅ Discriminação de danos morais detectada: {len(valores['danos_morais_discriminado'])} beneficiários")
 
-    try:
-        img = Image.open(io.BytesIO(image_bytes))
-        metadados["dimensoes"] = f"{img.width}x{img.height}"
-
-        if img.mode not in ('RGB', 'L'):
-            img = img.convert('RGB')
-
-        # Upscale small images for better OCR (minimum 300 DPI equivalent)
-        min_dimension = 2000
-        if img.width < min_dimension or img.height < min_dimension:
-            scale = max(min_dimension / img.width, min_dimension / img.height)
-            if scale > 1:
-                new_size = (int(img.width * scale), int(img.height * scale))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                logging.info(f"📐 Imagem ampliada para {new_size[0]}x{new_size[1]} (escala {scale:.1f}x)")
-
-        # Limit maximum size
-        if img.width > 4000 or img.height > 4000:
-            ratio = min(4000/img.width, 4000/img.height)
-            new_size = (int(img.width * ratio), int(img.height * ratio))
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
-
-        if CV2_AVAILABLE:
-            # Advanced preprocessing with OpenCV
-            logging.info("🔬 Usando OpenCV para pré-processamento avançado")
-            img_array = np.array(img.convert('RGB'))
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-
-            # Noise removal
-            denoised = cv2.fastNlMeansDenoising(gray, None, 10, 7, 21)
-
-            # Deskew detection and correction
-            try:
-                coords = np.column_stack(np.where(denoised < 200))
-                if len(coords) > 100:
-                    angle = cv2.minAreaRect(coords)[-1]
-                    if angle < -45:
-                        angle = -(90 + angle)
-                    else:
-                        angle = -angle
-                    if abs(angle) > 0.5 and abs(angle) < 15:
-                        (h, w) = denoised.shape[:2]
-                        center = (w // 2, h // 2)
-                        M = cv2.getRotationMatrix2D(center, angle, 1.0)
-                        denoised = cv2.warpAffine(denoised, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-                        logging.info(f"📐 Deskew aplicado: {angle:.1f}°")
-            except Exception as e:
-                logging.warning(f"⚠️ Erro no deskew: {e}")
+    # Validar discriminação usando função robusta
+    passou_validacao, avisos_validacao = validar_discriminacao_valores(texto_simplificado, valores)
+    analise["validacao_discriminacao"] = {
+        "passou": passou_validacao,
+        "avisos": avisos_validacao
+    }
 
-            # Adaptive thresholding (binarization)
-            binary = cv2.adaptiveThreshold(denoised, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+    return analise
 
-            # Morphological operations to clean up
-            kernel = np.ones((1, 1), np.uint8)
-            binary = cv2.dilate(binary, kernel, iterations=1)
-            binary = cv2.erode(binary, kernel, iterations=1)
 
-            img = Image.fromarray(binary)
-        else:
-            # Basic preprocessing with PIL only
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(1.8)
-            enhancer = ImageEnhance.Sharpness(img)
-            img = enhancer.enhance(2.0)
-            img = img.convert('L')
-            # Simple thresholding
-            img = img.point(lambda x: 0 if x < 140 else 255, '1')
-            img = img.convert('L')
-
-        # OCR com timeout rígido — imagens muito grandes podem travar o worker por minutos
-        custom_config = r'--oem 3 --psm 3 -l por+eng' if 'por' in TESSERACT_LANGS else r'--oem 3 --psm 3 -l eng'
-        try:
-            texto = pytesseract.image_to_string(img, config=custom_config, timeout=45)
-        except RuntimeError as e:
-            # pytesseract lança RuntimeError quando timeout estoura
-            logging.error(f"⏱️ OCR timeout ({e}) — imagem muito complexa ou grande")
-            raise ValueError("Tempo limite do OCR excedido. Envie uma imagem mais nítida ou menor.")
-        texto = pos_processar_texto_ocr(texto)
-
-        if len(texto.strip()) < 50:
-            metadados["qualidade_ocr"] = "baixa"
-        elif len(texto.strip()) < 200:
-            metadados["qualidade_ocr"] = "média"
+def registrar_tokens_analise(analise, usage, prompt, resposta_completa, tokens_economizados=0):
+    """Registra os tokens consumidos (usage_metadata do Gemini ou estimativa)
+    e anexa o resumo em analise["tokens_usados"]. tokens_economizados: estimativa
+    do que a remoção de boilerplate do PDF deixou de enviar."""
+    try:
+        if usage:
+            tokens_in = getattr(usage, 'prompt_token_count', 0) or 0
+            tokens_out = getattr(usage, 'candidates_token_count', 0) or 0
+            registrar_uso_tokens(tokens_input=tokens_in, tokens_output=tokens_out, tokens_economizados=tokens_economizados)
+            analise["tokens_usados"] = {"input": tokens_in, "output": tokens_out, "total": tokens_in + tokens_out}
+            logging.info(f"📊 Tokens: input={tokens_in:,}, output={tokens_out:,}, total={tokens_in + tokens_out:,}")
         else:
-            metadados["qualidade_ocr"] = "boa"
-
-        logging.info(f"OCR concluído. Qualidade: {metadados['qualidade_ocr']}")
-
+            # Estimar tokens se metadata não disponível (~4 chars = 1 token)
+            tokens_est_in = len(prompt) // 4
+            tokens_est_out = len(resposta_completa) // 4
+            registrar_uso_tokens(tokens_input=tokens_est_in, tokens_output=tokens_est_out, tokens_economizados=tokens_economizados)
+            analise["tokens_usados"] = {"input": tokens_est_in, "output": tokens_est_out, "total": tokens_est_in + tokens_est_out, "estimado": True}
+            logging.info(f"📊 Tokens (estimado): input≈{tokens_est_in:,}, output≈{tokens_est_out:,}")
     except Exception as e:
-        logging.error(f"Erro ao processar imagem: {e}")
-        raise
+        logging.warning(f"⚠️ Erro ao registrar tokens: {e}")
 
-    return texto, metadados
 
-def pos_processar_texto_ocr(texto):
-    """Pós-processamento de texto OCR para corrigir erros comuns"""
-    if not texto:
-        return texto
+def registrar_falha_modelo(modelo_nome, erro_msg, idx, total_modelos, contabilizar=True, aguardar_retry=True):
+    """Atualiza estatísticas de falha e, em erro de quota, respeita o
+    `retry in Xs` sugerido pela API (máx 5s) antes do próximo modelo.
+    No modo hedging as estatísticas já são contadas na thread e não há espera."""
+    if contabilizar:
+        contabilizar_modelo(modelo_nome, attempts=1, failures=1)
 
-    # Remove non-printable characters except newlines and tabs
-    texto = re.sub(r'[^\x20-\x7E\xA0-\xFF\n\t]', '', texto)
+    # Identificar tipo de erro
+    is_quota_error = "quota" in erro_msg.lower() or "429" in erro_msg or "resource" in erro_msg.lower()
 
-    # Fix common OCR artifacts
-    texto = re.sub(r'[|]{2,}', '', texto)  # Remove pipe sequences
-    texto = re.sub(r'[_]{3,}', '', texto)  # Remove underscore sequences
-    texto = re.sub(r'[\.]{4,}', '...', texto)  # Normalize dot sequences
+    if is_quota_error:
+        logging.error(f"❌ [{idx}/{total_modelos}] Quota excedida em {modelo_nome}")
 
-    # Fix broken hyphenation at end of lines (common in legal docs)
-    texto = re.sub(r'(\w)-\n(\w)', r'\1\2', texto)
+        # Extrair tempo de retry sugerido pela API (ex: "retry in 2.7s")
+        retry_match = re.search(r'retry\s+in\s+([\d.]+)s', erro_msg, re.IGNORECASE)
+        if retry_match and idx < total_modelos and aguardar_retry:
+            wait_time = min(float(retry_match.group(1)), 5.0)  # Máximo 5 segundos
+            logging.info(f"⏳ Aguardando {wait_time:.1f}s antes do próximo modelo...")
+            time.sleep(wait_time)
+    else:
+        logging.error(f"❌ [{idx}/{total_modelos}] Erro em {modelo_nome}: {erro_msg[:100]}")
 
-    # Normalize multiple spaces
-    texto = re.sub(r'[ \t]{2,}', ' ', texto)
+    if idx < total_modelos:
+        logging.warning(f"⚠️ Tentando próximo modelo ({idx+1}/{total_modelos})...")
 
-    # Normalize multiple blank lines
-    texto = re.sub(r'\n{3,}', '\n\n', texto)
 
-    return texto.strip()
+def erro_todos_modelos(erros_por_modelo, ultimo_erro):
+    """Loga o resumo e monta a exceção amigável quando todos os modelos falham."""
+    logging.error(f"❌ TODOS OS {len(GEMINI_MODELS)} MODELOS FALHARAM!")
+    logging.error(f"📊 Resumo de erros por modelo:")
+    for modelo, erro in erros_por_modelo.items():
+        logging.error(f"  - {modelo}: {erro}")
+    logging.error(f"📊 Estatísticas dos modelos: {model_usage_stats}")
 
-def extrair_texto_pdf(pdf_bytes):
-    """Extrai texto de PDF"""
-    texto = ""
+    # Mensagem de erro amigável baseada no tipo de erro
+    todos_quota = all("quota" in err.lower() or "429" in err for err in erros_por_modelo.values())
+    if todos_quota:
+        return Exception(
+            "O limite de uso da API Gemini foi atingido para todos os modelos disponíveis. "
+            "Isso geralmente acontece no plano gratuito. "
+            "Aguarde alguns minutos e tente novamente. "
+            "Se o problema persistir, verifique sua cota em https://ai.google.dev/gemini-api/docs/rate-limits"
+        )
+    return Exception(f"Erro ao processar documento com IA. Último erro: {ultimo_erro}")
+
+
+def erro_sem_modelos_disponiveis():
+    """Exceção para quando o roteador não tem nenhum modelo com circuito fechado/sondável."""
+    return erro_todos_modelos(erros_circuitos_abertos(), "todos os circuitos de modelo estão abertos")
+
+
+def chamar_modelo_analise(modelo_nome, prompt):
+    """
+    Uma chamada bloqueante ao Gemini + separação JSON/texto.
+    Lança exceção se a resposta vier vazia ou em formato inválido.
+
+    Returns:
+        tuple: (analise, texto_simplificado, usage_metadata, resposta_completa)
+    """
+    # max_output_tokens aumentado para 8192 (máximo dos Flash) — evita truncamento
+    # da análise em documentos complexos com muitas seções e valores discriminados.
+    try:
+        response = gemini_client.models.generate_content(
+            model=modelo_nome,
+            contents=prompt,
+            config=genai_types.GenerateContentConfig(
+                temperature=0,
+                max_output_tokens=8192,
+            ),
+        )
+    except Exception as e:
+        registrar_erro_circuito(modelo_nome, str(e))
+        raise
+    registrar_sucesso_circuito(modelo_nome)
+
+    # Verificar se a resposta contém texto válido
+    texto_resposta = response.text
+    if not texto_resposta:
+        raise ValueError(f"Resposta vazia ou bloqueada do modelo {modelo_nome}")
+    resposta_completa = texto_resposta.strip()
+    if not resposta_completa:
+        raise ValueError(f"Resposta em branco do modelo {modelo_nome}")
+    logging.info(f"✅ Resposta recebida do {modelo_nome} ({len(resposta_completa)} chars)")
+
+    # Separar JSON e texto simplificado
+    analise, texto_simplificado = separar_resposta_gemini(resposta_completa)
+    return analise, texto_simplificado, getattr(response, 'usage_metadata', None), resposta_completa
+
+
+def contabilizar_modelo(modelo_nome, **incrementos):
+    """Soma contadores de model_usage_stats (attempts=1, failures=1...) e recalcula
+    a taxa de hedge (hedges / tentativas)."""
+    with model_stats_lock:
+        stats = model_usage_stats.get(modelo_nome)
+        if stats is None:
+            return
+        for campo, valor in incrementos.items():
+            stats[campo] += valor
+        stats["hedge_rate"] = round(stats["hedges"] / max(stats["attempts"], 1), 3)
+
+
+def estatisticas_modelos():
+    """Cópia consistente de model_usage_stats (para o /health)."""
+    with model_stats_lock:
+        return {nome: dict(stats) for nome, stats in model_usage_stats.items()}
+
+
+def _chamar_modelo_hedge(modelo_nome, prompt, corrida_encerrada):
+    """Executa chamar_modelo_analise numa thread do hedge_executor (a tentativa é
+    contada no disparo). A chamada HTTP em andamento não pode ser interrompida: se
+    outra resposta já venceu a corrida (corrida_encerrada), o resultado é
+    descartado sem contar sucesso nem falha."""
+    try:
+        resultado = chamar_modelo_analise(modelo_nome, prompt)
+    except Exception:
+        if not corrida_encerrada.is_set():
+            contabilizar_modelo(modelo_nome, failures=1)
+        raise
+    if corrida_encerrada.is_set():
+        logging.info(f"🏁 Resposta de {modelo_nome} chegou depois do vencedor - descartada")
+    else:
+        contabilizar_modelo(modelo_nome, successes=1)
+    return resultado
+
+
+def executar_modelos_com_hedge(prompt, modelos_ordenados):
+    """
+    Corrida entre modelos: dispara o primário e, se ele não responder em
+    GEMINI_HEDGE_DELAY segundos, dispara o próximo em paralelo (e assim por diante).
+    Falhas disparam o próximo imediatamente, sem o sleep de quota do modo sequencial.
+    Vence a primeira resposta válida; as demais são ignoradas.
+
+    Returns:
+        tuple: (idx, modelo_nome, analise, texto_simplificado, usage, resposta_completa)
+    """
+    total_modelos = len(modelos_ordenados)
+    pendentes = {}
+    proximo = 0
+    ultimo_disparado = None
+    ultimo_erro = None
+    erros_por_modelo = {}
+    corrida_encerrada = threading.Event()
+
+    def disparar():
+        """Dispara o próximo modelo cujo circuito permite chamada. False se não há mais nenhum."""
+        nonlocal proximo, ultimo_disparado
+        while proximo < total_modelos:
+            modelo_nome = modelos_ordenados[proximo]["name"]
+            proximo += 1
+            if not circuito_permite_chamada(modelo_nome):
+                continue
+            logging.info(f"🤖 [{proximo}/{total_modelos}] Disparando modelo: {modelo_nome}")
+            contabilizar_modelo(modelo_nome, attempts=1)
+            futuro = hedge_executor.submit(_chamar_modelo_hedge, modelo_nome, prompt, corrida_encerrada)
+            pendentes[futuro] = (proximo, modelo_nome)
+            ultimo_disparado = modelo_nome
+            return True
+        return False
+
+    if not disparar():
+        raise erro_sem_modelos_disponiveis()
+    while pendentes:
+        timeout = GEMINI_HEDGE_DELAY if proximo < total_modelos else None
+        concluidos, _ = wait(pendentes, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        if not concluidos:
+            # Orçamento de latência estourado: hedge com o próximo modelo.
+            # O disparo é atribuído ao último modelo lançado (o que estourou o orçamento).
+            nome_lento = ultimo_disparado
+            if disparar():
+                contabilizar_modelo(nome_lento, hedges=1)
+                logging.warning(f"⏱️ {nome_lento} sem resposta em {GEMINI_HEDGE_DELAY:.0f}s - hedge com {ultimo_disparado}")
+            continue
+
+        for futuro in concluidos:
+            idx, modelo_nome = pendentes.pop(futuro)
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                ultimo_erro = e
+                erros_por_modelo[modelo_nome] = str(e)[:200]
+                registrar_falha_modelo(modelo_nome, str(e), idx, total_modelos,
+                                       contabilizar=False, aguardar_retry=False)
+                if not pendentes:
+                    disparar()
+                continue
+
+            # Vencedor: as demais chamadas seguem até o fim mas são descartadas
+            corrida_encerrada.set()
+            for outro in pendentes:
+                outro.cancel()
+            if pendentes:
+                logging.info(f"🏁 {modelo_nome} venceu a corrida; {len(pendentes)} chamada(s) descartada(s)")
+            return (idx, modelo_nome) + resultado
+
+    raise erro_todos_modelos(erros_por_modelo, ultimo_erro)
+
+
+def analisar_documento_completo_gemini(texto, perspectiva="nao_informado", session_id=None, tokens_economizados=0):
+    """
+    ANÁLISE COMPLETA DO DOCUMENTO EM 1 ÚNICA CHAMADA GEMINI
+    Retorna dict com análise técnica + texto simplificado
+
+    🔥 VERSÃO CORRIGIDA - Perspectiva aplicada corretamente
+
+    Parâmetros:
+        texto: texto do documento
+        perspectiva: autor|reu|nao_informado
+        session_id: identificador de sessão — isola o cache entre usuários
+                    para evitar que um usuário veja o resultado de outro.
+        tokens_economizados: tokens poupados na extração (boilerplate do PDF),
+                             registrados junto com o consumo desta análise
+    """
+
+    cache_key = gerar_chave_cache_analise(texto, perspectiva, session_id)
+    analise_cache = buscar_analise_cache(cache_key)
+    chave_anonima = None
+    if analise_cache is None:
+        analise_cache, chave_anonima = buscar_analise_cache_anonimo(texto, perspectiva, session_id)
+        if analise_cache is not None:
+            salvar_analise_cache(cache_key, analise_cache)
+    if analise_cache is not None:
+        return analise_cache
+
+    texto_prompt, info_preparo = preparar_texto_analise(texto)
+    prompt, texto_truncado = montar_prompt_analise(texto_prompt, perspectiva)
+
+    # Tentar cada modelo em ordem de prioridade (pulando circuitos abertos)
+    modelos_ordenados = modelos_roteados()
+    if not modelos_ordenados:
+        raise erro_sem_modelos_disponiveis()
+    total_modelos = len(modelos_ordenados)
+    ultimo_erro = None
+    erros_por_modelo = {}
+
+    if GEMINI_HEDGE_ENABLED:
+        logging.info(f"🔄 Sistema multi-modelo com hedging: {total_modelos} modelos, orçamento {GEMINI_HEDGE_DELAY:.0f}s")
+        idx, modelo_nome, analise, texto_simplificado, usage, resposta_completa = executar_modelos_com_hedge(prompt, modelos_ordenados)
+        analise = finalizar_analise(analise, texto_simplificado, modelo_nome, idx, perspectiva, texto_truncado, info_preparo)
+        registrar_tokens_analise(analise, usage, prompt, resposta_completa, tokens_economizados)
+        logging.info(f"✅ Análise completa com {modelo_nome}: tipo={analise.get('tipo_documento')}, confiança={analise.get('confianca_tipo')}, perspectiva={perspectiva}")
+        salvar_analise_cache(cache_key, analise, chave_anonima=chave_anonima)
+        return analise
+
+    logging.info(f"🔄 Sistema multi-modelo: {total_modelos} modelos disponíveis para fallback")
+
+    for idx, modelo_config in enumerate(modelos_ordenados, 1):
+        modelo_nome = modelo_config["name"]
+        if not circuito_permite_chamada(modelo_nome):
+            continue
+
+        try:
+            logging.info(f"🤖 [{idx}/{total_modelos}] Tentando modelo: {modelo_nome} - {modelo_config.get('description', '')}")
+
+            analise, texto_simplificado, usage, resposta_completa = chamar_modelo_analise(modelo_nome, prompt)
+            analise = finalizar_analise(analise, texto_simplificado, modelo_nome, idx, perspectiva, texto_truncado, info_preparo)
+
+            # Atualizar estatísticas de sucesso
+            contabilizar_modelo(modelo_nome, attempts=1, successes=1)
+
+            # 📊 REGISTRAR TOKENS CONSUMIDOS
+            registrar_tokens_analise(analise, usage, prompt, resposta_completa, tokens_economizados)
+
+            logging.info(f"✅ Análise completa com {modelo_nome}: tipo={analise.get('tipo_documento')}, confiança={analise.get('confianca_tipo')}, perspectiva={perspectiva}")
+
+            # Salvar resultado no cache
+            salvar_analise_cache(cache_key, analise, chave_anonima=chave_anonima)
+
+            return analise
+
+        except Exception as e:
+            ultimo_erro = e
+            erro_msg = str(e)
+            erros_por_modelo[modelo_nome] = erro_msg[:200]
+            registrar_falha_modelo(modelo_nome, erro_msg, idx, total_modelos)
+            continue
+
+    # Se chegou aqui, todos os modelos falharam
+    raise erro_todos_modelos(erros_por_modelo, ultimo_erro)
+
+# ============= ANÁLISE EM STREAMING =============
+
+SEPARADOR_RESPOSTA = "---SEPARADOR---"
+
+
+def analisar_documento_stream_gemini(texto, perspectiva="nao_informado", session_id=None, tokens_economizados=0):
+    """
+    Versão em streaming de analisar_documento_completo_gemini (mesmo prompt,
+    mesmo cache, mesmas métricas). Gera tuplas (evento, dados):
+
+        ("analise", dict) - JSON técnico, assim que o separador chega
+        ("texto", str)    - trechos do texto simplificado, sempre em linhas completas
+        ("fim", dict)     - análise final, idêntica à da versão bloqueante
+
+    Os trechos de "texto" são prévia (linhas com vazamento de instruções já
+    filtradas); o texto definitivo vem em analise["texto_simplificado"] no "fim".
+    O fallback para o próximo modelo só acontece enquanto nada foi emitido.
+    """
+    cache_key = gerar_chave_cache_analise(texto, perspectiva, session_id)
+    analise_cache = buscar_analise_cache(cache_key)
+    chave_anonima = None
+    if analise_cache is None:
+        analise_cache, chave_anonima = buscar_analise_cache_anonimo(texto, perspectiva, session_id)
+        if analise_cache is not None:
+            salvar_analise_cache(cache_key, analise_cache)
+    if analise_cache is not None:
+        yield "analise", analise_cache
+        yield "texto", analise_cache.get("texto_simplificado", "")
+        yield "fim", analise_cache
+        return
+
+    texto_prompt, info_preparo = preparar_texto_analise(texto)
+    prompt, texto_truncado = montar_prompt_analise(texto_prompt, perspectiva)
+
+    modelos_ordenados = modelos_roteados()
+    if not modelos_ordenados:
+        raise erro_sem_modelos_disponiveis()
+    total_modelos = len(modelos_ordenados)
+    ultimo_erro = None
+    erros_por_modelo = {}
+
+    for idx, modelo_config in enumerate(modelos_ordenados, 1):
+        modelo_nome = modelo_config["name"]
+        emitiu = False
+        if not circuito_permite_chamada(modelo_nome):
+            continue
+
+        try:
+            logging.info(f"🌊 [{idx}/{total_modelos}] Streaming com modelo: {modelo_nome}")
+
+            stream = gemini_client.models.generate_content_stream(
+                model=modelo_nome,
+                contents=prompt,
+                config=genai_types.GenerateContentConfig(
+                    temperature=0,
+                    max_output_tokens=8192,
+                ),
+            )
+
+            buffer = ""
+            analise = None
+            inicio_texto = 0   # posição do texto simplificado no buffer
+            enviado = 0        # até onde o buffer já foi emitido
+            usage = None
+
+            for chunk in stream:
+                usage = getattr(chunk, 'usage_metadata', None) or usage
+                buffer += chunk.text or ""
+
+                if analise is None:
+                    if SEPARADOR_RESPOSTA not in buffer:
+                        continue
+                    json_texto = buffer.split(SEPARADOR_RESPOSTA, 1)[0]
+                    analise = parsear_json_analise(json_texto.strip())
+                    inicio_texto = enviado = len(json_texto) + len(SEPARADOR_RESPOSTA)
+                    logging.info(f"✅ JSON técnico recebido via streaming ({len(json_texto)} chars)")
+                    emitiu = True
+                    yield "analise", analise
+
+                # Emitir apenas linhas completas (permite filtrar vazamentos por linha)
+                fim_linha = buffer.rfind("\n")
+                if fim_linha >= enviado:
+                    trecho = buffer[enviado:fim_linha + 1]
+                    enviado = fim_linha + 1
+                    trecho = "".join(l for l in trecho.splitlines(True) if not linha_tem_vazamento(l))
+                    if trecho:
+                        yield "texto", trecho
+
+            registrar_sucesso_circuito(modelo_nome)
+
+            resposta_completa = buffer.strip()
+            if not resposta_completa:
+                raise ValueError(f"Resposta vazia ou bloqueada do modelo {modelo_nome}")
+            logging.info(f"✅ Streaming concluído do {modelo_nome} ({len(resposta_completa)} chars)")
+
+            if analise is None:
+                # Sem separador: mesmo fallback (regex) da versão bloqueante
+                analise, texto_simplificado = separar_resposta_gemini(resposta_completa)
+                emitiu = True
+                yield "analise", analise
+                yield "texto", texto_simplificado
+            else:
+                texto_simplificado = buffer[inicio_texto:].strip()
+                restante = buffer[enviado:]
+                if restante and not linha_tem_vazamento(restante):
+                    yield "texto", restante
+
+            analise = finalizar_analise(analise, texto_simplificado, modelo_nome, idx, perspectiva, texto_truncado, info_preparo)
+
+            contabilizar_modelo(modelo_nome, attempts=1, successes=1)
+
+            registrar_tokens_analise(analise, usage, prompt, resposta_completa, tokens_economizados)
+
+            logging.info(f"✅ Análise (streaming) completa com {modelo_nome}: tipo={analise.get('tipo_documento')}, perspectiva={perspectiva}")
+
+            salvar_analise_cache(cache_key, analise, chave_anonima=chave_anonima)
+
+            yield "fim", analise
+            return
+
+        except Exception as e:
+            ultimo_erro = e
+            erro_msg = str(e)
+            erros_por_modelo[modelo_nome] = erro_msg[:200]
+            registrar_erro_circuito(modelo_nome, erro_msg)
+            if emitiu:
+                # Parte da resposta já foi enviada ao cliente: não dá para trocar de modelo
+                contabilizar_modelo(modelo_nome, attempts=1, failures=1)
+                logging.error(f"❌ Streaming interrompido em {modelo_nome} após envio parcial: {erro_msg[:100]}")
+                raise
+            registrar_falha_modelo(modelo_nome, erro_msg, idx, total_modelos)
+            continue
+
+    raise erro_todos_modelos(erros_por_modelo, ultimo_erro)
+
+
+# ============= FUNÇÕES AUXILIARES =============
+
+def extrair_numero_processo_regex(texto):
+    """Extração simples de número de processo com regex"""
+    processo_patterns = [
+        r'\d{7}-\d{2}\.\d{4}\.\d\.\d{2}\.\d{4}',  # CNJ
+        r'Processo\s+n[º°]?\s*([\d\.\-\/]+)'
+    ]
+    for pattern in processo_patterns:
+        match = re.search(pattern, texto, re.IGNORECASE)
+        if match:
+            return match.group()
+    return None
+
+def gerar_perguntas_sugeridas(dados):
+    """Gera perguntas baseadas nos dados extraídos"""
+    perguntas = []
+
+    valores = dados.get("valores", {})
+    if valores.get("total_a_receber") or valores.get("danos_morais") or valores.get("danos_materiais"):
+        perguntas.append("Quanto vou receber?")
+
+    if dados.get("prazos"):
+        perguntas.append("Quais são os prazos importantes?")
+
+    if dados.get("audiencias"):
+        perguntas.append("Quando é a audiência?")
+
+    if dados.get("decisao"):
+        perguntas.append("Eu ganhei ou perdi?")
+
+    return perguntas[:4]
+
+# ============= PROCESSAMENTO DE IMAGENS E PDFs =============
+
+def processar_imagem_para_texto(image_bytes, formato='PNG', prazo=None):
+    """Extrai texto de imagem usando OCR (no serviço de OCR compartilhado, se ativo),
+    dentro do prazo do documento (padrão: OCR_PRAZO_DOCUMENTO a partir de agora)"""
+    if not TESSERACT_AVAILABLE:
+        raise ValueError("OCR não está disponível neste servidor")
+    prazo = prazo or prazo_ocr_documento()
+
+    if ocr_servico.disponivel():
+        try:
+            status, *resultado = ocr_servico.executar_lote("imagem", [(image_bytes, formato, prazo)],
+                                                           prazo_segundos=max(1, prazo - time.time()))[0]
+            if status == "ok":
+                return resultado[0]
+            tipo, mensagem = resultado
+            logging.error(f"Erro ao processar imagem: {mensagem}")
+            if tipo == "TimeoutError":
+                raise ValueError("Tempo limite do OCR excedido. Tente novamente em instantes.")
+            raise ValueError(mensagem) if tipo == "ValueError" else RuntimeError(mensagem)
+        except ocr_servico.PrazoOcrExpirado as e:
+            logging.error(f"⏱️ {e}")
+            raise ValueError("Tempo limite do OCR excedido. Tente novamente em instantes.")
+        except ocr_servico.ServicoOcrIndisponivel as e:
+            logging.warning(f"⚠️ {e} - OCR no próprio worker")
+
+    return processar_imagem_local(image_bytes, formato, prazo)
+
+# ============= OCR PARALELO (PÁGINAS ESCANEADAS) =============
+# Cada página escaneada leva segundos de OCR; em série, uma intimação de 10
+# páginas estoura o timeout de 120s do gunicorn. As páginas são rasterizadas e
+# reconhecidas num pool de processos por worker, e remontadas na ordem original.
+
+OCR_MAX_PROCESSOS = int(os.getenv("OCR_MAX_PROCESSOS", str(min(4, os.cpu_count() or 1))))
+# Workers do gunicorn (gunicorn_config.py exporta; servidor de desenvolvimento = 1)
+GUNICORN_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+OCR_PAGINA_TIMEOUT = 60  # segundos por página (o tesseract já tem timeout de 45s)
+# Páginas híbridas (PJe: cabeçalho em texto + decisão escaneada colada como imagem):
+# só as imagens grandes, sem camada de texto por cima, passam por OCR - recortadas
+# com get_pixmap(clip=...), não a página inteira.
+OCR_PAGINAS_HIBRIDAS = os.getenv("OCR_PAGINAS_HIBRIDAS", "true").lower() == "true"
+OCR_REGIAO_MIN_FRACAO = 0.08  # área mínima da imagem em relação à página
+OCR_REGIAO_MIN_LADO = 50  # pontos (~1,8 cm): descarta ícones, QR codes e assinaturas
+OCR_REGIAO_MAX_CHARS_TEXTO = 20  # mais texto que isso sobre a imagem = PDF já pesquisável
+
+if OCR_MAX_PROCESSOS > 1:
+    # Com várias páginas em paralelo, o OpenMP interno do tesseract só disputa CPU
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+_ocr_pool = None
+_ocr_pool_pid = None
+ocr_pool_lock = threading.Lock()
+
+
+def processos_ocr_locais():
+    """Processos do pool de OCR deste worker. O limite global (OCR_MAX_PROCESSOS
+    no servidor todo) é do serviço compartilhado, que não usa este pool; o pool
+    local só roda sem o serviço (desativado ou fora do ar), e então cada worker
+    tem o seu: os núcleos são divididos entre os workers."""
+    return max(1, min(OCR_MAX_PROCESSOS, (os.cpu_count() or 1) // GUNICORN_WORKERS))
+
+
+def obter_pool_ocr():
+    """Pool de OCR do processo atual. Criado sob demanda: com preload_app o
+    módulo é importado no master, e o pool precisa nascer dentro do worker.
+    Os processos vêm do forkserver (pipeline_ocr.contexto_processos_ocr), não
+    de um fork deste worker, que tem threads (PDF, hedge, map-reduce)."""
+    global _ocr_pool, _ocr_pool_pid
+    with ocr_pool_lock:
+        if _ocr_pool is None or _ocr_pool_pid != os.getpid():
+            processos = processos_ocr_locais()
+            _ocr_pool = ProcessPoolExecutor(max_workers=processos,
+                                            mp_context=contexto_processos_ocr(),
+                                            initializer=iniciar_processo_ocr)
+            _ocr_pool_pid = os.getpid()
+            logging.info(f"🧵 Pool de OCR iniciado com {processos} processos (pid {_ocr_pool_pid})")
+        return _ocr_pool
+
+
+def descartar_pool_ocr():
+    """Descarta o pool (ex.: processo filho morto por falta de memória)."""
+    global _ocr_pool
+    with ocr_pool_lock:
+        if _ocr_pool is not None:
+            _ocr_pool.shutdown(wait=False, cancel_futures=True)
+            _ocr_pool = None
+
+
+def regioes_imagem_para_ocr(page):
+    """
+    Imagens da página grandes o bastante para conter texto e sem camada de texto
+    por cima (layout via get_image_info, sem decodificar as imagens).
+
+    Returns:
+        list: retângulos (x0, y0, x1, y1) em pontos, de cima para baixo
+    """
+    if page.rotation != 0:
+        return []
+    area_pagina = page.rect.width * page.rect.height
+    regioes = []
+    for info in page.get_image_info():
+        rect = fitz.Rect(info["bbox"]) & page.rect
+        if rect.is_empty or rect.width < OCR_REGIAO_MIN_LADO or rect.height < OCR_REGIAO_MIN_LADO:
+            continue
+        if rect.width * rect.height < OCR_REGIAO_MIN_FRACAO * area_pagina:
+            continue
+        if any(fitz.Rect(r).contains(rect) for r in regioes):
+            continue
+        if len(page.get_text("text", clip=rect).strip()) > OCR_REGIAO_MAX_CHARS_TEXTO:
+            continue
+        regioes.append(tuple(rect))
+    return sorted(regioes, key=lambda r: (r[1], r[0]))
+
+
+def ocr_paginas_pdf(pdf_bytes, indices, regioes=None, prazo=None):
+    """
+    OCR das páginas `indices` (base 0), em paralelo quando há mais de uma.
+
+    Args:
+        regioes: opcional, {indice: retângulos} das páginas híbridas (só as imagens)
+        prazo: opcional, timestamp limite do OCR do documento - cada página recebe o
+               que resta; as que não terminarem a tempo são puladas
+
+    Returns:
+        dict: {indice: (texto, preprocessamento)} - páginas que falharam ou foram
+              puladas ficam de fora (erro logado)
+    """
+    resultados = {}
+    if not indices:
+        return resultados
+    regioes = regioes or {}
+    prazo = prazo or prazo_ocr_documento()
+
+    # Serviço compartilhado: paralelismo limitado no servidor todo, não por worker
+    if ocr_servico.disponivel():
+        inicio = time.time()
+        try:
+            respostas = ocr_servico.executar_lote("pagina_pdf", [(pdf_bytes, indice, regioes.get(indice), prazo) for indice in indices],
+                                                  prazo_segundos=max(1, prazo - time.time()))
+            for indice, (status, *resultado) in zip(indices, respostas):
+                if status == "ok":
+                    resultados[indice] = resultado[0]
+                else:
+                    logging.error(f"Erro ao processar página {indice+1}: {resultado[1]}")
+            logging.info(f"⚡ OCR via serviço: {len(indices)} páginas em {time.time() - inicio:.1f}s")
+            return resultados
+        except ocr_servico.PrazoOcrExpirado as e:
+            # Prazo do documento esgotado: as páginas ficam puladas, sem refazer no worker
+            logging.warning(f"⏱️ {e} - {len(indices)} página(s) pulada(s)")
+            return resultados
+        except ocr_servico.ServicoOcrIndisponivel as e:
+            logging.warning(f"⚠️ {e} - OCR no próprio worker")
+
+    pendentes = list(indices)
+    processos = processos_ocr_locais()
+    if len(indices) > 1 and processos > 1:
+        inicio = time.time()
+        try:
+            pool = obter_pool_ocr()
+            futures = {indice: pool.submit(ocr_pagina_pdf, pdf_bytes, indice, regioes.get(indice), prazo) for indice in indices}
+            for indice, future in futures.items():
+                try:
+                    resultados[indice] = future.result(timeout=max(0, min(OCR_PAGINA_TIMEOUT, prazo - time.time())))
+                except BrokenProcessPool:
+                    raise
+                except FuturesTimeout:
+                    # Ainda na fila: não começa mais; em execução: o tesseract para no próprio timeout
+                    future.cancel()
+                    logging.warning(f"⏱️ Página {indice+1} pulada: prazo de OCR do documento esgotado")
+                except Exception as e:
+                    logging.error(f"Erro ao processar página {indice+1}: {e}")
+            pendentes = []
+            logging.info(f"⚡ OCR paralelo: {len(indices)} páginas em {time.time() - inicio:.1f}s ({processos} processos)")
+        except BrokenProcessPool as e:
+            logging.error(f"❌ Pool de OCR quebrado ({e}) - continuando em série")
+            descartar_pool_ocr()
+            pendentes = [i for i in indices if i not in resultados]
+
+    for n, indice in enumerate(pendentes):
+        if time.time() >= prazo - 1:
+            logging.warning(f"⏱️ Prazo de OCR do documento esgotado - {len(pendentes) - n} página(s) pulada(s)")
+            break
+        try:
+            logging.info(f"Aplicando OCR na página {indice+1}")
+            resultados[indice] = ocr_pagina_pdf(pdf_bytes, indice, regioes.get(indice), prazo)
+        except Exception as e:
+            logging.error(f"Erro ao processar página {indice+1}: {e}")
+
+    return resultados
+
+
+# Tarefas que o serviço de OCR (ocr_servico.py, iniciado no master do gunicorn) executa
+ocr_servico.registrar_tarefa("imagem", processar_imagem_local)
+ocr_servico.registrar_tarefa("pagina_pdf", ocr_pagina_pdf)
+
+
+# Remoção de boilerplate de PDFs (PJe/eproc repetem cabeçalho do tribunal,
+# rodapé de assinatura, URL de verificação e hash em todas as páginas)
+REMOVER_BOILERPLATE_PDF = os.getenv("REMOVER_BOILERPLATE_PDF", "true").lower() == "true"
+BOILERPLATE_MARGEM = 0.12  # faixa superior/inferior da página tratada como cabeçalho/rodapé
+BOILERPLATE_MIN_PAGINAS = 3  # repetições mínimas para um bloco ser considerado boilerplate
+
+# Ruído de assinatura/certificação: removido quando repetido, mesmo fora das margens
+# (o PJe imprime a tarja de assinatura na lateral da página)
+PADROES_RUIDO_PDF = [
+    r'assinado\s+eletronicamente',
+    r'documento\s+assinado\s+digitalmente',
+    r'https?://\S+',
+    r'(?:c[óo]digo|chave)\s+de\s+(?:verifica[çc][ãa]o|acesso)',
+    r'n[úu]mero\s+do\s+documento',
+    r'\bnum\.\s*\d+\s*-\s*p[áa]g\.?\s*\d+',
+    r'\bICP-?Brasil\b',
+    r'\b[0-9a-f]{32,}\b',
+]
+
+
+def chave_bloco_boilerplate(texto):
+    """Normaliza um bloco para comparação entre páginas (números de página,
+    datas e IDs variam a cada página, então dígitos viram '#')."""
+    return re.sub(r'\s+', ' ', re.sub(r'\d+', '#', texto)).strip().lower()
+
+
+def bloco_eh_ruido(texto):
+    return any(re.search(padrao, texto, re.IGNORECASE) for padrao in PADROES_RUIDO_PDF)
+
+
+def remover_boilerplate_paginas(paginas):
+    """
+    Remove cabeçalhos/rodapés repetidos e ruído de assinatura das páginas com texto.
+
+    Um bloco sai quando a chave normalizada aparece em BOILERPLATE_MIN_PAGINAS
+    páginas (2 em documentos curtos) e ele está na margem superior/inferior ou
+    é ruído de assinatura/certificação. A primeira ocorrência é mantida: o
+    cabeçalho da 1ª página identifica tribunal e processo para a análise.
+
+    Args:
+        paginas: lista, por página, de listas de blocos (texto, na_margem);
+                 páginas de OCR entram como None e não são alteradas
+
+    Returns:
+        tuple: (textos por página, blocos_removidos, caracteres_removidos)
+    """
+    paginas_texto = [p for p in paginas if p]
+    min_repeticoes = BOILERPLATE_MIN_PAGINAS if len(paginas_texto) >= BOILERPLATE_MIN_PAGINAS else 2
+
+    frequencia = {}
+    for blocos in paginas_texto:
+        for chave in {chave_bloco_boilerplate(texto) for texto, _ in blocos}:
+            frequencia[chave] = frequencia.get(chave, 0) + 1
+
+    vistos = set()
+    removidos = 0
+    chars_removidos = 0
+    resultado = []
+    for blocos in paginas:
+        if blocos is None:
+            resultado.append(None)
+            continue
+        partes = []
+        for texto, na_margem in blocos:
+            chave = chave_bloco_boilerplate(texto)
+            repetido = chave and frequencia.get(chave, 0) >= min_repeticoes
+            if repetido and (na_margem or bloco_eh_ruido(texto)):
+                if chave in vistos:
+                    removidos += 1
+                    chars_removidos += len(texto)
+                    continue
+                vistos.add(chave)
+            partes.append(texto)
+        resultado.append("".join(partes))
+    return resultado, removidos, chars_removidos
+
+
+def extrair_texto_pdf(pdf_bytes, prazo=None):
+    """Extrai texto de PDF. O OCR (páginas escaneadas e imagens de páginas híbridas)
+    respeita o prazo do documento: páginas sem tempo vão para metadados["paginas_puladas"]"""
+    texto = ""
+    prazo = prazo or prazo_ocr_documento()
     metadados = {
         "total_paginas": 0,
         "tem_texto": False,
         "usou_ocr": False,
         "paginas_com_ocr": [],
-        "tipo": "pdf"
+        "paginas_puladas": [],
+        "tipo": "pdf",
+        "boilerplate_removido": {"blocos": 0, "caracteres": 0, "tokens_estimados": 0}
     }
 
     try:
@@ -1948,28 +2947,97 @@ def extrair_texto_pdf(pdf_bytes):
             logging.info(f"Processando PDF com {total_pages} páginas")
 
             # Usar lista para melhor performance em memória (evita concatenação repetida)
+            # Páginas de OCR entram como None e são preenchidas depois, em paralelo
             partes_texto = []
+            # Blocos (texto, na_margem) das páginas com texto; None nas de OCR
+            blocos_paginas = []
+            paginas_ocr = []
+            # Páginas híbridas: {indice: (retângulos das imagens, posição do OCR entre os blocos,
+            # posição da página em partes_texto)}
+            hibridas = {}
 
             for i, page in enumerate(doc):
                 try:
-                    conteudo = page.get_text()
-
-                    if conteudo.strip():
+                    altura = page.rect.height
+                    blocos_texto = [b for b in page.get_text("blocks") if b[6] == 0 and b[4].strip()]
+                    blocos = [
+                        (b[4] if b[4].endswith("\n") else b[4] + "\n",
+                         b[3] <= altura * BOILERPLATE_MARGEM or b[1] >= altura * (1 - BOILERPLATE_MARGEM))
+                        for b in blocos_texto
+                    ]
+
+                    if blocos:
                         metadados["tem_texto"] = True
-                        partes_texto.append(conteudo)
+                        partes_texto.append("".join(texto for texto, _ in blocos))
+                        blocos_paginas.append(blocos)
+                        regioes = regioes_imagem_para_ocr(page) if OCR_PAGINAS_HIBRIDAS and TESSERACT_AVAILABLE else []
+                        if regioes:
+                            # O texto das imagens entra antes do primeiro bloco abaixo da imagem mais alta
+                            posicao = sum(1 for b in blocos_texto if b[1] < regioes[0][1])
+                            hibridas[i] = (regioes, posicao, len(partes_texto) - 1)
                     elif TESSERACT_AVAILABLE:
-                        logging.info(f"Aplicando OCR na página {i+1}")
-                        metadados["usou_ocr"] = True
-                        metadados["paginas_com_ocr"].append(i+1)
-
-                        pix = page.get_pixmap(dpi=300)
-                        img_data = pix.tobytes()
-                        conteudo_ocr, _ = processar_imagem_para_texto(img_data, 'PNG')
-                        partes_texto.append(conteudo_ocr)
+                        paginas_ocr.append(i)
+                        partes_texto.append(None)
+                        blocos_paginas.append(None)
 
                 except Exception as e:
                     logging.error(f"Erro ao processar página {i+1}: {e}")
 
+            if hibridas:
+                resultados_hibridas = ocr_paginas_pdf(pdf_bytes, list(hibridas), {i: r for i, (r, _, _) in hibridas.items()}, prazo)
+                metadados["paginas_puladas"].extend(i + 1 for i in hibridas if i not in resultados_hibridas)
+                metadados["paginas_hibridas"] = []
+                for i, (texto_ocr, preprocessamento) in sorted(resultados_hibridas.items()):
+                    if not texto_ocr.strip():
+                        continue
+                    _, posicao, j = hibridas[i]
+                    blocos = blocos_paginas[j]
+                    blocos.insert(posicao, (texto_ocr if texto_ocr.endswith("\n") else texto_ocr + "\n", False))
+                    partes_texto[j] = "".join(texto for texto, _ in blocos)
+                    metadados["paginas_hibridas"].append(i + 1)
+                    metadados.setdefault("ocr_preprocessamento", []).append({"pagina": i + 1, **(preprocessamento or {})})
+                if metadados["paginas_hibridas"]:
+                    metadados["usou_ocr"] = True
+                    logging.info(f"🧩 Páginas híbridas: OCR das imagens nas páginas {metadados['paginas_hibridas']}")
+
+            if paginas_ocr:
+                metadados["usou_ocr"] = True
+                resultados_ocr = ocr_paginas_pdf(pdf_bytes, paginas_ocr, prazo=prazo)
+                metadados["paginas_com_ocr"] = [i + 1 for i in paginas_ocr if i in resultados_ocr]
+                metadados["paginas_puladas"].extend(i + 1 for i in paginas_ocr if i not in resultados_ocr)
+                metadados.setdefault("ocr_preprocessamento", []).extend(
+                    {"pagina": i + 1, **(resultados_ocr[i][1] or {})} for i in paginas_ocr if i in resultados_ocr
+                )
+                textos_ocr = {i: texto for i, (texto, _) in resultados_ocr.items()}
+                # Encaixar o OCR na ordem das páginas; as que falharam saem (junto com o
+                # placeholder em blocos_paginas, para manter o alinhamento)
+                fila_ocr = iter(paginas_ocr)
+                paginas = []
+                for parte, blocos in zip(partes_texto, blocos_paginas):
+                    if parte is None:
+                        parte = textos_ocr.get(next(fila_ocr))
+                        if parte is None:
+                            continue
+                    paginas.append((parte, blocos))
+                partes_texto = [parte for parte, _ in paginas]
+                blocos_paginas = [blocos for _, blocos in paginas]
+
+            if REMOVER_BOILERPLATE_PDF and len([b for b in blocos_paginas if b]) >= 2:
+                textos_limpos, blocos_removidos, chars_removidos = remover_boilerplate_paginas(blocos_paginas)
+                if blocos_removidos:
+                    partes_texto = [limpo if limpo is not None else original
+                                    for limpo, original in zip(textos_limpos, partes_texto)]
+                    metadados["boilerplate_removido"] = {
+                        "blocos": blocos_removidos,
+                        "caracteres": chars_removidos,
+                        "tokens_estimados": chars_removidos // 4
+                    }
+                    logging.info(f"✂️ Boilerplate removido: {blocos_removidos} blocos repetidos, {chars_removidos:,} chars (≈{chars_removidos // 4:,} tokens)")
+
+            if metadados["paginas_puladas"]:
+                metadados["paginas_puladas"].sort()
+                logging.warning(f"⚠️ OCR parcial: páginas {metadados['paginas_puladas']} sem texto reconhecido")
+
             # Join é muito mais eficiente que concatenação repetida
             texto = "\n".join(partes_texto).strip()
             texto = pos_processar_texto_ocr(texto)
@@ -1984,20 +3052,164 @@ def extrair_texto_pdf(pdf_bytes):
 
 # ============= GERAÇÃO DE PDF =============
 
-def gerar_pdf_simplificado(texto, metadados=None, filename="documento_simplificado.pdf"):
-    """Gera PDF com formatação aprimorada usando o novo gerador"""
+# O PDF é gerado em memória e guardado no cache compartilhado (RAM, criptografado,
+# visível pelos dois workers): o /download_pdf serve dali, sem gravar e reler o
+# TEMP_DIR. Sem cache (ou PDF acima do orçamento), o arquivo vai para o disco.
+# Exige chave do cache comum aos workers (RESULT_CACHE_KEY ou SECRET_KEY): com
+# chave por worker, o download que cai no outro worker não decifraria o PDF.
+PDF_CACHE_ENABLED = (os.getenv("PDF_CACHE_ENABLED", "true").lower() == "true"
+                     and cache_compartilhado.CHAVE_COMPARTILHADA)
+if os.getenv("PDF_CACHE_ENABLED", "true").lower() == "true" and not PDF_CACHE_ENABLED:
+    logging.warning("⚠️ PDF_CACHE_ENABLED ignorado: defina RESULT_CACHE_KEY ou SECRET_KEY - PDFs vão para o disco")
+
+# Geração adiada: a maioria lê o resultado na tela e nunca baixa o PDF. O
+# /processar só agenda o PDF numa thread do worker e guarda o pedido (texto +
+# metadados) no cache compartilhado; o /download_pdf espera o PDF em andamento
+# ou, se cair no outro worker, gera na hora a partir do pedido guardado.
+PDF_EM_SEGUNDO_PLANO = os.getenv("PDF_EM_SEGUNDO_PLANO", "true").lower() == "true"
+PDF_ESPERA_DOWNLOAD = int(os.getenv("PDF_ESPERA_DOWNLOAD", "30"))  # segundos
+pdf_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf")
+_pdfs_em_andamento = {}  # nome do arquivo -> Future (deste worker)
+pdfs_lock = threading.Lock()
+
+
+def chave_cache_pdf(basename):
+    """Chave pelo nome do arquivo - o que o link de download e a autorização da sessão carregam"""
+    return "pdf:" + hashlib.sha256(basename.encode('utf-8')).hexdigest()
+
+
+def gerar_pdf_simplificado(texto, metadados=None, filename="documento_simplificado.pdf", session_id=None,
+                           geracao=None):
+    """
+    Gera PDF com formatação aprimorada usando o novo gerador
+
+    Args:
+        session_id: dono do arquivo temporário (padrão: sessão da requisição atual)
+        geracao: token do agendamento (agendar_pdf) - se outro pedido com o mesmo
+            nome de arquivo o substituiu, o PDF gerado é descartado
+
+    Returns:
+        str: caminho do PDF em TEMP_DIR (o arquivo só existe se o PDF não foi para o cache)
+    """
     output_path = os.path.join(TEMP_DIR, filename)
 
     try:
-        # Usar o novo gerador de PDF melhorado
-        gerar_pdf_melhorado(texto, metadados, output_path)
-        registrar_arquivo_temporario(output_path, session_id=session.get('session_id'))
+        if PDF_CACHE_ENABLED and cache_compartilhado.CACHE_DISPONIVEL:
+            buffer = io.BytesIO()
+            gerar_pdf_melhorado(texto, metadados, buffer)
+            if geracao is not None and not pdf_ainda_atual(filename, geracao):
+                logging.info(f"📄 PDF descartado - substituído por um reenvio: {filename}")
+                return output_path
+            if cache_compartilhado.salvar_pdf(chave_cache_pdf(filename), buffer.getvalue()):
+                return output_path
+            # Não coube: versão anterior com o mesmo nome não pode sombrear a do disco
+            cache_compartilhado.remover_pdf(chave_cache_pdf(filename))
+            with open(output_path, 'wb') as f:
+                f.write(buffer.getvalue())
+        else:
+            gerar_pdf_melhorado(texto, metadados, output_path)
+        if session_id is None and has_request_context():
+            session_id = session.get('session_id')
+        registrar_arquivo_temporario(output_path, session_id=session_id)
         return output_path
 
     except Exception as e:
         logging.error(f"❌ Erro ao gerar PDF: {e}")
         raise
 
+
+def pdf_ainda_atual(filename, geracao):
+    """O pedido guardado para este nome de arquivo ainda é o do agendamento `geracao`?"""
+    pedido = cache_compartilhado.obter_pdf_pendente(chave_cache_pdf(filename))
+    return pedido is None or pedido.get("geracao") == geracao
+
+
+def _pdf_concluido(filename, future):
+    with pdfs_lock:
+        if _pdfs_em_andamento.get(filename) is future:
+            del _pdfs_em_andamento[filename]
+    # Erro já registrado em gerar_pdf_simplificado; o download tenta de novo pelo pedido
+
+
+def agendar_pdf(texto, metadados, filename):
+    """
+    Agenda a geração do PDF fora do caminho da resposta. Sem o cache
+    compartilhado com chave comum aos workers (PDF_CACHE_ENABLED) o outro
+    worker não leria o PDF nem o pedido guardado: gera na hora, como antes.
+
+    Returns:
+        str: caminho do PDF em TEMP_DIR (mesmo contrato de gerar_pdf_simplificado)
+    """
+    if not (PDF_EM_SEGUNDO_PLANO and PDF_CACHE_ENABLED and cache_compartilhado.CACHE_DISPONIVEL):
+        return gerar_pdf_simplificado(texto, metadados, filename)
+
+    output_path = os.path.join(TEMP_DIR, filename)
+    chave = chave_cache_pdf(filename)
+    session_id = session.get('session_id')
+    # Reenvio do mesmo arquivo (ex.: outra perspectiva) usa o mesmo nome: o token
+    # impede que um PDF anterior ainda em geração (aqui ou no outro worker)
+    # sobrescreva este
+    geracao = os.urandom(8).hex()
+
+    # Versão anterior com o mesmo nome não pode ser servida no lugar desta
+    cache_compartilhado.salvar_pdf_pendente(chave, {"texto": texto, "metadados": metadados,
+                                                    "session_id": session_id, "geracao": geracao})
+    cache_compartilhado.remover_pdf(chave)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    with pdfs_lock:
+        anterior = _pdfs_em_andamento.get(filename)
+        if anterior is not None:
+            anterior.cancel()  # só tem efeito se ainda não começou; senão é descartado pelo token
+        future = pdf_executor.submit(gerar_pdf_simplificado, texto, metadados, filename, session_id, geracao)
+        _pdfs_em_andamento[filename] = future
+    future.add_done_callback(lambda f: _pdf_concluido(filename, f))
+    return output_path
+
+
+def obter_pdf_gerado(basename):
+    """
+    Bytes do PDF no cache compartilhado: espera a geração em andamento neste
+    worker ou, sem ela, gera agora a partir do pedido guardado.
+
+    Returns:
+        bytes ou None (PDF em disco, pedido expirado ou falha na geração)
+    """
+    if not PDF_CACHE_ENABLED:
+        return None
+    chave = chave_cache_pdf(basename)
+    dados = cache_compartilhado.obter_pdf(chave)
+    if dados is not None:
+        return dados
+
+    with pdfs_lock:
+        future = _pdfs_em_andamento.get(basename)
+    if future is not None:
+        try:
+            future.result(timeout=PDF_ESPERA_DOWNLOAD)
+        except FuturesTimeout:
+            logging.warning(f"⚠️ PDF ainda em geração após {PDF_ESPERA_DOWNLOAD}s: {basename}")
+            return None
+        except Exception:
+            pass
+        dados = cache_compartilhado.obter_pdf(chave)
+        if dados is not None:
+            return dados
+
+    if os.path.exists(os.path.join(TEMP_DIR, basename)):
+        return None
+    pedido = cache_compartilhado.obter_pdf_pendente(chave)
+    if pedido is None:
+        return None
+    logging.info(f"📄 PDF gerado sob demanda no download: {basename}")
+    try:
+        gerar_pdf_simplificado(pedido["texto"], pedido["metadados"], basename, pedido.get("session_id"),
+                               pedido.get("geracao"))
+    except Exception:
+        return None
+    return cache_compartilhado.obter_pdf(chave)
+
 # ============= ROTAS =============
 
 @app.route("/")
@@ -2055,6 +3267,35 @@ def validar_cpf_endpoint():
         return jsonify({"erro": "Erro interno ao validar CPF", "valido": False}), 500
 
 
+# Marcadores de documento judicial: (regex, peso, descrição, só no cabeçalho?)
+# Usados na pré-validação (contra-indicadores de peça advocatícia) e na
+# pontuação de seções relevantes de documentos longos.
+MARCADORES_JUDICIAIS = [
+    # SENTENÇA no título/cabeçalho (peso 5 - supera qualquer indicador advocatício)
+    (r'\bSENTEN[ÇC]A\b', 5, "Palavra 'SENTENÇA' no cabeçalho", True),
+    # ACÓRDÃO no título/cabeçalho
+    (r'\bAC[OÓ]RD[AÃ]O\b', 5, "Palavra 'ACÓRDÃO' no cabeçalho", True),
+    # Expressões decisórias típicas de juiz (JULGO PROCEDENTE/IMPROCEDENTE)
+    (r'\bJULGO\s+(?:PARCIALMENTE\s+)?(?:PROCEDENTE|IMPROCEDENTE)', 5, "Expressão decisória 'JULGO PROCEDENTE/IMPROCEDENTE'", False),
+    # VISTOS, etc. (abertura clássica de sentença)
+    (r'\bVISTOS[\s,]+(?:ETC|EXAMINADOS|RELATADOS)', 4, "Abertura judicial 'Vistos, etc.'", False),
+    # VISTOS, RELATADOS E DISCUTIDOS (abertura de acórdão)
+    (r'VISTOS[\s,]+RELATADOS\s+E\s+DISCUTIDOS', 5, "Abertura de acórdão 'Vistos, relatados e discutidos'", False),
+    # DISPOSITIVO / ANTE O EXPOSTO / DIANTE DO EXPOSTO (seção decisória)
+    (r'\b(?:ANTE|DIANTE|FACE)\s+(?:O|DO|AO)\s+EXPOSTO', 4, "Expressão decisória 'Ante/Diante o exposto'", False),
+    # DETERMINO / DEFIRO / INDEFIRO (verbos de comando judicial)
+    (r'\b(?:DETERMINO|DEFIRO|INDEFIRO|HOMOLOGO|CONDENO|ABSOLVO)\b', 3, "Verbo de comando judicial", False),
+    # P.R.I. ou P.R.I.C. (Publique-se, Registre-se, Intime-se - encerramento de sentença)
+    (r'\bP\s*\.?\s*R\s*\.?\s*I\s*\.?\s*(?:C\s*\.?)?\b', 3, "Encerramento judicial 'P.R.I.'", False),
+    # Assinatura de juiz(a) ou desembargador(a)
+    (r'(?:JU[IÍ]Z(?:A)?|DESEMBARGADOR(?:A)?|MINISTRO(?:A)?)\s+(?:DE\s+DIREITO|FEDERAL|RELATOR(?:A)?)', 3, "Assinatura de autoridade judicial", False),
+    # Cabeçalho de tribunal (TJXX, TRT, TRF, STJ, STF)
+    (r'\b(?:TRIBUNAL\s+DE\s+JUSTI[ÇC]A|TJ[A-Z]{2}|TRT|TRF|STJ|STF|PODER\s+JUDICI[AÁ]RIO)\b', 4, "Cabeçalho de tribunal/poder judiciário", True),
+    # CUMPRA-SE (ordem judicial)
+    (r'\bCUMPRA[\s-]*SE\b', 2, "Ordem judicial 'Cumpra-se'", False),
+]
+
+
 def detectar_documento_advocaticio(texto):
     """Pré-validação textual para detectar documentos advocatícios (petições, reclamações trabalhistas, etc.)
     antes de enviar ao Gemini. Funciona como rede de segurança para evitar processar documentos não-judiciais.
@@ -2072,60 +3313,10 @@ def detectar_documento_advocaticio(texto):
 
     cabecalho = texto_upper[:3000]
 
-    # SENTENÇA no título/cabeçalho (peso 5 - supera qualquer indicador advocatício)
-    if re.search(r'\bSENTEN[ÇC]A\b', cabecalho):
-        contra_indicadores_judiciais.append("Palavra 'SENTENÇA' no cabeçalho")
-        peso_judicial += 5
-
-    # ACÓRDÃO no título/cabeçalho
-    if re.search(r'\bAC[OÓ]RD[AÃ]O\b', cabecalho):
-        contra_indicadores_judiciais.append("Palavra 'ACÓRDÃO' no cabeçalho")
-        peso_judicial += 5
-
-    # Expressões decisórias típicas de juiz (JULGO PROCEDENTE/IMPROCEDENTE)
-    if re.search(r'\bJULGO\s+(?:PARCIALMENTE\s+)?(?:PROCEDENTE|IMPROCEDENTE)', texto_upper):
-        contra_indicadores_judiciais.append("Expressão decisória 'JULGO PROCEDENTE/IMPROCEDENTE'")
-        peso_judicial += 5
-
-    # VISTOS, etc. (abertura clássica de sentença)
-    if re.search(r'\bVISTOS[\s,]+(?:ETC|EXAMINADOS|RELATADOS)', texto_upper):
-        contra_indicadores_judiciais.append("Abertura judicial 'Vistos, etc.'")
-        peso_judicial += 4
-
-    # VISTOS, RELATADOS E DISCUTIDOS (abertura de acórdão)
-    if re.search(r'VISTOS[\s,]+RELATADOS\s+E\s+DISCUTIDOS', texto_upper):
-        contra_indicadores_judiciais.append("Abertura de acórdão 'Vistos, relatados e discutidos'")
-        peso_judicial += 5
-
-    # DISPOSITIVO / ANTE O EXPOSTO / DIANTE DO EXPOSTO (seção decisória)
-    if re.search(r'\b(?:ANTE|DIANTE|FACE)\s+(?:O|DO|AO)\s+EXPOSTO', texto_upper):
-        contra_indicadores_judiciais.append("Expressão decisória 'Ante/Diante o exposto'")
-        peso_judicial += 4
-
-    # DETERMINO / DEFIRO / INDEFIRO (verbos de comando judicial)
-    if re.search(r'\b(?:DETERMINO|DEFIRO|INDEFIRO|HOMOLOGO|CONDENO|ABSOLVO)\b', texto_upper):
-        contra_indicadores_judiciais.append("Verbo de comando judicial")
-        peso_judicial += 3
-
-    # P.R.I. ou P.R.I.C. (Publique-se, Registre-se, Intime-se - encerramento de sentença)
-    if re.search(r'\bP\s*\.?\s*R\s*\.?\s*I\s*\.?\s*(?:C\s*\.?)?\b', texto_upper):
-        contra_indicadores_judiciais.append("Encerramento judicial 'P.R.I.'")
-        peso_judicial += 3
-
-    # Assinatura de juiz(a) ou desembargador(a)
-    if re.search(r'(?:JU[IÍ]Z(?:A)?|DESEMBARGADOR(?:A)?|MINISTRO(?:A)?)\s+(?:DE\s+DIREITO|FEDERAL|RELATOR(?:A)?)', texto_upper):
-        contra_indicadores_judiciais.append("Assinatura de autoridade judicial")
-        peso_judicial += 3
-
-    # Cabeçalho de tribunal (TJXX, TRT, TRF, STJ, STF)
-    if re.search(r'\b(?:TRIBUNAL\s+DE\s+JUSTI[ÇC]A|TJ[A-Z]{2}|TRT|TRF|STJ|STF|PODER\s+JUDICI[AÁ]RIO)\b', cabecalho):
-        contra_indicadores_judiciais.append("Cabeçalho de tribunal/poder judiciário")
-        peso_judicial += 4
-
-    # CUMPRA-SE (ordem judicial)
-    if re.search(r'\bCUMPRA[\s-]*SE\b', texto_upper):
-        contra_indicadores_judiciais.append("Ordem judicial 'Cumpra-se'")
-        peso_judicial += 2
+    for padrao, peso, descricao, somente_cabecalho in MARCADORES_JUDICIAIS:
+        if re.search(padrao, cabecalho if somente_cabecalho else texto_upper):
+            contra_indicadores_judiciais.append(descricao)
+            peso_judicial += peso
 
     # Se há contra-indicadores judiciais fortes, o documento é judicial - não bloquear
     if peso_judicial >= 4:
@@ -2216,6 +3407,38 @@ def detectar_documento_advocaticio(texto):
     return {"detectado": False, "razao": None, "indicadores": indicadores, "peso": peso_total}
 
 
+# ============= CACHE DE EXTRAÇÃO =============
+# Reenvio do mesmo arquivo (ex.: trocar a perspectiva autor/réu) reaproveita
+# texto extraído, metadados e pré-validação: só a chamada ao Gemini é refeita.
+# Chave = file_hash + extensão + configuração da extração; conteúdo criptografado
+# no cache compartilhado (tabela cache_extracao, TTL curto).
+EXTRACAO_CACHE_ENABLED = os.getenv("EXTRACAO_CACHE_ENABLED", "true").lower() == "true"
+
+def chave_cache_extracao(file_hash, extensao):
+    configuracao = f"{extensao}|boilerplate={REMOVER_BOILERPLATE_PDF}|{configuracao_ocr()}"
+    return "extracao:" + hashlib.sha256(f"{file_hash}|{configuracao}".encode()).hexdigest()
+
+def buscar_extracao_cache(file_hash, extensao):
+    """(texto_original, metadados_arquivo, pre_validacao) do cache ou None"""
+    if not EXTRACAO_CACHE_ENABLED:
+        return None
+    resultado = cache_compartilhado.obter_extracao(chave_cache_extracao(file_hash, extensao))
+    if resultado is None:
+        return None
+    logging.info(f"♻️ Extração reaproveitada do cache ({len(resultado['texto_original'])} caracteres)")
+    resultado["metadados_arquivo"]["cache_extracao"] = True
+    return resultado["texto_original"], resultado["metadados_arquivo"], resultado["pre_validacao"]
+
+def salvar_extracao_cache(file_hash, extensao, texto_original, metadados_arquivo, pre_validacao):
+    # OCR parcial (prazo esgotado) não vai para o cache: o reenvio tenta as páginas de novo
+    if EXTRACAO_CACHE_ENABLED and not metadados_arquivo.get("paginas_puladas"):
+        cache_compartilhado.salvar_extracao(chave_cache_extracao(file_hash, extensao), {
+            "texto_original": texto_original,
+            "metadados_arquivo": metadados_arquivo,
+            "pre_validacao": pre_validacao
+        })
+
+
 @app.route("/processar", methods=["POST"])
 @rate_limit
 @require_csrf
@@ -2227,235 +3450,112 @@ def processar():
         session.permanent = True
         session.modified = True
 
-        # 🔐 VERIFICAR LIMITE DE TOKENS
-        token_check = verificar_limite_tokens_request()
-        if token_check:
-            return token_check
-
-        # 🔐 VERIFICAR CPF
-        cpf_limpo, cpf_error = verificar_cpf_request()
-        if cpf_error:
-            return cpf_error
-
-        if 'file' not in request.files:
-            return jsonify({"erro": "Nenhum arquivo enviado"}), 400
-
-        file = request.files['file']
-        perspectiva = request.form.get('perspectiva', 'nao_informado')
-
-        # Validar perspectiva contra whitelist (anti prompt injection)
-        PERSPECTIVAS_VALIDAS = {'autor', 'reu', 'nao_informado'}
-        if perspectiva not in PERSPECTIVAS_VALIDAS:
-            perspectiva = 'nao_informado'
-
-        logging.info(f"📍 Perspectiva capturada: {perspectiva}")
-
-        if file.filename == '':
-            return jsonify({"erro": "Nenhum arquivo selecionado"}), 400
-
-        if not allowed_file(file.filename):
-            return jsonify({"erro": "Formato inválido"}), 400
-
-        file.seek(0, os.SEEK_END)
-        size = file.tell()
-        file.seek(0)
-
-        if size > MAX_FILE_SIZE:
-            return jsonify({"erro": "Arquivo muito grande"}), 400
-
-        file_bytes = file.read()
-        file_extension = file.filename.rsplit('.', 1)[1].lower()
-        file_hash = hashlib.sha256(file_bytes).hexdigest()
-
-        # Validar MIME real via magic bytes — extensão sozinha é insuficiente
-        if not validar_mime_arquivo(file_bytes, file_extension):
-            logging.warning(f"🚫 Arquivo rejeitado: extensão .{file_extension} não bate com o conteúdo real")
-            return jsonify({"erro": "O conteúdo do arquivo não corresponde à extensão informada."}), 400
-
-        logging.info(f"📄 Processando: {secure_filename(file.filename)} ({size/1024:.1f}KB)")
-
-        # Extrair texto
-        try:
-            if file_extension == 'pdf':
-                logging.info("📄 Extraindo texto de PDF...")
-                texto_original, metadados_arquivo = extrair_texto_pdf(file_bytes)
-                logging.info(f"✅ Texto extraído do PDF: {len(texto_original)} caracteres")
-            elif file_extension in ALLOWED_IMAGE_EXTENSIONS:
-                logging.info("🖼️ Extraindo texto de imagem com OCR...")
-                texto_original, metadados_arquivo = processar_imagem_para_texto(file_bytes, file_extension.upper())
-                logging.info(f"✅ Texto extraído da imagem: {len(texto_original)} caracteres")
-            else:
-                return jsonify({"erro": "Tipo não suportado"}), 400
-        except Exception as e:
-            logging.error(f"❌ Erro ao extrair texto do arquivo: {e}", exc_info=DEBUG_MODE)
-            return jsonify({"erro": "Erro ao extrair texto do documento. Verifique se o arquivo não está corrompido."}), 500
-
-        if len(texto_original) < 10:
-            logging.warning(f"⚠️ Texto muito curto: {len(texto_original)} caracteres")
-            return jsonify({"erro": "Texto insuficiente no documento"}), 400
-
-        # 🚫 PRÉ-VALIDAÇÃO: Detectar documentos advocatícios antes de enviar ao Gemini
-        pre_validacao = detectar_documento_advocaticio(texto_original)
-        if pre_validacao["detectado"]:
-            logging.warning(f"🚫 PRÉ-VALIDAÇÃO: Documento advocatício detectado - {pre_validacao['razao']}")
-            return jsonify({
-                "documento_nao_judicial": True,
-                "texto": "",
-                "tipo_documento": "advocaticio",
-                "confianca_tipo": "ALTA",
-                "razao_tipo": pre_validacao["razao"],
-                "urgencia": None,
-                "acao_necessaria": None,
-                "dados_extraidos": {
-                    "numero_processo": None,
-                    "tipo_documento": "advocaticio",
-                    "partes": {},
-                    "autoridade": {},
-                    "valores": {},
-                    "prazos": [],
-                    "decisao": None,
-                    "audiencias": [],
-                    "links_audiencia": []
-                },
-                "recursos_cabiveis": {"cabe_recurso": None, "prazo": None},
-                "perguntas_sugeridas": [],
-                "tem_justica_gratuita": None,
-                "caracteres_original": len(texto_original),
-                "caracteres_simplificado": 0,
-                "modelo_usado": "pre-validacao",
-                "perspectiva_aplicada": perspectiva,
-                "segredo_justica": {"detectado": False, "motivo": None, "hipotese_legal": None},
-                "pdf_download_url": None
-            })
+        documento, cpf_limpo, resposta_erro = preparar_documento_upload()
+        if resposta_erro:
+            return resposta_erro
+        texto_original = documento["texto_original"]
+        perspectiva = documento["perspectiva"]
+        session_id = obter_session_id()
 
         # 🎯 ANÁLISE COMPLETA COM GEMINI (COM PERSPECTIVA CORRIGIDA)
         logging.info(f"🤖 Iniciando análise completa com Gemini (perspectiva: {perspectiva})...")
         logging.info(f"📝 Texto extraído: {len(texto_original)} caracteres")
 
         try:
-            analise_completa = analisar_documento_completo_gemini(texto_original, perspectiva, session_id=obter_session_id())
+            analise_completa = analisar_documento_completo_gemini(texto_original, perspectiva, session_id=session_id, tokens_economizados=documento["tokens_economizados"])
         except Exception as e:
             logging.error(f"❌ ERRO CRÍTICO na análise Gemini: {e}", exc_info=DEBUG_MODE)
-            erro_msg = str(e)
-            # Mensagem amigável para erros de quota
-            if "quota" in erro_msg.lower() or "429" in erro_msg or "limite" in erro_msg.lower():
-                return jsonify({
-                    "erro": "O serviço de IA está temporariamente indisponível devido ao limite de uso. "
-                            "Por favor, aguarde alguns minutos e tente novamente."
-                }), 503
-            return jsonify({"erro": "Erro ao analisar documento. Tente novamente em alguns instantes."}), 500
+            return jsonify({"erro": mensagem_erro_analise(e)}), 503 if erro_de_quota(e) else 500
 
-        # 🔒 VERIFICAÇÃO DE SEGREDO DE JUSTIÇA
-        segredo_justica = analise_completa.get("segredo_justica", {})
-        if segredo_justica.get("detectado") == True:
-            tipo_doc_segredo = (analise_completa.get("tipo_documento") or "").lower().strip()
-            # Mandados e intimações são documentos procedimentais - não restringir
-            tipos_procedimentais = ["mandado", "intimacao", "intimação", "citacao", "citação", "notificacao", "notificação"]
-            # Fallback: detectar tipo procedimental pelo texto original caso Gemini não preencha tipo_documento
-            if not tipo_doc_segredo or tipo_doc_segredo == "sigiloso":
-                texto_upper = texto_original[:3000].upper()
-                termos_procedimentais = ["MANDADO DE INTIMAÇÃO", "MANDADO DE CITAÇÃO", "MANDADO DE NOTIFICAÇÃO",
-                                        "INTIMAÇÃO", "CITAÇÃO", "NOTIFICAÇÃO", "OFICIAL DE JUSTIÇA", "CUMPRA-SE"]
-                for termo in termos_procedimentais:
-                    if termo in texto_upper:
-                        tipo_doc_segredo = "mandado" if "MANDADO" in termo else termo.lower()
-                        logging.info(f"📋 Tipo procedimental detectado pelo texto original: '{termo}'")
-                        break
-            if tipo_doc_segredo in tipos_procedimentais:
-                logging.warning(f"🔒 Segredo detectado pelo Gemini, mas documento é tipo '{tipo_doc_segredo}' (procedimental) - IGNORANDO restrição")
-                # Verificar se o texto simplificado está vazio/padrão (Gemini pode ter retornado só a msg de segredo)
-                texto_simp = analise_completa.get("texto_simplificado", "")
-                msg_padrao_segredo = "segredo de justiça"
-                if not texto_simp or msg_padrao_segredo in texto_simp.lower():
-                    logging.warning("🔄 Texto simplificado está vazio ou é mensagem padrão de segredo - re-analisando documento...")
-                    # Invalidar cache para forçar nova análise
-                    # Reconstruir a chave com mesmo formato usado em analisar_documento_completo_gemini
-                    _sid_inval = obter_session_id()
-                    cache_key = hashlib.sha256(f"{_sid_inval}:{perspectiva}:{texto_original}".encode()).hexdigest()
-                    with cleanup_lock:
-                        if cache_key in results_cache:
-                            del results_cache[cache_key]
-                    try:
-                        analise_completa = analisar_documento_completo_gemini(texto_original, perspectiva, session_id=obter_session_id())
-                    except Exception as e:
-                        logging.error(f"❌ Erro na re-análise: {e}")
-                        # Continuar com a análise original mesmo incompleta
-                # Limpar a flag de segredo para que o documento seja simplificado normalmente
-                analise_completa["segredo_justica"] = {"detectado": False, "motivo": None, "hipotese_legal": None}
-            else:
-                logging.warning(f"🔒 SEGREDO DE JUSTIÇA DETECTADO - Motivo: {segredo_justica.get('motivo', 'Não especificado')}")
-                logging.warning(f"🔒 Hipótese legal: {segredo_justica.get('hipotese_legal', 'Não especificada')}")
+        # 🔒 VERIFICAÇÃO DE SEGREDO DE JUSTIÇA E DOCUMENTO ADVOCATÍCIO (mesma regra do /processar/stream)
+        segredo_detectado = (analise_completa.get("segredo_justica") or {}).get("detectado") == True
+        bloqueio = verificar_bloqueio_analise(analise_completa, texto_original, perspectiva)
+        if not bloqueio:
+            analise_completa, bloqueio = reanalisar_se_so_segredo(analise_completa, segredo_detectado, documento, session_id)
+        if bloqueio:
+            return jsonify(bloqueio)
 
-                # Retornar resposta específica sem informações do documento
-                return jsonify({
-                    "texto": "O processo envolve segredo de justiça, procure a Comarca do fórum da sua cidade.",
-                    "tipo_documento": "sigiloso",
-                    "confianca_tipo": "ALTA",
-                    "razao_tipo": "Documento identificado como protegido por segredo de justiça",
-                    "urgencia": "MÉDIA",
-                    "acao_necessaria": "Procure a Comarca do fórum da sua cidade",
-                    "dados_extraidos": {
-                        "numero_processo": None,
-                        "tipo_documento": "sigiloso",
-                        "partes": {},
-                        "autoridade": {},
-                        "valores": {},
-                        "prazos": [],
-                        "decisao": None,
-                        "audiencias": [],
-                        "links_audiencia": []
-                    },
-                    "recursos_cabiveis": {
-                        "cabe_recurso": "Não disponível",
-                        "prazo": None
-                    },
-                    "perguntas_sugeridas": [],
-                    "tem_justica_gratuita": None,
-                    "caracteres_original": len(texto_original),
-                    "caracteres_simplificado": 0,
-                    "modelo_usado": analise_completa.get("modelo_usado", GEMINI_MODELS[0]["name"]),
-                    "perspectiva_aplicada": perspectiva,
-                    "segredo_justica": {
-                        "detectado": True,
-                        "motivo": None,
-                        "hipotese_legal": None
-                    },
-                    "pdf_download_url": None
-                })
+        # Salvar texto original
+        texto_original_path = os.path.join(TEMP_DIR, f"texto_{documento['file_hash'][:8]}.txt")
+        with open(texto_original_path, 'w', encoding='utf-8') as f:
+            f.write(texto_original)
+        registrar_arquivo_temporario(texto_original_path, session_id=session.get('session_id'))
 
-        # 🚫 VERIFICAÇÃO DE DOCUMENTO ADVOCATÍCIO (não-judicial)
-        origem_doc = (analise_completa.get("origem_documento") or "").lower().strip()
-        confianca_origem = (analise_completa.get("confianca_origem") or "").upper().strip()
-        razao_origem = analise_completa.get("razao_origem", "")
-        tipo_doc_gemini = (analise_completa.get("tipo_documento") or "").lower().strip()
-
-        # Verificação cruzada: tipos judiciais NUNCA podem ser classificados como advocatícios
-        # Sentenças, acórdãos, mandados, decisões, despachos e intimações são SEMPRE judiciais
-        tipos_sempre_judiciais = ["sentenca", "acordao", "mandado", "decisao", "despacho", "intimacao"]
-        if origem_doc == "advocaticio" and tipo_doc_gemini in tipos_sempre_judiciais:
-            logging.warning(f"⚠️ CORREÇÃO AUTOMÁTICA: Gemini classificou origem como 'advocaticio' mas tipo_documento é '{tipo_doc_gemini}' (sempre judicial)")
-            logging.warning(f"⚠️ Razão original do Gemini: {razao_origem}")
-            logging.info(f"✅ Corrigindo origem_documento de 'advocaticio' para 'judicial' (tipo '{tipo_doc_gemini}' é intrinsecamente judicial)")
-            origem_doc = "judicial"
-            analise_completa["origem_documento"] = "judicial"
-            analise_completa["confianca_origem"] = "ALTA"
-            analise_completa["razao_origem"] = f"Corrigido automaticamente: {tipo_doc_gemini} é documento judicial (classificação original incorreta: {razao_origem})"
+        # 🔐 GERAR ID DE VALIDAÇÃO (LGPD compliant)
+        doc_id = gerar_doc_id()
+        validation_url = f"{request.host_url.rstrip('/')}/validar/{doc_id}"
+        pdf_filename = f"simplificado_{documento['file_hash'][:8]}.pdf"
+
+        resultado, pdf_path = finalizar_documento(analise_completa, documento, doc_id, request.remote_addr,
+                                                  validation_url, pdf_filename, inicio_processamento)
+
+        # Autorizar PDF para esta sessão (vínculo PDF↔sessão contra acesso cruzado)
+        autorizar_pdf_sessao(os.path.basename(pdf_path))
+
+        # Salvar na sessão
+        session['pdf_path'] = pdf_path
+        session['pdf_filename'] = pdf_filename
+        session['texto_original_path'] = texto_original_path
+        session['contexto_chat'] = {
+            "dados_extraidos": resultado["dados_extraidos"],
+            "perspectiva": perspectiva,
+            "perguntas_sugeridas": resultado["perguntas_sugeridas"]
+        }
+        session.modified = True
+
+        return jsonify(resultado)
+
+    except Exception as e:
+        logging.error(f"❌ Erro: {e}", exc_info=DEBUG_MODE)
+        return jsonify({"erro": "Erro ao processar arquivo"}), 500
+
+    finally:
+        # 🔐 Registrar CPF no cofre APÓS processamento (sucesso ou falha)
+        try:
+            if cpf_limpo:
+                ip_address = request.remote_addr
+                registrar_cpf_vault(cpf_limpo, ip_address)
+        except Exception as e:
+            logging.warning(f"⚠️ Erro ao registrar CPF no cofre: {e}")
 
-        if origem_doc == "advocaticio" and confianca_origem in ("ALTA", "MÉDIA"):
-            logging.warning(f"🚫 DOCUMENTO ADVOCATÍCIO DETECTADO - Confiança: {confianca_origem}")
-            logging.warning(f"🚫 Razão: {razao_origem}")
+def verificar_bloqueio_analise(analise_completa, texto_original, perspectiva):
+    """
+    Aplica as verificações pós-Gemini do /processar (segredo de justiça e
+    origem advocatícia) sobre o JSON técnico, sem depender do texto simplificado.
 
-            return jsonify({
-                "documento_nao_judicial": True,
-                "texto": "",
-                "tipo_documento": "advocaticio",
-                "confianca_tipo": confianca_origem,
-                "razao_tipo": razao_origem,
-                "urgencia": None,
-                "acao_necessaria": None,
+    Returns:
+        dict | None: payload de bloqueio (mesmo formato do /processar) ou None
+    """
+    modelo_usado = analise_completa.get("modelo_usado", GEMINI_MODELS[0]["name"])
+
+    # 🔒 SEGREDO DE JUSTIÇA
+    segredo_justica = analise_completa.get("segredo_justica", {}) or {}
+    if segredo_justica.get("detectado") == True:
+        tipo_doc_segredo = (analise_completa.get("tipo_documento") or "").lower().strip()
+        tipos_procedimentais = ["mandado", "intimacao", "intimação", "citacao", "citação", "notificacao", "notificação"]
+        if not tipo_doc_segredo or tipo_doc_segredo == "sigiloso":
+            texto_upper = texto_original[:3000].upper()
+            termos_procedimentais = ["MANDADO DE INTIMAÇÃO", "MANDADO DE CITAÇÃO", "MANDADO DE NOTIFICAÇÃO",
+                                    "INTIMAÇÃO", "CITAÇÃO", "NOTIFICAÇÃO", "OFICIAL DE JUSTIÇA", "CUMPRA-SE"]
+            for termo in termos_procedimentais:
+                if termo in texto_upper:
+                    tipo_doc_segredo = "mandado" if "MANDADO" in termo else termo.lower()
+                    break
+        if tipo_doc_segredo in tipos_procedimentais:
+            logging.warning(f"🔒 Segredo detectado pelo Gemini, mas documento é tipo '{tipo_doc_segredo}' (procedimental) - IGNORANDO restrição")
+            analise_completa["segredo_justica"] = {"detectado": False, "motivo": None, "hipotese_legal": None}
+        else:
+            logging.warning(f"🔒 SEGREDO DE JUSTIÇA DETECTADO - Motivo: {segredo_justica.get('motivo', 'Não especificado')}")
+            return {
+                "texto": "O processo envolve segredo de justiça, procure a Comarca do fórum da sua cidade.",
+                "tipo_documento": "sigiloso",
+                "confianca_tipo": "ALTA",
+                "razao_tipo": "Documento identificado como protegido por segredo de justiça",
+                "urgencia": "MÉDIA",
+                "acao_necessaria": "Procure a Comarca do fórum da sua cidade",
                 "dados_extraidos": {
                     "numero_processo": None,
-                    "tipo_documento": "advocaticio",
+                    "tipo_documento": "sigiloso",
                     "partes": {},
                     "autoridade": {},
                     "valores": {},
@@ -2464,178 +3564,462 @@ def processar():
                     "audiencias": [],
                     "links_audiencia": []
                 },
-                "recursos_cabiveis": {"cabe_recurso": None, "prazo": None},
+                "recursos_cabiveis": {"cabe_recurso": "Não disponível", "prazo": None},
                 "perguntas_sugeridas": [],
                 "tem_justica_gratuita": None,
                 "caracteres_original": len(texto_original),
                 "caracteres_simplificado": 0,
-                "modelo_usado": analise_completa.get("modelo_usado", GEMINI_MODELS[0]["name"]),
+                "modelo_usado": modelo_usado,
                 "perspectiva_aplicada": perspectiva,
-                "segredo_justica": {"detectado": False, "motivo": None, "hipotese_legal": None},
+                "segredo_justica": {"detectado": True, "motivo": None, "hipotese_legal": None},
                 "pdf_download_url": None
-            })
+            }
 
-        tipo_doc = analise_completa.get("tipo_documento", "desconhecido")
-        texto_simplificado = analise_completa.get("texto_simplificado", "")
-        modelo_usado = analise_completa.get("modelo_usado", GEMINI_MODELS[0]["name"])
-        perspectiva_aplicada = analise_completa.get("perspectiva_aplicada", perspectiva)
+    # 🚫 DOCUMENTO ADVOCATÍCIO (não-judicial)
+    origem_doc = (analise_completa.get("origem_documento") or "").lower().strip()
+    confianca_origem = (analise_completa.get("confianca_origem") or "").upper().strip()
+    razao_origem = analise_completa.get("razao_origem", "")
+    tipo_doc_gemini = (analise_completa.get("tipo_documento") or "").lower().strip()
+
+    tipos_sempre_judiciais = ["sentenca", "acordao", "mandado", "decisao", "despacho", "intimacao"]
+    if origem_doc == "advocaticio" and tipo_doc_gemini in tipos_sempre_judiciais:
+        logging.warning(f"⚠️ CORREÇÃO AUTOMÁTICA: origem 'advocaticio' com tipo_documento '{tipo_doc_gemini}' (sempre judicial)")
+        origem_doc = "judicial"
+        analise_completa["origem_documento"] = "judicial"
+        analise_completa["confianca_origem"] = "ALTA"
+        analise_completa["razao_origem"] = f"Corrigido automaticamente: {tipo_doc_gemini} é documento judicial (classificação original incorreta: {razao_origem})"
+
+    if origem_doc == "advocaticio" and confianca_origem in ("ALTA", "MÉDIA"):
+        logging.warning(f"🚫 DOCUMENTO ADVOCATÍCIO DETECTADO - Confiança: {confianca_origem}")
+        return {
+            "documento_nao_judicial": True,
+            "texto": "",
+            "tipo_documento": "advocaticio",
+            "confianca_tipo": confianca_origem,
+            "razao_tipo": razao_origem,
+            "urgencia": None,
+            "acao_necessaria": None,
+            "dados_extraidos": {
+                "numero_processo": None,
+                "tipo_documento": "advocaticio",
+                "partes": {},
+                "autoridade": {},
+                "valores": {},
+                "prazos": [],
+                "decisao": None,
+                "audiencias": [],
+                "links_audiencia": []
+            },
+            "recursos_cabiveis": {"cabe_recurso": None, "prazo": None},
+            "perguntas_sugeridas": [],
+            "tem_justica_gratuita": None,
+            "caracteres_original": len(texto_original),
+            "caracteres_simplificado": 0,
+            "modelo_usado": modelo_usado,
+            "perspectiva_aplicada": perspectiva,
+            "segredo_justica": {"detectado": False, "motivo": None, "hipotese_legal": None},
+            "pdf_download_url": None
+        }
 
-        logging.info(f"✅ Análise concluída: tipo={tipo_doc}, modelo={modelo_usado}, perspectiva={perspectiva_aplicada}")
+    return None
 
-        # Preparar dados estruturados
-        # Filtrar prazos válidos (não null, não vazios)
-        prazos_validos = []
-        for p in analise_completa.get("prazos", []):
-            if isinstance(p, dict) and p.get("prazo") and p.get("prazo") != "null":
-                prazos_validos.append(p)
 
-        dados_estruturados = {
-            "numero_processo": extrair_numero_processo_regex(texto_original),
-            "tipo_documento": tipo_doc,
-            "partes": analise_completa.get("partes", {}),
-            "autoridade": analise_completa.get("autoridade", {}),  # Agora retorna objeto completo com cargo e nome
-            "valores": analise_completa.get("valores_principais", {}),
-            "prazos": prazos_validos,  # Agora retorna objetos completos com destinatario e finalidade
-            "decisao": analise_completa.get("decisao_resumida"),
-            "audiencias": [analise_completa.get("audiencia")] if analise_completa.get("audiencia", {}).get("tem_audiencia") else [],
-            "links_audiencia": [analise_completa.get("audiencia", {}).get("link")] if analise_completa.get("audiencia", {}).get("link") else [],
-        }
+def erro_de_quota(erro):
+    """Erro do Gemini por limite de uso (quota / 429)."""
+    erro_msg = str(erro)
+    return "quota" in erro_msg.lower() or "429" in erro_msg or "limite" in erro_msg.lower()
 
-        info_doc = {
-            "urgencia": analise_completa.get("urgencia", "MÉDIA"),
-            "acao_necessaria": analise_completa.get("acao_necessaria", "Verificar documento")
-        }
 
-        recursos_info = analise_completa.get("recursos_cabiveis", {
-            "cabe_recurso": "Consulte advogado(a) ou defensoria pública",
-            "prazo": None
-        })
+def mensagem_erro_analise(erro):
+    """Mensagem amigável para falhas da análise Gemini (JSON do /processar ou evento "erro" do stream)."""
+    if erro_de_quota(erro):
+        return ("O serviço de IA está temporariamente indisponível devido ao limite de uso. "
+                "Por favor, aguarde alguns minutos e tente novamente.")
+    return "Erro ao analisar documento. Tente novamente em alguns instantes."
 
-        # Contexto chat
-        contexto_chat = {
-            "dados_extraidos": dados_estruturados,
-            "perspectiva": perspectiva,
-            "perguntas_sugeridas": gerar_perguntas_sugeridas(dados_estruturados)
-        }
 
-        # Salvar texto original
-        texto_original_path = os.path.join(TEMP_DIR, f"texto_{file_hash[:8]}.txt")
-        with open(texto_original_path, 'w', encoding='utf-8') as f:
-            f.write(texto_original)
-        registrar_arquivo_temporario(texto_original_path, session_id=session.get('session_id'))
+def preparar_documento_upload():
+    """
+    Etapas do /processar e do /processar/stream antes do Gemini: limite de tokens,
+    CPF, validação do arquivo, extração do texto (com cache) e pré-validação
+    advocatícia.
 
-        # 🔐 GERAR ID E HASH DE VALIDAÇÃO (LGPD compliant)
-        doc_id = gerar_doc_id()
-        hash_conteudo = gerar_hash_conteudo(texto_simplificado)
-        hash_curto = f"{hash_conteudo[:8]}...{hash_conteudo[-8:]}"
+    Returns:
+        tuple: (documento, cpf_limpo, resposta_erro) - documento é um dict com
+               texto_original, metadados_arquivo, perspectiva, file_hash,
+               nome_arquivo, tamanho e tokens_economizados; resposta_erro é a
+               resposta Flask a devolver (ou None). cpf_limpo vem preenchido
+               sempre que o CPF foi validado, mesmo com erro depois.
+    """
+    # 🔐 VERIFICAR LIMITE DE TOKENS
+    token_check = verificar_limite_tokens_request()
+    if token_check:
+        return None, None, token_check
 
-        # Hash do IP (LGPD: nunca armazena o IP real)
-        ip_address = request.remote_addr
-        ip_hash = gerar_hash_ip(ip_address or '0.0.0.0')
+    # 🔐 VERIFICAR CPF
+    cpf_limpo, cpf_error = verificar_cpf_request()
+    if cpf_error:
+        return None, None, cpf_error
 
-        # URL de validação
-        base_url = request.host_url.rstrip('/')
-        validation_url = f"{base_url}/validar/{doc_id}"
+    if 'file' not in request.files:
+        return None, cpf_limpo, (jsonify({"erro": "Nenhum arquivo enviado"}), 400)
 
-        # Registrar validação no banco (LGPD compliant)
+    file = request.files['file']
+    perspectiva = request.form.get('perspectiva', 'nao_informado')
+
+    # Validar perspectiva contra whitelist (anti prompt injection)
+    PERSPECTIVAS_VALIDAS = {'autor', 'reu', 'nao_informado'}
+    if perspectiva not in PERSPECTIVAS_VALIDAS:
+        perspectiva = 'nao_informado'
+
+    logging.info(f"📍 Perspectiva capturada: {perspectiva}")
+
+    if file.filename == '':
+        return None, cpf_limpo, (jsonify({"erro": "Nenhum arquivo selecionado"}), 400)
+
+    if not allowed_file(file.filename):
+        return None, cpf_limpo, (jsonify({"erro": "Formato inválido"}), 400)
+
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+
+    if size > MAX_FILE_SIZE:
+        return None, cpf_limpo, (jsonify({"erro": "Arquivo muito grande"}), 400)
+
+    file_bytes = file.read()
+    file_extension = file.filename.rsplit('.', 1)[1].lower()
+    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    nome_arquivo = secure_filename(file.filename)
+
+    # Validar MIME real via magic bytes — extensão sozinha é insuficiente
+    if not validar_mime_arquivo(file_bytes, file_extension):
+        logging.warning(f"🚫 Arquivo rejeitado: extensão .{file_extension} não bate com o conteúdo real")
+        return None, cpf_limpo, (jsonify({"erro": "O conteúdo do arquivo não corresponde à extensão informada."}), 400)
+
+    logging.info(f"📄 Processando: {nome_arquivo} ({size/1024:.1f}KB)")
+
+    extracao = buscar_extracao_cache(file_hash, file_extension)
+    if extracao is not None:
+        texto_original, metadados_arquivo, pre_validacao = extracao
+    else:
+        # Extrair texto (OCR limitado a um prazo para o documento inteiro)
+        prazo_ocr = prazo_ocr_documento()
         try:
-            registrar_validacao(doc_id, hash_conteudo, ip_hash, tipo_doc)
+            if file_extension == 'pdf':
+                logging.info("📄 Extraindo texto de PDF...")
+                texto_original, metadados_arquivo = extrair_texto_pdf(file_bytes, prazo_ocr)
+                logging.info(f"✅ Texto extraído do PDF: {len(texto_original)} caracteres")
+            elif file_extension in ALLOWED_IMAGE_EXTENSIONS:
+                logging.info("🖼️ Extraindo texto de imagem com OCR...")
+                texto_original, metadados_arquivo = processar_imagem_para_texto(file_bytes, file_extension.upper(), prazo_ocr)
+                logging.info(f"✅ Texto extraído da imagem: {len(texto_original)} caracteres")
+            else:
+                return None, cpf_limpo, (jsonify({"erro": "Tipo não suportado"}), 400)
         except Exception as e:
-            logging.error(f"❌ Erro ao registrar validação: {e}")
+            logging.error(f"❌ Erro ao extrair texto do arquivo: {e}", exc_info=DEBUG_MODE)
+            return None, cpf_limpo, (jsonify({"erro": "Erro ao extrair texto do documento. Verifique se o arquivo não está corrompido."}), 500)
 
-        # Gerar PDF
-        metadados_pdf = {
-            "modelo": modelo_usado,
-            "tipo": metadados_arquivo.get("tipo"),
-            "tipo_documento": tipo_doc,
-            "urgencia": info_doc["urgencia"],
-            "dados": dados_estruturados,
-            "recursos": recursos_info,
-            "confianca": analise_completa.get("confianca_tipo", "MÉDIA"),
-            "perspectiva": perspectiva_aplicada,
-            "doc_id": doc_id,
-            "hash_curto": hash_curto,
-            "validation_url": validation_url
-        }
+        if len(texto_original) < 10:
+            logging.warning(f"⚠️ Texto muito curto: {len(texto_original)} caracteres")
+            return None, cpf_limpo, (jsonify({"erro": "Texto insuficiente no documento"}), 400)
 
-        pdf_filename = f"simplificado_{file_hash[:8]}.pdf"
-        pdf_path = gerar_pdf_simplificado(texto_simplificado, metadados_pdf, pdf_filename)
+        # 🚫 PRÉ-VALIDAÇÃO: Detectar documentos advocatícios antes de enviar ao Gemini
+        pre_validacao = detectar_documento_advocaticio(texto_original)
+        salvar_extracao_cache(file_hash, file_extension, texto_original, metadados_arquivo, pre_validacao)
+
+    if pre_validacao["detectado"]:
+        logging.warning(f"🚫 PRÉ-VALIDAÇÃO: Documento advocatício detectado - {pre_validacao['razao']}")
+        return None, cpf_limpo, jsonify(verificar_bloqueio_analise({
+            "origem_documento": "advocaticio",
+            "confianca_origem": "ALTA",
+            "razao_origem": pre_validacao["razao"],
+            "modelo_usado": "pre-validacao",
+        }, texto_original, perspectiva))
+
+    documento = {
+        "texto_original": texto_original,
+        "metadados_arquivo": metadados_arquivo,
+        "perspectiva": perspectiva,
+        "file_hash": file_hash,
+        "nome_arquivo": nome_arquivo,
+        "tamanho": size,
+        "tokens_economizados": metadados_arquivo.get("boilerplate_removido", {}).get("tokens_estimados", 0)
+    }
+    return documento, cpf_limpo, None
 
-        # Autorizar PDF para esta sessão (vínculo PDF↔sessão contra acesso cruzado)
-        autorizar_pdf_sessao(os.path.basename(pdf_path))
 
-        # Salvar na sessão
-        session['pdf_path'] = pdf_path
-        session['pdf_filename'] = pdf_filename
-        session['texto_original_path'] = texto_original_path
-        session['contexto_chat'] = contexto_chat
+def reanalisar_se_so_segredo(analise_completa, segredo_detectado, documento, session_id):
+    """
+    Segredo de justiça ignorado por ser documento procedimental
+    (verificar_bloqueio_analise): o Gemini pode ter devolvido só a mensagem
+    padrão de segredo no lugar do texto simplificado. Nesse caso o documento
+    é re-analisado, sem o cache.
+
+    Returns:
+        tuple: (analise, bloqueio) - bloqueio da nova análise ou None
+    """
+    if not segredo_detectado:
+        return analise_completa, None
+    texto_simp = analise_completa.get("texto_simplificado", "")
+    if texto_simp and "segredo de justiça" not in texto_simp.lower():
+        return analise_completa, None
+
+    texto_original = documento["texto_original"]
+    perspectiva = documento["perspectiva"]
+    logging.warning("🔄 Texto simplificado está vazio ou é mensagem padrão de segredo - re-analisando documento...")
+    invalidar_analise_documento(texto_original, perspectiva, session_id)
+    try:
+        analise_nova = analisar_documento_completo_gemini(texto_original, perspectiva, session_id=session_id,
+                                                          tokens_economizados=documento["tokens_economizados"])
+    except Exception as e:
+        logging.error(f"❌ Erro na re-análise: {e}")
+        # Continuar com a análise original mesmo incompleta
+        return analise_completa, None
+    analise_nova["segredo_justica"] = {"detectado": False, "motivo": None, "hipotese_legal": None}
+    return analise_nova, verificar_bloqueio_analise(analise_nova, texto_original, perspectiva)
+
+
+def finalizar_documento(analise_completa, documento, doc_id, ip_address, validation_url, pdf_filename, inicio_processamento):
+    """
+    Etapas do /processar e do /processar/stream depois da análise: dados
+    estruturados, registro de validação, PDF, estatísticas e auditoria de IP.
+
+    Returns:
+        tuple: (payload final - o mesmo nas duas rotas, caminho do PDF)
+    """
+    texto_original = documento["texto_original"]
+    perspectiva = documento["perspectiva"]
+    tipo_doc = analise_completa.get("tipo_documento", "desconhecido")
+    texto_simplificado = analise_completa.get("texto_simplificado", "")
+    modelo_usado = analise_completa.get("modelo_usado", GEMINI_MODELS[0]["name"])
+    perspectiva_aplicada = analise_completa.get("perspectiva_aplicada", perspectiva)
+
+    logging.info(f"✅ Análise concluída: tipo={tipo_doc}, modelo={modelo_usado}, perspectiva={perspectiva_aplicada}")
+
+    # Filtrar prazos válidos (não null, não vazios)
+    prazos_validos = [
+        p for p in analise_completa.get("prazos", [])
+        if isinstance(p, dict) and p.get("prazo") and p.get("prazo") != "null"
+    ]
+
+    dados_estruturados = {
+        "numero_processo": extrair_numero_processo_regex(texto_original),
+        "tipo_documento": tipo_doc,
+        "partes": analise_completa.get("partes", {}),
+        "autoridade": analise_completa.get("autoridade", {}),  # Agora retorna objeto completo com cargo e nome
+        "valores": analise_completa.get("valores_principais", {}),
+        "prazos": prazos_validos,  # Agora retorna objetos completos com destinatario e finalidade
+        "decisao": analise_completa.get("decisao_resumida"),
+        "audiencias": [analise_completa.get("audiencia")] if analise_completa.get("audiencia", {}).get("tem_audiencia") else [],
+        "links_audiencia": [analise_completa.get("audiencia", {}).get("link")] if analise_completa.get("audiencia", {}).get("link") else [],
+    }
+    urgencia = analise_completa.get("urgencia", "MÉDIA")
+    acao_necessaria = analise_completa.get("acao_necessaria", "Verificar documento")
+    recursos_info = analise_completa.get("recursos_cabiveis", {
+        "cabe_recurso": "Consulte advogado(a) ou defensoria pública",
+        "prazo": None
+    })
+    perguntas_sugeridas = gerar_perguntas_sugeridas(dados_estruturados)
+
+    # 🔐 HASH DE VALIDAÇÃO (LGPD: nunca armazena o IP real)
+    hash_conteudo = gerar_hash_conteudo(texto_simplificado)
+    hash_curto = f"{hash_conteudo[:8]}...{hash_conteudo[-8:]}"
+    ip_hash = gerar_hash_ip(ip_address or '0.0.0.0')
+    try:
+        registrar_validacao(doc_id, hash_conteudo, ip_hash, tipo_doc)
+    except Exception as e:
+        logging.error(f"❌ Erro ao registrar validação: {e}")
+
+    # Gerar PDF
+    metadados_pdf = {
+        "modelo": modelo_usado,
+        "tipo": documento["metadados_arquivo"].get("tipo"),
+        "tipo_documento": tipo_doc,
+        "urgencia": urgencia,
+        "dados": dados_estruturados,
+        "recursos": recursos_info,
+        "confianca": analise_completa.get("confianca_tipo", "MÉDIA"),
+        "perspectiva": perspectiva_aplicada,
+        "doc_id": doc_id,
+        "hash_curto": hash_curto,
+        "validation_url": validation_url
+    }
+    pdf_path = agendar_pdf(texto_simplificado, metadados_pdf, pdf_filename)
+
+    # Estatísticas
+    try:
+        database.incrementar_documento(tipo_doc)
+    except Exception as e:
+        logging.error(f"Erro stats: {e}")
+
+    # 📋 Auditoria de IP (registra IP real + metadados, SEM conteúdo do documento)
+    try:
+        tokens_usados = analise_completa.get("tokens_usados") or {}
+        registrar_auditoria_ip(
+            ip_address=ip_address or '0.0.0.0',
+            tipo_documento=tipo_doc,
+            nome_arquivo=documento["nome_arquivo"],
+            tamanho_bytes=documento["tamanho"],
+            modelo_usado=modelo_usado,
+            tempo_ms=int((time.monotonic() - inicio_processamento) * 1000),
+            tentativa_numero=analise_completa.get("tentativa_numero", 1),
+            sucesso=True,
+            tokens_input=tokens_usados.get("input", 0),
+            tokens_output=tokens_usados.get("output", 0),
+        )
+    except Exception as e:
+        logging.error(f"❌ Erro ao registrar auditoria: {e}")
+
+    logging.info(f"✅ Processamento completo: {tipo_doc} (confiança: {analise_completa.get('confianca_tipo')}, perspectiva: {perspectiva_aplicada})")
+
+    resultado = {
+        "texto": texto_simplificado,
+        "tipo_documento": tipo_doc,
+        "confianca_tipo": analise_completa.get("confianca_tipo"),
+        "razao_tipo": analise_completa.get("razao_tipo"),
+        "urgencia": urgencia,
+        "acao_necessaria": acao_necessaria,
+        "dados_extraidos": dados_estruturados,
+        "recursos_cabiveis": recursos_info,
+        "perguntas_sugeridas": perguntas_sugeridas,
+        "tem_justica_gratuita": analise_completa.get("tem_justica_gratuita"),
+        "caracteres_original": len(texto_original),
+        "caracteres_simplificado": len(texto_simplificado),
+        "paginas_puladas": documento["metadados_arquivo"].get("paginas_puladas", []),
+        "modelo_usado": modelo_usado,
+        "perspectiva_aplicada": perspectiva_aplicada,
+        "segredo_justica": {
+            "detectado": False,
+            "motivo": None,
+            "hipotese_legal": None
+        },
+        "pdf_download_url": f"/download_pdf?path={os.path.basename(pdf_path)}&filename={pdf_filename}",
+        "doc_id": doc_id,
+        "validation_url": validation_url
+    }
+    return resultado, pdf_path
+
+
+def evento_sse(evento, dados):
+    """Formata um evento Server-Sent Events com payload JSON."""
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+
+@app.route("/processar/stream", methods=["POST"])
+@rate_limit
+@require_csrf
+def processar_stream():
+    """
+    Mesmo fluxo do /processar, mas devolve o resultado como Server-Sent Events:
+    "analise" (classificação), "texto" (trechos do texto simplificado),
+    "fim" (payload idêntico ao do /processar) ou "erro".
+
+    Erros de validação e a pré-validação advocatícia continuam saindo como JSON
+    comum (antes de abrir o stream), com os mesmos status HTTP do /processar.
+    """
+    cpf_limpo = None
+    inicio_processamento = time.monotonic()  # métricas admin: tempo total
+    try:
+        session.permanent = True
         session.modified = True
 
-        # Estatísticas
-        try:
-            database.incrementar_documento(tipo_doc)
-        except Exception as e:
-            logging.error(f"Erro stats: {e}")
+        documento, cpf_limpo, resposta_erro = preparar_documento_upload()
+        if resposta_erro:
+            return resposta_erro
+        texto_original = documento["texto_original"]
+        perspectiva = documento["perspectiva"]
+        file_hash = documento["file_hash"]
 
-        # 📋 Auditoria de IP (registra IP real + metadados, SEM conteúdo do documento)
-        try:
-            tempo_total_ms = int((time.monotonic() - inicio_processamento) * 1000)
-            tokens_usados = analise_completa.get("tokens_usados") or {}
-            registrar_auditoria_ip(
-                ip_address=ip_address or '0.0.0.0',
-                tipo_documento=tipo_doc,
-                nome_arquivo=secure_filename(file.filename),
-                tamanho_bytes=size,
-                modelo_usado=modelo_usado,
-                tempo_ms=tempo_total_ms,
-                tentativa_numero=analise_completa.get("tentativa_numero", 1),
-                sucesso=True,
-                tokens_input=tokens_usados.get("input", 0),
-                tokens_output=tokens_usados.get("output", 0),
-            )
-        except Exception as e:
-            logging.error(f"❌ Erro ao registrar auditoria: {e}")
+        # Sessão preenchida ANTES do streaming: depois que os headers saem,
+        # o cookie de sessão não pode mais ser alterado.
+        session_id = obter_session_id()
+        doc_id = gerar_doc_id()
+        ip_address = request.remote_addr
+        validation_url = f"{request.host_url.rstrip('/')}/validar/{doc_id}"
 
-        logging.info(f"✅ Processamento completo: {tipo_doc} (confiança: {analise_completa.get('confianca_tipo')}, perspectiva: {perspectiva_aplicada})")
+        texto_original_path = os.path.join(TEMP_DIR, f"texto_{file_hash[:8]}.txt")
+        with open(texto_original_path, 'w', encoding='utf-8') as f:
+            f.write(texto_original)
+        registrar_arquivo_temporario(texto_original_path, session_id=session_id)
 
-        return jsonify({
-            "texto": texto_simplificado,
-            "tipo_documento": tipo_doc,
-            "confianca_tipo": analise_completa.get("confianca_tipo"),
-            "razao_tipo": analise_completa.get("razao_tipo"),
-            "urgencia": info_doc["urgencia"],
-            "acao_necessaria": info_doc["acao_necessaria"],
-            "dados_extraidos": dados_estruturados,
-            "recursos_cabiveis": recursos_info,
-            "perguntas_sugeridas": contexto_chat["perguntas_sugeridas"],
-            "tem_justica_gratuita": analise_completa.get("tem_justica_gratuita"),
-            "caracteres_original": len(texto_original),
-            "caracteres_simplificado": len(texto_simplificado),
-            "modelo_usado": modelo_usado,
-            "perspectiva_aplicada": perspectiva_aplicada,
-            "segredo_justica": {
-                "detectado": False,
-                "motivo": None,
-                "hipotese_legal": None
-            },
-            "pdf_download_url": f"/download_pdf?path={os.path.basename(pdf_path)}&filename={pdf_filename}",
-            "doc_id": doc_id,
-            "validation_url": validation_url
-        })
+        # Dados extraídos só existem no fim do stream: o /chat os lê deste arquivo
+        contexto_path = os.path.join(TEMP_DIR, f"contexto_{file_hash[:8]}.json")
+        pdf_filename = f"simplificado_{file_hash[:8]}.pdf"
+        autorizar_pdf_sessao(pdf_filename)
+
+        session['pdf_path'] = os.path.join(TEMP_DIR, pdf_filename)
+        session['pdf_filename'] = pdf_filename
+        session['texto_original_path'] = texto_original_path
+        session['contexto_chat'] = {
+            "dados_extraidos": {"numero_processo": extrair_numero_processo_regex(texto_original)},
+            "perspectiva": perspectiva,
+            "perguntas_sugeridas": [],
+            "dados_path": contexto_path
+        }
+        session.modified = True
 
     except Exception as e:
         logging.error(f"❌ Erro: {e}", exc_info=DEBUG_MODE)
         return jsonify({"erro": "Erro ao processar arquivo"}), 500
 
     finally:
-        # 🔐 Registrar CPF no cofre APÓS processamento (sucesso ou falha)
+        # 🔐 Registrar CPF no cofre (a análise em si ocorre durante o streaming)
         try:
             if cpf_limpo:
-                ip_address = request.remote_addr
-                registrar_cpf_vault(cpf_limpo, ip_address)
+                registrar_cpf_vault(cpf_limpo, request.remote_addr)
         except Exception as e:
             logging.warning(f"⚠️ Erro ao registrar CPF no cofre: {e}")
 
+    def gerar_eventos():
+        try:
+            segredo_detectado = False
+            for evento, dados in analisar_documento_stream_gemini(texto_original, perspectiva, session_id=session_id,
+                                                                  tokens_economizados=documento["tokens_economizados"]):
+                if evento == "analise":
+                    segredo_detectado = (dados.get("segredo_justica") or {}).get("detectado") == True
+                    bloqueio = verificar_bloqueio_analise(dados, texto_original, perspectiva)
+                    if bloqueio:
+                        yield evento_sse("fim", bloqueio)
+                        return
+                    yield evento_sse("analise", {
+                        "tipo_documento": dados.get("tipo_documento"),
+                        "confianca_tipo": dados.get("confianca_tipo"),
+                        "urgencia": dados.get("urgencia"),
+                        "acao_necessaria": dados.get("acao_necessaria"),
+                        "perspectiva_aplicada": perspectiva
+                    })
+                elif evento == "texto":
+                    yield evento_sse("texto", {"delta": dados})
+                elif evento == "fim":
+                    analise_completa = dados
+
+            # Mesma re-análise do /processar; o "texto" do evento "fim" substitui o que foi transmitido
+            analise_completa, bloqueio = reanalisar_se_so_segredo(analise_completa, segredo_detectado, documento, session_id)
+            if bloqueio:
+                yield evento_sse("fim", bloqueio)
+                return
+
+            resultado, _ = finalizar_documento(analise_completa, documento, doc_id, ip_address,
+                                               validation_url, pdf_filename, inicio_processamento)
+
+            with open(contexto_path, 'w', encoding='utf-8') as f:
+                json.dump({"dados_extraidos": resultado["dados_extraidos"],
+                           "perguntas_sugeridas": resultado["perguntas_sugeridas"]}, f, ensure_ascii=False)
+            registrar_arquivo_temporario(contexto_path, session_id=session_id)
+
+            yield evento_sse("fim", resultado)
+
+        except Exception as e:
+            logging.error(f"❌ ERRO no streaming: {e}", exc_info=DEBUG_MODE)
+            yield evento_sse("erro", {"erro": mensagem_erro_analise(e)})
+
+    return Response(
+        stream_with_context(gerar_eventos()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route("/processar_texto", methods=["POST"])
 @rate_limit
 @require_csrf
@@ -2730,12 +4114,7 @@ def processar_texto():
                 msg_padrao_segredo = "segredo de justiça"
                 if not texto_simp or msg_padrao_segredo in texto_simp.lower():
                     logging.warning("🔄 Texto simplificado está vazio ou é mensagem padrão de segredo - re-analisando documento...")
-                    # Reconstruir a chave com mesmo formato usado em analisar_documento_completo_gemini
-                    _sid_inval = obter_session_id()
-                    cache_key = hashlib.sha256(f"{_sid_inval}:{perspectiva}:{texto_original}".encode()).hexdigest()
-                    with cleanup_lock:
-                        if cache_key in results_cache:
-                            del results_cache[cache_key]
+                    invalidar_analise_documento(texto_original, perspectiva, obter_session_id())
                     try:
                         analise_completa = analisar_documento_completo_gemini(texto_original, perspectiva, session_id=obter_session_id())
                     except Exception as e:
@@ -2892,7 +4271,7 @@ def processar_texto():
         }
 
         pdf_filename = f"simplificado_{text_hash[:8]}.pdf"
-        pdf_path = gerar_pdf_simplificado(texto_simplificado, metadados_pdf, pdf_filename)
+        pdf_path = agendar_pdf(texto_simplificado, metadados_pdf, pdf_filename)
 
         # Autorizar PDF para esta sessão (vínculo PDF↔sessão contra acesso cruzado)
         autorizar_pdf_sessao(os.path.basename(pdf_path))
@@ -3003,6 +4382,12 @@ def chat_contextual():
         dados = contexto.get("dados_extraidos", {})
         perspectiva = contexto.get("perspectiva", "nao_informado")
 
+        # /processar/stream grava os dados extraídos em arquivo (sessão fecha antes da análise)
+        dados_path = contexto.get("dados_path")
+        if dados_path and os.path.exists(dados_path):
+            with open(dados_path, 'r', encoding='utf-8') as f:
+                dados = json.load(f).get("dados_extraidos", dados)
+
         # Truncar documento para o chat (máximo 10000 chars)
         doc_para_chat = documento[:10000] if documento else ""
 
@@ -3037,18 +4422,27 @@ PERGUNTA: {pergunta}
 Responda em NO MÁXIMO 2-3 frases curtas e simples, baseando-se EXCLUSIVAMENTE no documento acima. Se não souber, diga "Não encontrei essa informação no documento"."""
 
         # Tentar modelos em ordem de prioridade (fallback)
-        modelos_chat = sorted(GEMINI_MODELS, key=lambda x: x["priority"])
+        modelos_chat = modelos_roteados()
         ultimo_erro_chat = None
+        if not modelos_chat:
+            ultimo_erro_chat = Exception("; ".join(erros_circuitos_abertos().values()))
         for modelo_chat in modelos_chat:
+            if not circuito_permite_chamada(modelo_chat["name"]):
+                continue
             try:
-                response = gemini_client.models.generate_content(
-                    model=modelo_chat["name"],
-                    contents=prompt,
-                    config=genai_types.GenerateContentConfig(
-                        temperature=0,
-                        max_output_tokens=1000,
-                    ),
-                )
+                try:
+                    response = gemini_client.models.generate_content(
+                        model=modelo_chat["name"],
+                        contents=prompt,
+                        config=genai_types.GenerateContentConfig(
+                            temperature=0,
+                            max_output_tokens=1000,
+                        ),
+                    )
+                except Exception as e:
+                    registrar_erro_circuito(modelo_chat["name"], str(e))
+                    raise
+                registrar_sucesso_circuito(modelo_chat["name"])
                 texto_resposta = response.text
                 if not texto_resposta:
                     raise ValueError(f"Resposta vazia do modelo {modelo_chat['name']}")
@@ -3126,12 +4520,18 @@ def download_pdf():
         pdf_path = session.get('pdf_path')
         pdf_filename = session.get('pdf_filename', 'documento_simplificado.pdf')
 
-    if not pdf_path or not os.path.exists(pdf_path):
+    dados_pdf = obter_pdf_gerado(os.path.basename(pdf_path)) if pdf_path else None
+
+    if dados_pdf is None and (not pdf_path or not os.path.exists(pdf_path)):
         return jsonify({"erro": "PDF não encontrado ou expirado"}), 404
 
     try:
         # Sanitizar o filename de download também
         safe_download_name = secure_filename(pdf_filename)
+        if dados_pdf is not None:
+            # Da memória: Content-Length, ETag (If-None-Match -> 304) e Range pelo send_file
+            return send_file(io.BytesIO(dados_pdf), as_attachment=True, download_name=safe_download_name,
+                             mimetype='application/pdf', etag=hashlib.sha256(dados_pdf).hexdigest()[:32])
         return send_file(pdf_path, as_attachment=True, download_name=safe_download_name, mimetype='application/pdf')
     except Exception as e:
         logging.error(f"❌ Erro download: {e}")
@@ -3483,9 +4883,13 @@ def health():
             "models": {
                 "total": len(GEMINI_MODELS),
                 "configured": [m["name"] for m in sorted(GEMINI_MODELS, key=lambda x: x["priority"])],
-                "usage_stats": model_usage_stats
+                "usage_stats": estatisticas_modelos(),
+                "circuit_breakers": estado_circuitos()
             },
+            "result_cache": {"local_entries": len(results_cache), "shared": cache_compartilhado.estatisticas()},
             "tesseract_available": TESSERACT_AVAILABLE,
+            "ocr_engine": TESSERACT_MOTOR,
+            "ocr_service": ocr_servico.estatisticas(),
             "documents_processed": {"total": total_docs, "today": today_docs},
             "token_usage": token_info,
             "cpf_protection": {"enabled": True, "daily_limit_per_cpf": CPF_DAILY_LIMIT}
@@ -3526,11 +4930,11 @@ def cleanup_temp_files():
                 for key in to_remove:
                     del results_cache[key]
 
+            cache_compartilhado.limpar_expirados()
+
         except Exception as e:
             logging.error(f"Erro na limpeza: {e}")
 
-cleanup_thread = threading.Thread(target=cleanup_temp_files, daemon=True)
-cleanup_thread.start()
 
 
 # ============================================================================
@@ -3896,7 +5300,31 @@ def _admin_cleanup_loop():
             logging.error(f"Erro no cleanup admin: {e}")
 
 
-threading.Thread(target=_admin_cleanup_loop, daemon=True).start()
+# ============= THREADS DE LIMPEZA =============
+_threads_limpeza_pid = None
+
+
+def iniciar_threads_limpeza():
+    """
+    Inicia as threads de limpeza (LGPD, TEMP_DIR e admin), uma vez por processo.
+
+    Cada worker tem o próprio temp_files_tracker, então cada um precisa da
+    sua thread. Com preload_app o import roda no master e o fork não copia
+    threads: o gunicorn_config.py chama esta função no post_fork.
+    """
+    global _threads_limpeza_pid
+    if _threads_limpeza_pid == os.getpid():
+        return
+    _threads_limpeza_pid = os.getpid()
+    iniciar_limpeza_automatica()
+    threading.Thread(target=cleanup_temp_files, daemon=True).start()
+    threading.Thread(target=_admin_cleanup_loop, daemon=True).start()
+
+
+# Com preload o master não inicia threads: ele ainda vai forkar os workers.
+# __mp_main__: app.py reimportado pelo forkserver do OCR (python app.py)
+if os.getenv("LIMPEZA_NO_POST_FORK", "false").lower() != "true" and __name__ != "__mp_main__":
+    iniciar_threads_limpeza()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,425 @@
+"""
+Cache compartilhado de análises do Gemini, de OCR por página, de textos
+extraídos por arquivo e dos PDFs gerados (entre workers e reinícios)
+LGPD COMPLIANT - Conteúdo criptografado (Fernet), chave de cache é hash SHA-256,
+TTL curto e orçamento de bytes com descarte LRU
+
+Fica em SQLite sob /dev/shm (RAM, some no reboot do container) para que os
+workers do gunicorn - e os workers reciclados por max_requests - enxerguem o
+mesmo cache. O cache em memória do app.py continua como primeiro nível.
+"""
+import sqlite3
+import os
+import json
+import zlib
+import time
+import base64
+import hashlib
+import secrets
+import logging
+import tempfile
+from threading import Lock
+
+# Criptografia do conteúdo em cache
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    CRYPTO_AVAILABLE = True
+except ImportError:
+    CRYPTO_AVAILABLE = False
+    logging.warning("⚠️ cryptography não disponível - cache compartilhado desabilitado")
+
+# === CONFIGURAÇÕES ===
+_DIR_PADRAO = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+CACHE_DB_PATH = os.getenv("RESULT_CACHE_PATH", os.path.join(_DIR_PADRAO, "entenda_aqui_cache.db"))
+CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "3600"))  # segundos
+CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 64MB
+RESULT_CACHE_KEY = os.getenv("RESULT_CACHE_KEY", "")
+# Janela em que as sessões distintas de um mesmo conteúdo são contadas (cache anônimo)
+JANELA_SESSOES = int(os.getenv("CACHE_ANONIMO_JANELA", "86400"))  # 24h
+# OCR por página (reenvio do mesmo mandado escaneado não refaz o OCR)
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", "3600"))  # segundos
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # 32MB
+# Extração por arquivo (texto + metadados + pré-validação): reenvio com outra perspectiva
+EXTRACAO_CACHE_TTL = int(os.getenv("EXTRACAO_CACHE_TTL", "1800"))  # segundos
+EXTRACAO_CACHE_MAX_BYTES = int(os.getenv("EXTRACAO_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # 32MB
+# PDFs simplificados: mesmo prazo dos arquivos temporários (LGPD)
+PDF_CACHE_TTL = int(os.getenv("PDF_CACHE_TTL", "1800"))  # segundos
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # 32MB
+
+# Tabelas com a mesma estrutura (chave, dados, tamanho, criado_em, ultimo_acesso)
+TABELA_ANALISES = "cache_analises"
+TABELA_OCR = "cache_ocr"
+TABELA_EXTRACAO = "cache_extracao"
+TABELA_PDF = "cache_pdf"
+# Texto + metadados de PDFs ainda não gerados (geração adiada para o download)
+TABELA_PDF_PENDENTE = "cache_pdf_pendente"
+
+cache_lock = Lock()
+
+
+
+def derivar_chave(result_cache_key, secret_key):
+    """
+    Chave Fernet do cache: RESULT_CACHE_KEY ou, sem ela, derivada (HKDF) da
+    SECRET_KEY do Flask. Sem nenhuma das duas, chave aleatória deste processo.
+
+    Com preload_app os workers herdam a chave aleatória do master, mas ela muda
+    a cada restart do servidor (o arquivo em /dev/shm continua lá) e, sem
+    preload, cada worker teria a sua: não é uma chave compartilhada.
+
+    Returns:
+        tuple: (chave em bytes, compartilhada entre processos?)
+    """
+    if result_cache_key:
+        return hashlib.sha256(result_cache_key.encode()).digest(), True
+    if secret_key:
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"entenda-aqui:cache-compartilhado")
+        return hkdf.derive(secret_key.encode()), True
+    return secrets.token_bytes(32), False
+
+
+_fernet = None
+# Só com chave compartilhada um worker lê o que outro gravou: o que depende
+# disso (PDF servido pelo cache) consulta CHAVE_COMPARTILHADA
+CHAVE_COMPARTILHADA = False
+if CRYPTO_AVAILABLE:
+    key_bytes, CHAVE_COMPARTILHADA = derivar_chave(RESULT_CACHE_KEY, os.getenv("SECRET_KEY", ""))
+    if not CHAVE_COMPARTILHADA:
+        logging.warning("⚠️ RESULT_CACHE_KEY e SECRET_KEY não configuradas - cada worker cifra o cache "
+                        "compartilhado com a própria chave (sem acertos entre workers)")
+    _fernet = Fernet(base64.urlsafe_b64encode(key_bytes))
+
+CACHE_DISPONIVEL = _fernet is not None
+
+
+def _conectar():
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=5)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    return conn
+
+
+def init_cache():
+    """Cria a tabela do cache (idempotente)."""
+    global CACHE_DISPONIVEL
+    if not CACHE_DISPONIVEL:
+        return
+    try:
+        with cache_lock:
+            conn = _conectar()
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                for tabela in (TABELA_ANALISES, TABELA_OCR, TABELA_EXTRACAO, TABELA_PDF, TABELA_PDF_PENDENTE):
+                    conn.execute(f'''
+                        CREATE TABLE IF NOT EXISTS {tabela} (
+                            chave TEXT PRIMARY KEY,
+                            dados BLOB NOT NULL,
+                            tamanho INTEGER NOT NULL,
+                            criado_em REAL NOT NULL,
+                            ultimo_acesso REAL NOT NULL
+                        )
+                    ''')
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{tabela}_acesso ON {tabela}(ultimo_acesso)')
+                # Sessões (hash) que enviaram cada conteúdo - base do cache anônimo
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS cache_sessoes_conteudo (
+                        chave TEXT NOT NULL,
+                        sessao_hash TEXT NOT NULL,
+                        visto_em REAL NOT NULL,
+                        PRIMARY KEY (chave, sessao_hash)
+                    )
+                ''')
+                conn.commit()
+            finally:
+                conn.close()
+        logging.info(f"📦 Cache compartilhado pronto em {CACHE_DB_PATH} (TTL {CACHE_TTL}s, máx {CACHE_MAX_BYTES // (1024 * 1024)}MB)")
+    except Exception as e:
+        logging.error(f"❌ Erro ao inicializar cache compartilhado: {e}")
+        CACHE_DISPONIVEL = False
+
+
+def _obter(tabela, chave, ttl, bruto=False):
+    """
+    Busca uma entrada no cache compartilhado.
+
+    Args:
+        bruto: entrada gravada como bytes (sem JSON nem zlib)
+
+    Returns:
+        dict (bytes se bruto) ou None (ausente, expirada, ilegível ou cache indisponível)
+    """
+    if not CACHE_DISPONIVEL:
+        return None
+    agora = time.time()
+    try:
+        with cache_lock:
+            conn = _conectar()
+            try:
+                row = conn.execute(
+                    f'SELECT dados, criado_em FROM {tabela} WHERE chave = ?', (chave,)
+                ).fetchone()
+                if not row:
+                    return None
+                if agora - row[1] >= ttl:
+                    conn.execute(f'DELETE FROM {tabela} WHERE chave = ?', (chave,))
+                    conn.commit()
+                    return None
+                # LRU: registrar o acesso
+                conn.execute(f'UPDATE {tabela} SET ultimo_acesso = ? WHERE chave = ?', (agora, chave))
+                conn.commit()
+                dados = row[0]
+            finally:
+                conn.close()
+        dados = _fernet.decrypt(dados)
+        return dados if bruto else json.loads(zlib.decompress(dados).decode('utf-8'))
+    except InvalidToken:
+        # Gravada com outra chave (outro worker sem chave compartilhada, ou antes de
+        # um restart): não apagar - pode ser válida para quem gravou; o TTL a remove
+        return None
+    except Exception as e:
+        logging.warning(f"⚠️ Erro ao ler cache compartilhado: {e}")
+        return None
+
+
+def _salvar(tabela, chave, valor, max_bytes, bruto=False):
+    """
+    Grava (comprimido + criptografado) e aplica o orçamento de bytes por LRU.
+
+    Args:
+        bruto: valor já em bytes e comprimido (ex.: PDF) - só criptografado
+
+    Returns:
+        bool: True se gravou
+    """
+    if not CACHE_DISPONIVEL:
+        return False
+    try:
+        if bruto:
+            dados = _fernet.encrypt(valor)
+        else:
+            dados = _fernet.encrypt(zlib.compress(json.dumps(valor, ensure_ascii=False).encode('utf-8')))
+        if len(dados) > max_bytes:
+            return False
+        agora = time.time()
+        with cache_lock:
+            conn = _conectar()
+            try:
+                conn.execute(
+                    f'INSERT OR REPLACE INTO {tabela} (chave, dados, tamanho, criado_em, ultimo_acesso) VALUES (?, ?, ?, ?, ?)',
+                    (chave, dados, len(dados), agora, agora)
+                )
+                total = conn.execute(f'SELECT COALESCE(SUM(tamanho), 0) FROM {tabela}').fetchone()[0]
+                removidos = 0
+                while total > max_bytes:
+                    row = conn.execute(
+                        f'SELECT chave, tamanho FROM {tabela} ORDER BY ultimo_acesso ASC LIMIT 1'
+                    ).fetchone()
+                    if not row:
+                        break
+                    conn.execute(f'DELETE FROM {tabela} WHERE chave = ?', (row[0],))
+                    total -= row[1]
+                    removidos += 1
+                conn.commit()
+            finally:
+                conn.close()
+        if removidos:
+            logging.info(f"🗑️ Cache compartilhado ({tabela}): {removidos} entrada(s) descartada(s) por LRU")
+        return True
+    except Exception as e:
+        logging.warning(f"⚠️ Erro ao gravar cache compartilhado: {e}")
+        return False
+
+
+def _remover(tabela, chave):
+    if not CACHE_DISPONIVEL:
+        return
+    try:
+        with cache_lock:
+            conn = _conectar()
+            try:
+                conn.execute(f'DELETE FROM {tabela} WHERE chave = ?', (chave,))
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        logging.warning(f"⚠️ Erro ao remover do cache compartilhado: {e}")
+
+
+def obter(chave):
+    """Análise em cache (dict) ou None."""
+    return _obter(TABELA_ANALISES, chave, CACHE_TTL)
+
+
+def salvar(chave, valor):
+    _salvar(TABELA_ANALISES, chave, valor, CACHE_MAX_BYTES)
+
+
+def remover(chave):
+    """Invalida uma análise (ex.: re-análise forçada)."""
+    _remover(TABELA_ANALISES, chave)
+
+
+def obter_ocr(chave):
+    """Resultado de OCR de uma página/imagem em cache ({texto, metadados}) ou None."""
+    return _obter(TABELA_OCR, chave, OCR_CACHE_TTL)
+
+
+def salvar_ocr(chave, valor):
+    _salvar(TABELA_OCR, chave, valor, OCR_CACHE_MAX_BYTES)
+
+
+def obter_extracao(chave):
+    """Extração de um arquivo em cache ({texto_original, metadados_arquivo, pre_validacao}) ou None."""
+    return _obter(TABELA_EXTRACAO, chave, EXTRACAO_CACHE_TTL)
+
+
+def salvar_extracao(chave, valor):
+    _salvar(TABELA_EXTRACAO, chave, valor, EXTRACAO_CACHE_MAX_BYTES)
+
+
+def obter_pdf(chave):
+    """Bytes de um PDF gerado ou None."""
+    return _obter(TABELA_PDF, chave, PDF_CACHE_TTL, bruto=True)
+
+
+def salvar_pdf(chave, dados):
+    """Grava os bytes do PDF. Retorna False se não coube ou o cache está indisponível."""
+    return _salvar(TABELA_PDF, chave, dados, PDF_CACHE_MAX_BYTES, bruto=True)
+
+
+def remover_pdf(chave):
+    _remover(TABELA_PDF, chave)
+
+
+def obter_pdf_pendente(chave):
+    """Pedido de PDF ainda não gerado ({texto, metadados, session_id}) ou None."""
+    return _obter(TABELA_PDF_PENDENTE, chave, PDF_CACHE_TTL)
+
+
+def salvar_pdf_pendente(chave, valor):
+    return _salvar(TABELA_PDF_PENDENTE, chave, valor, PDF_CACHE_MAX_BYTES)
+
+
+def registrar_sessao_conteudo(chave, sessao_hash):
+    """
+    Registra que a sessão (hash) enviou o conteúdo `chave` e retorna quantas
+    sessões distintas o enviaram dentro de JANELA_SESSOES.
+    """
+    if not CACHE_DISPONIVEL:
+        return 0
+    agora = time.time()
+    try:
+        with cache_lock:
+            conn = _conectar()
+            try:
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache_sessoes_conteudo (chave, sessao_hash, visto_em) VALUES (?, ?, ?)',
+                    (chave, sessao_hash, agora)
+                )
+                total = conn.execute(
+                    'SELECT COUNT(*) FROM cache_sessoes_conteudo WHERE chave = ? AND visto_em >= ?',
+                    (chave, agora - JANELA_SESSOES)
+                ).fetchone()[0]
+                conn.commit()
+            finally:
+                conn.close()
+        return total
+    except Exception as e:
+        logging.warning(f"⚠️ Erro ao registrar sessão do conteúdo: {e}")
+        return 0
+
+
+def limpar_expirados():
+    """Remove entradas com mais de CACHE_TTL segundos (LGPD). Retorna o total removido."""
+    if not CACHE_DISPONIVEL:
+        return 0
+    try:
+        with cache_lock:
+            conn = _conectar()
+            try:
+                cursor = conn.execute('DELETE FROM cache_analises WHERE criado_em < ?', (time.time() - CACHE_TTL,))
+                deletados = cursor.rowcount
+                conn.execute('DELETE FROM cache_sessoes_conteudo WHERE visto_em < ?', (time.time() - JANELA_SESSOES,))
+                conn.commit()
+            finally:
+                conn.close()
+        if deletados > 0:
+            logging.info(f"🗑️ LGPD: Removidas {deletados} análises expiradas do cache compartilhado")
+        return deletados
+    except Exception as e:
+        logging.warning(f"⚠️ Erro ao limpar cache compartilhado: {e}")
+        return 0
+
+
+def _limpar(tabela, ttl, descricao):
+    if not CACHE_DISPONIVEL:
+        return 0
+    try:
+        with cache_lock:
+            conn = _conectar()
+            try:
+                deletados = conn.execute(f'DELETE FROM {tabela} WHERE criado_em < ?',
+                                         (time.time() - ttl,)).rowcount
+                conn.commit()
+            finally:
+                conn.close()
+        if deletados > 0:
+            logging.info(f"🗑️ LGPD: Removidos {deletados} {descricao} expirados do cache")
+        return deletados
+    except Exception as e:
+        logging.warning(f"⚠️ Erro ao limpar cache ({tabela}): {e}")
+        return 0
+
+
+def limpar_ocr_expirado():
+    """Remove resultados de OCR com mais de OCR_CACHE_TTL segundos (LGPD). Retorna o total removido."""
+    return _limpar(TABELA_OCR, OCR_CACHE_TTL, "resultados de OCR")
+
+
+def limpar_extracao_expirada():
+    """Remove extrações com mais de EXTRACAO_CACHE_TTL segundos (LGPD). Retorna o total removido."""
+    return _limpar(TABELA_EXTRACAO, EXTRACAO_CACHE_TTL, "textos extraídos")
+
+
+def limpar_pdf_expirado():
+    """Remove PDFs (e pedidos de PDF) com mais de PDF_CACHE_TTL segundos (LGPD). Retorna o total removido."""
+    return (_limpar(TABELA_PDF, PDF_CACHE_TTL, "PDFs")
+            + _limpar(TABELA_PDF_PENDENTE, PDF_CACHE_TTL, "pedidos de PDF"))
+
+
+def estatisticas():
+    """Entradas e bytes ocupados (para /health em modo debug)."""
+    if not CACHE_DISPONIVEL:
+        return {"disponivel": False}
+    try:
+        with cache_lock:
+            conn = _conectar()
+            try:
+                entradas, total = conn.execute(
+                    f'SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM {TABELA_ANALISES}'
+                ).fetchone()
+                entradas_ocr, total_ocr = conn.execute(
+                    f'SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM {TABELA_OCR}'
+                ).fetchone()
+                entradas_extracao, total_extracao = conn.execute(
+                    f'SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM {TABELA_EXTRACAO}'
+                ).fetchone()
+                entradas_pdf, total_pdf = conn.execute(
+                    f'SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM {TABELA_PDF}'
+                ).fetchone()
+                pdf_pendentes = conn.execute(f'SELECT COUNT(*) FROM {TABELA_PDF_PENDENTE}').fetchone()[0]
+            finally:
+                conn.close()
+        return {"disponivel": True, "entradas": entradas, "bytes": total, "max_bytes": CACHE_MAX_BYTES, "ttl": CACHE_TTL,
+                "ocr": {"entradas": entradas_ocr, "bytes": total_ocr, "max_bytes": OCR_CACHE_MAX_BYTES, "ttl": OCR_CACHE_TTL},
+                "extracao": {"entradas": entradas_extracao, "bytes": total_extracao,
+                             "max_bytes": EXTRACAO_CACHE_MAX_BYTES, "ttl": EXTRACAO_CACHE_TTL},
+                "pdf": {"entradas": entradas_pdf, "bytes": total_pdf, "max_bytes": PDF_CACHE_MAX_BYTES, "ttl": PDF_CACHE_TTL,
+                        "pendentes": pdf_pendentes}}
+    except Exception as e:
+        return {"disponivel": False, "erro": str(e)[:100]}
+
+
+# Inicializar ao importar módulo
+init_cache()
@@ -268,6 +268,20 @@ def _init_db_inner():
                     ultima_atualizacao TEXT
                 )
             ''')
+            # Migração: tokens (estimados) poupados pela remoção de cabeçalhos/rodapés repetidos
+            cursor.execute('PRAGMA table_info(token_usage_diario)')
+            if 'tokens_economizados' not in {col[1] for col in cursor.fetchall()}:
+                cursor.execute('ALTER TABLE token_usage_diario ADD COLUMN tokens_economizados INTEGER DEFAULT 0')
+
+            # === CACHE ANÔNIMO DE ANÁLISES (contadores diários) ===
+            # Apenas hits/misses agregados - nenhum hash ou conteúdo de documento
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cache_anonimo_diario (
+                    data TEXT PRIMARY KEY,
+                    hits INTEGER DEFAULT 0,
+                    misses INTEGER DEFAULT 0
+                )
+            ''')
 
             # === COFRE CRIPTOGRAFADO DE CPF (LGPD) ===
             # CPFs criptografados com Fernet - apagados diariamente
@@ -1345,6 +1359,19 @@ def get_admin_dashboard_stats():
                 'ips_distintos': row[2] or 0,
             }
 
+            # === Cache anônimo de análises (últimos 30 dias) ===
+            cursor.execute('''
+                SELECT COALESCE(SUM(hits), 0), COALESCE(SUM(misses), 0)
+                FROM cache_anonimo_diario WHERE data >= ?
+            ''', ((datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d'),))
+            row = cursor.fetchone()
+            cache_hits, cache_misses = row[0], row[1]
+            cache_anonimo = {
+                'hits': cache_hits,
+                'misses': cache_misses,
+                'taxa_acerto_pct': round(cache_hits / (cache_hits + cache_misses) * 100, 1) if (cache_hits + cache_misses) else 0,
+            }
+
             return {
                 'gerado_em': datetime.now().isoformat(),
                 'documentos': {
@@ -1379,6 +1406,7 @@ def get_admin_dashboard_stats():
                     'serie_diaria': ips_unicos_por_dia,
                 },
                 'admin_login_24h': login_admin_24h,
+                'cache_anonimo_30d': cache_anonimo,
             }
         except Exception as e:
             logging.error(f"❌ Erro ao montar dashboard admin: {e}")
@@ -1485,7 +1513,7 @@ def get_auditoria_ip(limite=100, pagina=1, filtro_ip=None, filtro_tipo=None, fil
 # === FUNÇÕES DE CONTROLE DE TOKENS ===
 # ==========================================
 
-def registrar_uso_tokens(tokens_input=0, tokens_output=0):
+def registrar_uso_tokens(tokens_input=0, tokens_output=0, tokens_economizados=0, contar_requisicao=True):
     """
     Registra tokens consumidos na requisição atual.
     Incrementa contadores diários de input, output e total.
@@ -1493,11 +1521,17 @@ def registrar_uso_tokens(tokens_input=0, tokens_output=0):
     Args:
         tokens_input: Tokens consumidos no prompt (input)
         tokens_output: Tokens gerados na resposta (output)
+        tokens_economizados: Tokens estimados que deixaram de ir no prompt
+                             (cabeçalhos/rodapés repetidos removidos do PDF)
+        contar_requisicao: Se False, soma só os tokens, sem incrementar
+                           requisicoes (chamadas auxiliares do map-reduce,
+                           que fazem parte da análise de um único documento)
 
     Returns:
         Dict com tokens_total_hoje e limite_atingido
     """
     tokens_total = tokens_input + tokens_output
+    incremento_requisicoes = 1 if contar_requisicao else 0
     hoje = datetime.now().strftime('%Y-%m-%d')
 
     with db_lock:
@@ -1506,17 +1540,18 @@ def registrar_uso_tokens(tokens_input=0, tokens_output=0):
             cursor = conn.cursor()
 
             cursor.execute('''
-                INSERT INTO token_usage_diario (data, tokens_input, tokens_output, tokens_total, requisicoes, ultima_atualizacao)
-                VALUES (?, ?, ?, ?, 1, ?)
+                INSERT INTO token_usage_diario (data, tokens_input, tokens_output, tokens_total, requisicoes, tokens_economizados, ultima_atualizacao)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
                 ON CONFLICT(data) DO UPDATE SET
                     tokens_input = tokens_input + ?,
                     tokens_output = tokens_output + ?,
                     tokens_total = tokens_total + ?,
-                    requisicoes = requisicoes + 1,
+                    requisicoes = requisicoes + ?,
+                    tokens_economizados = COALESCE(tokens_economizados, 0) + ?,
                     ultima_atualizacao = ?
             ''', (
-                hoje, tokens_input, tokens_output, tokens_total, datetime.now().isoformat(),
-                tokens_input, tokens_output, tokens_total, datetime.now().isoformat()
+                hoje, tokens_input, tokens_output, tokens_total, incremento_requisicoes, tokens_economizados, datetime.now().isoformat(),
+                tokens_input, tokens_output, tokens_total, incremento_requisicoes, tokens_economizados, datetime.now().isoformat()
             ))
 
             # Buscar total atualizado
@@ -1588,7 +1623,7 @@ def get_uso_tokens_hoje():
         try:
             cursor = conn.cursor()
 
-            cursor.execute('SELECT tokens_input, tokens_output, tokens_total, requisicoes FROM token_usage_diario WHERE data = ?', (hoje,))
+            cursor.execute('SELECT tokens_input, tokens_output, tokens_total, requisicoes, tokens_economizados FROM token_usage_diario WHERE data = ?', (hoje,))
             row = cursor.fetchone()
         finally:
             conn.close()
@@ -1600,6 +1635,7 @@ def get_uso_tokens_hoje():
             "tokens_output": row[1],
             "tokens_total": row[2],
             "requisicoes": row[3],
+            "tokens_economizados": row[4] or 0,
             "limite_diario": DAILY_TOKEN_LIMIT,
             "percentual_uso": min(100, int((row[2] / DAILY_TOKEN_LIMIT) * 100))
         }
@@ -1609,6 +1645,7 @@ def get_uso_tokens_hoje():
         "tokens_output": 0,
         "tokens_total": 0,
         "requisicoes": 0,
+        "tokens_economizados": 0,
         "limite_diario": DAILY_TOKEN_LIMIT,
         "percentual_uso": 0
     }
@@ -1637,6 +1674,24 @@ def limpar_tokens_antigos(dias=7):
         return deletados
 
 
+def registrar_cache_anonimo(hit):
+    """
+    Incrementa o contador diário de hits/misses do cache anônimo de análises.
+    LGPD: apenas contagens agregadas.
+    """
+    hoje = datetime.now().strftime('%Y-%m-%d')
+    coluna = 'hits' if hit else 'misses'
+    with db_lock:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('INSERT OR IGNORE INTO cache_anonimo_diario (data, hits, misses) VALUES (?, 0, 0)', (hoje,))
+            cursor.execute(f'UPDATE cache_anonimo_diario SET {coluna} = {coluna} + 1 WHERE data = ?', (hoje,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
 # ==========================================
 # === FUNÇÕES DO COFRE DE CPF (LGPD) ===
 # ==========================================
@@ -1965,6 +2020,12 @@ def limpar_estatisticas_antigas():
             ''')
 
             deletados = cursor.rowcount
+
+            cursor.execute('''
+                DELETE FROM cache_anonimo_diario
+                WHERE date(data) < date('now', '-30 days')
+            ''')
+            deletados += cursor.rowcount
             conn.commit()
         finally:
             conn.close()
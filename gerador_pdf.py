@@ -12,11 +12,13 @@ from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfdoc
 from reportlab.lib.utils import ImageReader
 import os
 import io
 import math
 import logging
+import threading
 from datetime import datetime
 
 _DEBUG_MODE = os.getenv('FLASK_ENV', 'production').lower() != 'production'
@@ -37,6 +39,47 @@ JUS_VINHO = colors.HexColor('#6d2932')
 JUS_AZUL = colors.HexColor('#2c4f5e')
 JUS_DOURADO = colors.HexColor('#b8963c')
 
+# ============= CACHE DE LOGOS =============
+# Os PNGs de static/ são bem maiores que o desenhado (avatar.png: 1024px para
+# 1,2cm): passar o caminho ao ReportLab faz cada PDF decodificar e embutir o
+# arquivo inteiro. Cada logo é lido e reduzido uma vez por processo.
+
+# Resolução dos logos no PDF, no maior tamanho em que são desenhados
+PDF_LOGO_DPI = int(os.getenv("PDF_LOGO_DPI", "300"))
+
+_logos = {}
+_logos_lock = threading.Lock()
+
+
+def logo_pdf(nome, lado_max):
+    """
+    ImageReader de um logo de static/, reduzido para lado_max (pontos) a PDF_LOGO_DPI.
+
+    Returns:
+        ImageReader ou None se o arquivo não existir ou não puder ser lido
+    """
+    chave = (nome, lado_max)
+    with _logos_lock:
+        if chave in _logos:
+            return _logos[chave]
+        caminho = os.path.join(_BASE_DIR, 'static', nome)
+        leitor = None
+        if os.path.exists(caminho):
+            try:
+                from PIL import Image as PILImage
+                with PILImage.open(caminho) as original:
+                    img = original.convert('RGBA' if 'A' in original.getbands() or 'transparency' in original.info else 'RGB')
+                lado_px = math.ceil(lado_max / 72 * PDF_LOGO_DPI)
+                if max(img.size) > lado_px:
+                    img.thumbnail((lado_px, lado_px), PILImage.LANCZOS)
+                leitor = ImageReader(img)
+                leitor.getRGBData()  # decodifica já (o ReportLab guarda no leitor)
+                logging.info(f"🖼️ Logo {nome} em cache: {original.size[0]}x{original.size[1]} -> {img.size[0]}x{img.size[1]}")
+            except Exception as e:
+                logging.warning(f"⚠️ Não foi possível carregar {nome}: {e}")
+        _logos[chave] = leitor
+        return leitor
+
 def registrar_fontes():
     """Registra fontes personalizadas se disponíveis"""
     try:
@@ -62,27 +105,61 @@ def registrar_fontes():
     return False
 
 class HeaderFooterCanvas(canvas.Canvas):
-    """Canvas customizado com cabeçalho e rodapé"""
-    
+    """Canvas customizado com cabeçalho e rodapé
+
+    Marca d'água, cabeçalho e rodapé fixos formam uma "moldura" desenhada uma vez
+    por documento como Form XObject: cada página só referencia a moldura (um
+    operador Do) e desenha o que muda - número da página e validação na última.
+
+    "Página X de Y" exige o total, conhecido só no fim. Em vez de guardar o
+    estado do canvas de todas as páginas até o save(), cada página é emitida ao
+    terminar e referencia um form de rodapé próprio, definido no save() (o PDF
+    aceita XObjects definidos depois de usados). A memória por página fica em
+    alguns bytes, mesmo em simplificações e glossários de 30+ páginas.
+    """
+
+    NOME_MOLDURA = "moldura_pagina"
+
     def __init__(self, *args, **kwargs):
         self.metadados = kwargs.pop('metadados', {})
         canvas.Canvas.__init__(self, *args, **kwargs)
-        self.pages = []
-        
+        self.total_paginas = 0
+
     def showPage(self):
-        self.pages.append(dict(self.__dict__))
-        self._startPage()
-        
+        self.total_paginas += 1
+        self.draw_header_footer(self.total_paginas)
+        canvas.Canvas.showPage(self)
+
     def save(self):
-        page_count = len(self.pages)
-        for page_num, page_dict in enumerate(self.pages, 1):
-            self.__dict__.update(page_dict)
-            self.draw_header_footer(page_num, page_count)
-            canvas.Canvas.showPage(self)
+        if len(self._code):
+            self.showPage()
+        self.criar_form(self.NOME_MOLDURA, self.desenhar_moldura)
+        for page_num in range(1, self.total_paginas + 1):
+            self.criar_form(self.nome_rodape(page_num), self.desenhar_rodape, page_num, self.total_paginas)
         canvas.Canvas.save(self)
-        
-    def draw_header_footer(self, page_num, page_count):
-        """Desenha cabeçalho, rodapé e marca d'água em cada página"""
+
+    @staticmethod
+    def nome_rodape(page_num):
+        return f"rodape_pagina_{page_num}"
+
+    def criar_form(self, nome, desenhar, *args):
+        """Grava o que desenhar(*args) produz como Form XObject"""
+        self.beginForm(nome)
+        desenhar(*args)
+        # O PDFFormXObject do ReportLab não declara ExtGState nos recursos do form
+        # (as transparências da marca d'água seriam ignoradas): recursos montados
+        # aqui, como o ReportLab faz para as páginas
+        recursos = pdfdoc.PDFResourceDictionary()
+        recursos.basicFonts()
+        recursos.allProcs()
+        if self._formsinuse:
+            recursos.XObject = self._doc.xobjDict(self._formsinuse)
+        recursos.ExtGState = self._extgstate.getState() or {}
+        recursos.setColorSpace(self._colorsUsed)
+        self.endForm(Resources=recursos)
+
+    def desenhar_moldura(self):
+        """Conteúdo igual em todas as páginas do documento"""
         page_width, page_height = A4
 
         # MARCA D'ÁGUA DIAGONAL - Aviso de finalidade informativa
@@ -112,8 +189,10 @@ class HeaderFooterCanvas(canvas.Canvas):
         self.restoreState()
 
         # MARCA D'ÁGUA TJTO - Múltiplas miniaturas da logo para dificultar falsificação
-        logo_tjto_path = os.path.join(_BASE_DIR, 'static', 'logotjto.png')
-        if os.path.exists(logo_tjto_path):
+        # Um único leitor (no maior tamanho) para as miniaturas e o logo central:
+        # a imagem é embutida uma vez só no PDF
+        logo_tjto = logo_pdf('logotjto.png', 6 * cm)
+        if logo_tjto:
             try:
                 self.saveState()
 
@@ -154,7 +233,7 @@ class HeaderFooterCanvas(canvas.Canvas):
                         self.translate(-tamanho / 2, -tamanho / 2)
 
                         self.drawImage(
-                            logo_tjto_path,
+                            logo_tjto,
                             0, 0,
                             width=tamanho, height=tamanho,
                             preserveAspectRatio=True,
@@ -170,7 +249,7 @@ class HeaderFooterCanvas(canvas.Canvas):
                 x_center = (page_width - logo_central) / 2
                 y_center = (page_height - logo_central) / 2
                 self.drawImage(
-                    logo_tjto_path,
+                    logo_tjto,
                     x_center, y_center,
                     width=logo_central, height=logo_central,
                     preserveAspectRatio=True,
@@ -194,10 +273,10 @@ class HeaderFooterCanvas(canvas.Canvas):
         self.rect(2*page_width/3, page_height - 1.5*cm, page_width/3, 0.3*cm, fill=True, stroke=False)
 
         # Logo JUS (esquerda)
-        logo_jus_path = os.path.join(_BASE_DIR, 'static', 'avatar.png')
-        if os.path.exists(logo_jus_path):
+        logo_jus = logo_pdf('avatar.png', 1.2*cm)
+        if logo_jus:
             try:
-                self.drawImage(logo_jus_path, 1.5*cm, page_height - 2.8*cm,
+                self.drawImage(logo_jus, 1.5*cm, page_height - 2.8*cm,
                               width=1.2*cm, height=1.2*cm,
                               preserveAspectRatio=True, mask='auto')
             except Exception as e:
@@ -215,10 +294,10 @@ class HeaderFooterCanvas(canvas.Canvas):
                               "Documento em Linguagem Simples")
 
         # Logo INOVASSOL (direita)
-        logo_inovassol_path = os.path.join(_BASE_DIR, 'static', 'inovassol.png')
-        if os.path.exists(logo_inovassol_path):
+        logo_inovassol = logo_pdf('inovassol.png', 1.2*cm)
+        if logo_inovassol:
             try:
-                self.drawImage(logo_inovassol_path, page_width - 2.7*cm, page_height - 2.8*cm,
+                self.drawImage(logo_inovassol, page_width - 2.7*cm, page_height - 2.8*cm,
                               width=1.2*cm, height=1.2*cm,
                               preserveAspectRatio=True, mask='auto')
             except Exception as e:
@@ -234,7 +313,7 @@ class HeaderFooterCanvas(canvas.Canvas):
         self.setFont('Helvetica', 7)
         self.setFillColor(colors.grey)
         
-        # Data de geração
+        # Data de geração (uma para o documento inteiro)
         data_geracao = datetime.now().strftime("%d/%m/%Y às %H:%M")
         self.drawString(1.5*cm, 1.8*cm, f"Gerado em: {data_geracao}")
         
@@ -246,10 +325,6 @@ class HeaderFooterCanvas(canvas.Canvas):
         tipo_doc = self.metadados.get('tipo_documento', 'DOCUMENTO')
         self.drawString(1.5*cm, 1.0*cm, f"Tipo: {tipo_doc.upper()}")
         
-        # Número da página (direita)
-        self.setFont('Helvetica', 8)
-        self.drawRightString(page_width - 1.5*cm, 1.5*cm, f"Página {page_num} de {page_count}")
-        
         # Linha separadora rodapé
         self.setStrokeColor(colors.lightgrey)
         self.line(1.5*cm, 2.2*cm, page_width - 1.5*cm, 2.2*cm)
@@ -269,6 +344,26 @@ class HeaderFooterCanvas(canvas.Canvas):
         inovassol_text = "Desenvolvido pelo INOVASSOL - Centro de Inovacao do Poder Judiciario do Estado do Tocantins"
         self.drawCentredString(page_width/2, 0.2*cm, inovassol_text)
 
+        self.restoreState()
+
+    def draw_header_footer(self, page_num):
+        """Aplica a moldura e o rodapé da página (forms definidos no save)"""
+        self.saveState()
+        self.doForm(self.NOME_MOLDURA)
+        self.doForm(self.nome_rodape(page_num))
+        self.restoreState()
+
+    def desenhar_rodape(self, page_num, page_count):
+        """O que varia por página: número e, na última, a validação"""
+        page_width, page_height = A4
+
+        self.saveState()
+
+        # Número da página (direita)
+        self.setFont('Helvetica', 8)
+        self.setFillColor(colors.grey)
+        self.drawRightString(page_width - 1.5*cm, 1.5*cm, f"Página {page_num} de {page_count}")
+
         # QR CODE DE VALIDAÇÃO E CÓDIGO (apenas na última página)
         doc_id = self.metadados.get('doc_id')
         validation_url = self.metadados.get('validation_url')
@@ -524,13 +619,15 @@ def gerar_pdf_simplificado(texto, metadados=None, output_path='documento_simplif
     Args:
         texto: Texto completo para incluir no PDF
         metadados: Dicionário com informações do documento
-        output_path: Caminho do arquivo de saída
+        output_path: Caminho do arquivo de saída ou arquivo aberto (ex.: io.BytesIO)
     """
     
     if metadados is None:
         metadados = {}
+    em_memoria = hasattr(output_path, 'write')
+    destino = "memória" if em_memoria else output_path
     
-    logging.info(f"📄 Gerando PDF: {output_path}")
+    logging.info(f"📄 Gerando PDF: {destino}")
     logging.info(f"📏 Tamanho do texto: {len(texto)} caracteres")
     
     try:
@@ -730,8 +827,9 @@ def gerar_pdf_simplificado(texto, metadados=None, output_path='documento_simplif
             )
         )
         
-        logging.info(f"✅ PDF gerado com sucesso: {output_path}")
-        logging.info(f"📦 Tamanho do arquivo: {os.path.getsize(output_path) / 1024:.1f} KB")
+        tamanho = output_path.tell() if em_memoria else os.path.getsize(output_path)
+        logging.info(f"✅ PDF gerado com sucesso: {destino}")
+        logging.info(f"📦 Tamanho do arquivo: {tamanho / 1024:.1f} KB")
         
         return output_path
         
@@ -739,8 +837,40 @@ def gerar_pdf_simplificado(texto, metadados=None, output_path='documento_simplif
         logging.error(f"❌ Erro ao gerar PDF: {e}", exc_info=_DEBUG_MODE)
         raise
 
+# ============= BENCHMARK =============
+
+def benchmark(blocos=(1, 40, 120), repeticoes=2):
+    """Tempo e tamanho do PDF gerado por número de páginas (python gerador_pdf.py --benchmark)"""
+    import time
+    import tempfile
+
+    paragrafo = "O juiz decidiu que a empresa deve pagar uma parte do que vocês pediram, com correção e juros. " * 12
+    resultados = []
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, "benchmark.pdf")
+        for n in blocos:
+            texto = f"📑 **O QUE ESTÁ ACONTECENDO**\n\n{paragrafo}\n\n" * n
+            tempos = []
+            for _ in range(repeticoes):
+                inicio = time.perf_counter()
+                gerar_pdf_simplificado(texto, {"doc_id": "BENCHMARK", "validation_url": "https://exemplo"}, caminho)
+                tempos.append((time.perf_counter() - inicio) * 1000)
+            with open(caminho, "rb") as f:
+                paginas = f.read().count(b"/Type /Page\n")
+            resultados.append({"paginas": paginas, "min_ms": round(min(tempos)), "kb": round(os.path.getsize(caminho) / 1024)})
+    return resultados
+
+
 # Teste standalone
 if __name__ == "__main__":
+    import sys
+
+    if "--benchmark" in sys.argv:
+        logging.disable(logging.WARNING)
+        for r in benchmark():
+            print(f"{r['paginas']:4d} páginas: {r['min_ms']:6d} ms   {r['kb']:6d} KB")
+        sys.exit(0)
+
     texto_teste = """
 📊 CONSEGUIU PARTE DO QUE PEDIU
 
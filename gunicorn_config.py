@@ -5,7 +5,9 @@ import multiprocessing
 bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
 
 # Workers
-workers = 2  # REDUZIDO - 2 workers é suficiente para evitar OOM
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))  # REDUZIDO - 2 workers é suficiente para evitar OOM
+# O app (preload) divide os núcleos do OCR local entre os workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
 worker_class = "sync"
 worker_connections = 100
 max_requests = 100  # Reciclar worker após 100 requests
@@ -36,9 +38,29 @@ tmp_upload_dir = None
 
 # Memory management
 preload_app = True  # Pre-load para compartilhar memória entre workers
+if preload_app:
+    # O app é importado no master: as threads de limpeza ficam para o post_fork
+    os.environ["LIMPEZA_NO_POST_FORK"] = "true"
 worker_tmp_dir = "/dev/shm"  # Usar RAM para arquivos temporários
 
 # Limites
 limit_request_line = 4096
 limit_request_fields = 100
-limit_request_field_size = 8190
\ No newline at end of file
+limit_request_field_size = 8190
+
+# Serviço de OCR compartilhado (ocr_servico.py): criado pelo master depois do
+# preload do app e antes dos workers, que herdam o endereço e a chave do socket
+def when_ready(server):
+    import ocr_servico
+    ocr_servico.iniciar_servico()
+
+
+# Threads de limpeza LGPD de cada worker (o fork não copia as threads do master)
+def post_fork(server, worker):
+    import app
+    app.iniciar_threads_limpeza()
+
+
+def on_exit(server):
+    import ocr_servico
+    ocr_servico.encerrar_servico()
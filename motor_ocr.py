@@ -0,0 +1,220 @@
+"""
+Motor de OCR (Tesseract) com handles persistentes por processo
+
+O pytesseract grava a imagem em arquivo temporário, abre o binário `tesseract`
+e recarrega o traineddata (por+eng) a cada chamada. Com o tesserocr (bindings
+da libtesseract) a API é inicializada uma vez por processo e configuração e
+reutilizada em todas as páginas. Sem tesserocr, cai no pytesseract.
+
+Benchmark:  python motor_ocr.py [imagem1.png imagem2.png ...]
+"""
+import os
+import time
+import queue
+import logging
+import threading
+
+import pytesseract
+
+# Bindings nativos da libtesseract (opcional - exige libtesseract-dev no build)
+try:
+    import tesserocr
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
+# === CONFIGURAÇÕES ===
+# "auto" (tesserocr se disponível), "tesserocr" ou "pytesseract"
+OCR_MOTOR = os.getenv("OCR_MOTOR", "auto").lower()
+
+# Handles ociosos por configuração (lang, psm, oem). A PyTessBaseAPI não é
+# thread-safe: cada chamada pega um handle exclusivo e devolve ao terminar.
+_handles = {}
+_handles_pid = None
+handles_lock = threading.Lock()
+
+
+def motor_ativo():
+    """Nome do motor usado por reconhecer_texto()."""
+    if OCR_MOTOR == "pytesseract" or not TESSEROCR_AVAILABLE:
+        return "pytesseract"
+    return "tesserocr"
+
+
+def _fila_handles(lang, psm, oem):
+    """Fila de handles ociosos desta configuração, no processo atual (handles
+    criados antes de um fork não são reaproveitados no filho)."""
+    global _handles, _handles_pid
+    with handles_lock:
+        if _handles_pid != os.getpid():
+            _handles = {}
+            _handles_pid = os.getpid()
+        return _handles.setdefault((lang, psm, oem), queue.LifoQueue())
+
+
+def _obter_handle(lang, psm, oem):
+    fila = _fila_handles(lang, psm, oem)
+    try:
+        return fila, fila.get_nowait()
+    except queue.Empty:
+        inicio = time.time()
+        api = tesserocr.PyTessBaseAPI(lang=lang, psm=psm, oem=oem)
+        logging.info(f"🔠 Handle tesserocr inicializado ({lang}, psm={psm}) em {time.time() - inicio:.2f}s (pid {os.getpid()})")
+        return fila, api
+
+
+def _reconhecer_tesserocr(img, lang, psm, oem, timeout, extrair=None):
+    fila, api = _obter_handle(lang, psm, oem)
+    try:
+        api.SetImage(img)
+        try:
+            concluido = api.Recognize(timeout=int(timeout * 1000))
+        except TypeError:
+            # tesserocr < 2.5 não aceita timeout
+            concluido = api.Recognize()
+        if not concluido:
+            # Mesmo contrato do pytesseract: RuntimeError em timeout
+            raise RuntimeError("Tesseract process timeout")
+        return extrair(api) if extrair else api.GetUTF8Text()
+    finally:
+        api.Clear()
+        fila.put(api)
+
+
+def _palavras_tesserocr(api):
+    """Palavras do último Recognize, numerando blocos/parágrafos/linhas como o image_to_data"""
+    RIL = tesserocr.RIL
+    palavras = []
+    bloco = paragrafo = linha = 0
+    iterador = api.GetIterator()
+    if iterador is None:
+        return palavras
+    for r in tesserocr.iterate_level(iterador, RIL.WORD):
+        if r.IsAtBeginningOf(RIL.BLOCK):
+            bloco += 1
+        if r.IsAtBeginningOf(RIL.PARA):
+            paragrafo += 1
+        if r.IsAtBeginningOf(RIL.TEXTLINE):
+            linha += 1
+        texto = (r.GetUTF8Text(RIL.WORD) or "").strip()
+        caixa = r.BoundingBox(RIL.WORD)
+        if not texto or caixa is None:
+            continue
+        x0, y0, x1, y1 = caixa
+        palavras.append({"texto": texto, "conf": float(r.Confidence(RIL.WORD)), "bloco": bloco,
+                         "paragrafo": paragrafo, "linha": linha, "x": x0, "y": y0, "w": x1 - x0, "h": y1 - y0})
+    return palavras
+
+
+def reconhecer_texto(img, lang="por+eng", psm=3, oem=3, timeout=45):
+    """
+    OCR de uma imagem PIL com o motor ativo.
+
+    Raises:
+        RuntimeError: tempo limite excedido (igual ao pytesseract)
+    """
+    if motor_ativo() == "tesserocr":
+        return _reconhecer_tesserocr(img, lang, psm, oem, timeout)
+    config = f'--oem {oem} --psm {psm} -l {lang}'
+    return pytesseract.image_to_string(img, config=config, timeout=timeout)
+
+
+def reconhecer_palavras(img, lang="por+eng", psm=3, oem=3, timeout=45):
+    """
+    OCR com confiança e posição por palavra (equivalente ao image_to_data).
+
+    Returns:
+        list[dict]: texto, conf (0-100), bloco, paragrafo, linha, x, y, w, h - na ordem de leitura
+
+    Raises:
+        RuntimeError: tempo limite excedido
+    """
+    if motor_ativo() == "tesserocr":
+        return _reconhecer_tesserocr(img, lang, psm, oem, timeout, extrair=_palavras_tesserocr)
+    config = f'--oem {oem} --psm {psm} -l {lang}'
+    dados = pytesseract.image_to_data(img, config=config, timeout=timeout, output_type=pytesseract.Output.DICT)
+    palavras = []
+    for i, texto in enumerate(dados["text"]):
+        texto = (texto or "").strip()
+        if not texto or float(dados["conf"][i]) < 0:
+            continue
+        palavras.append({"texto": texto, "conf": float(dados["conf"][i]), "bloco": dados["block_num"][i],
+                         "paragrafo": dados["par_num"][i], "linha": dados["line_num"][i],
+                         "x": dados["left"][i], "y": dados["top"][i],
+                         "w": dados["width"][i], "h": dados["height"][i]})
+    return palavras
+
+
+def info_motor():
+    """
+    Versão e idiomas do Tesseract pelo motor ativo.
+
+    Returns:
+        tuple: (motor, versao, idiomas) - levanta exceção se indisponível
+    """
+    if motor_ativo() == "tesserocr":
+        _, idiomas = tesserocr.get_languages()
+        return "tesserocr", f"tesseract {tesserocr.tesseract_version().split()[1]}", list(idiomas)
+    versao = str(pytesseract.get_tesseract_version())
+    return "pytesseract", f"tesseract {versao}", pytesseract.get_languages(config='')
+
+
+# ============= BENCHMARK =============
+
+def _imagens_fixture():
+    """Páginas A4 sintéticas a 300 DPI (texto corrido), quando nenhuma imagem é informada."""
+    import fitz
+    from PIL import Image
+
+    imagens = []
+    with fitz.open() as doc:
+        for n in range(3):
+            page = doc.new_page()
+            for linha in range(40):
+                page.insert_text((60, 70 + linha * 18),
+                                 f"Página {n + 1}, linha {linha + 1}: o réu deverá comparecer à audiência no prazo de 15 dias.",
+                                 fontsize=10)
+            pix = page.get_pixmap(dpi=300, colorspace=fitz.csGRAY)
+            imagens.append(Image.frombytes("L", (pix.width, pix.height), pix.samples))
+    return imagens
+
+
+def benchmark(imagens, repeticoes=3, lang="por+eng"):
+    """Latência por página de cada motor disponível (ms: média e mínima)."""
+    global OCR_MOTOR
+    motores = ["pytesseract"] + (["tesserocr"] if TESSEROCR_AVAILABLE else [])
+    resultados = {}
+    original = OCR_MOTOR
+    try:
+        for motor in motores:
+            OCR_MOTOR = motor
+            reconhecer_texto(imagens[0], lang=lang)  # aquecimento (inicializa o handle)
+            tempos = []
+            for _ in range(repeticoes):
+                for img in imagens:
+                    inicio = time.perf_counter()
+                    reconhecer_texto(img, lang=lang)
+                    tempos.append((time.perf_counter() - inicio) * 1000)
+            resultados[motor] = {"media_ms": round(sum(tempos) / len(tempos)), "min_ms": round(min(tempos)),
+                                 "paginas": len(tempos)}
+    finally:
+        OCR_MOTOR = original
+    return resultados
+
+
+if __name__ == "__main__":
+    import sys
+    from PIL import Image
+
+    logging.basicConfig(level=logging.INFO)
+    imagens = [Image.open(caminho) for caminho in sys.argv[1:]] or _imagens_fixture()
+    try:
+        motor, versao, idiomas = info_motor()
+    except Exception as e:
+        sys.exit(f"Tesseract indisponível: {e}")
+    lang = "por+eng" if "por" in idiomas else "eng"
+    print(f"Motor ativo: {motor} ({versao}), idiomas: {lang}")
+    if not TESSEROCR_AVAILABLE:
+        print("tesserocr não instalado - medindo só o pytesseract")
+    for nome, r in benchmark(imagens, lang=lang).items():
+        print(f"{nome:12s} média {r['media_ms']:6d} ms/página   mínima {r['min_ms']:6d} ms   ({r['paginas']} páginas)")
@@ -0,0 +1,351 @@
+"""
+Serviço de OCR compartilhado entre os workers do gunicorn
+
+Sem ele cada worker roda OCR no próprio processo: dois uploads escaneados
+simultâneos ocupam todas as CPUs e atrasam as requisições do outro worker
+(que só esperam o Gemini). O master do gunicorn (hook when_ready) cria um
+processo de serviço com UM pool de OCR - o limite de paralelismo passa a ser
+global - e os workers enviam as tarefas por socket Unix.
+
+Cada tarefa tem prazo: se expirar ainda na fila, não é executada. Fila e
+tempos de espera ficam disponíveis em estatisticas() (/health em modo debug).
+Se o serviço não estiver ativo (servidor de desenvolvimento) ou cair, o app
+volta a fazer OCR no próprio processo.
+"""
+import os
+import time
+import signal
+import logging
+import secrets
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+# === CONFIGURAÇÕES ===
+OCR_SERVICO_ENABLED = os.getenv("OCR_SERVICO_ENABLED", "true").lower() == "true"
+# Mesmo parâmetro do pool local; com o serviço ativo o limite vale para o servidor todo
+OCR_SERVICO_PARALELO = int(os.getenv("OCR_MAX_PROCESSOS", str(min(4, os.cpu_count() or 1))))
+# Prazo padrão de uma tarefa (fila + execução), abaixo do timeout de 120s do gunicorn
+OCR_SERVICO_PRAZO = int(os.getenv("OCR_SERVICO_PRAZO", "100"))
+_DIR_PADRAO = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+OCR_SERVICO_SOCKET = os.getenv("OCR_SERVICO_SOCKET", os.path.join(_DIR_PADRAO, "entenda_aqui_ocr.sock"))
+
+# Chave de autenticação do socket: gerada no master e herdada pelos workers (fork)
+_authkey = secrets.token_bytes(32)
+_servico_pid = None
+
+# Tarefas executáveis pelo serviço: nome -> função (registradas pelo app no import)
+_tarefas = {}
+
+
+class ServicoOcrIndisponivel(ConnectionError):
+    """Serviço não iniciado, morto ou inacessível - o chamador faz OCR localmente."""
+
+
+class PrazoOcrExpirado(TimeoutError):
+    """O serviço não respondeu dentro do prazo do lote. Não é falha do serviço
+    (está sobrecarregado): refazer o OCR no worker só dobraria a carga."""
+
+
+def registrar_tarefa(nome, funcao):
+    """Registra uma função de OCR (precisa ser de nível de módulo - vai para o pool por referência)."""
+    _tarefas[nome] = funcao
+
+
+def disponivel():
+    return _servico_pid is not None
+
+
+# ============= LADO DO SERVIÇO =============
+
+_em_execucao = None  # multiprocessing.Value compartilhado com os processos do pool
+
+
+def _vigiar_pai(pid_pai):
+    """Encerra o processo atual se o pai morrer (sem isso viram órfãos)."""
+    def vigiar():
+        while os.getppid() == pid_pai:
+            time.sleep(2)
+        os._exit(0)
+    threading.Thread(target=vigiar, daemon=True).start()
+
+
+def _contexto_pool():
+    """forkserver com os módulos das tarefas pré-carregados: o serviço tem uma
+    thread por conexão, e um fork dele com um lock (logging, fila) em uso por
+    outra thread deixaria o processo do pool travado."""
+    contexto = multiprocessing.get_context("forkserver")
+    contexto.set_forkserver_preload(sorted({funcao.__module__ for funcao in _tarefas.values()}))
+    return contexto
+
+
+def _iniciar_processo_pool(contador):
+    global _em_execucao
+    _em_execucao = contador
+    logging.basicConfig(level=logging.INFO)  # o forkserver não herda a configuração
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _vigiar_pai(os.getppid())
+
+
+def _executar_com_prazo(funcao, args, enviado_em, prazo):
+    """Roda no processo do pool. Tarefas vencidas na fila são descartadas sem executar."""
+    inicio = time.time()
+    if inicio > prazo:
+        raise TimeoutError("prazo da tarefa de OCR expirou na fila")
+    with _em_execucao.get_lock():
+        _em_execucao.value += 1
+    try:
+        return inicio - enviado_em, funcao(*args)
+    finally:
+        with _em_execucao.get_lock():
+            _em_execucao.value -= 1
+
+
+class _Servico:
+    def __init__(self, paralelo):
+        self.paralelo = paralelo
+        self.lock = threading.Lock()
+        self.contexto = _contexto_pool()
+        # Criado no mesmo contexto do pool: o semáforo de um Value "fork" não chega ao forkserver
+        self.em_execucao = self.contexto.Value('i', 0)
+        self.pool = None
+        self.pendentes = 0
+        self.pico_pendentes = 0
+        self.concluidas = 0
+        self.erros = 0
+        self.expiradas = 0
+        self.espera_total = 0.0
+        self.iniciado_em = time.time()
+
+    def obter_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.paralelo,
+                    mp_context=self.contexto,
+                    initializer=_iniciar_processo_pool,
+                    initargs=(self.em_execucao,)
+                )
+            return self.pool
+
+    def descartar_pool(self, pool):
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def estatisticas(self):
+        with self.lock:
+            em_execucao = self.em_execucao.value
+            return {
+                "ativo": True,
+                "paralelo": self.paralelo,
+                "pendentes": self.pendentes,
+                "em_execucao": em_execucao,
+                "na_fila": max(0, self.pendentes - em_execucao),
+                "pico_pendentes": self.pico_pendentes,
+                "concluidas": self.concluidas,
+                "erros": self.erros,
+                "expiradas": self.expiradas,
+                "espera_media_ms": int(self.espera_total / self.concluidas * 1000) if self.concluidas else 0,
+                "uptime_s": int(time.time() - self.iniciado_em)
+            }
+
+    def executar_lote(self, nome, lista_args, prazo):
+        """Submete todas as tarefas ao pool e devolve, na ordem, ("ok", valor) ou ("erro", tipo, msg)."""
+        funcao = _tarefas.get(nome)
+        if funcao is None:
+            return [("erro", "ValueError", f"tarefa de OCR desconhecida: {nome}")] * len(lista_args)
+
+        pool = self.obter_pool()
+        enviado_em = time.time()
+        with self.lock:
+            self.pendentes += len(lista_args)
+            self.pico_pendentes = max(self.pico_pendentes, self.pendentes)
+
+        futures = [pool.submit(_executar_com_prazo, funcao, args, enviado_em, prazo) for args in lista_args]
+        respostas = []
+        for future in futures:
+            try:
+                espera, valor = future.result(timeout=max(0.0, prazo - time.time()))
+                respostas.append(("ok", valor))
+                with self.lock:
+                    self.concluidas += 1
+                    self.espera_total += espera
+            except (FuturesTimeout, TimeoutError):
+                future.cancel()
+                respostas.append(("erro", "TimeoutError", "prazo da tarefa de OCR expirado"))
+                with self.lock:
+                    self.expiradas += 1
+            except BrokenProcessPool as e:
+                self.descartar_pool(pool)
+                respostas.append(("erro", "RuntimeError", f"pool de OCR quebrado: {e}"))
+                with self.lock:
+                    self.erros += 1
+            except Exception as e:
+                respostas.append(("erro", type(e).__name__, str(e)))
+                with self.lock:
+                    self.erros += 1
+            finally:
+                with self.lock:
+                    self.pendentes -= 1
+        return respostas
+
+
+def _atender(conexao, servico):
+    try:
+        mensagem = conexao.recv()
+        if mensagem[0] == "status":
+            conexao.send(servico.estatisticas())
+        elif mensagem[0] == "lote":
+            _, nome, lista_args, prazo = mensagem
+            conexao.send(servico.executar_lote(nome, lista_args, prazo))
+    except (EOFError, OSError):
+        pass  # cliente desistiu (timeout da requisição)
+    except Exception as e:
+        logging.error(f"❌ Serviço de OCR: erro ao atender tarefa: {e}")
+    finally:
+        conexao.close()
+
+
+def _main_servico(pid_master):
+    """Loop do processo de serviço (filho do master do gunicorn)."""
+    # Handlers de sinal do master não valem aqui
+    for sinal in (signal.SIGHUP, signal.SIGQUIT, signal.SIGTTIN, signal.SIGTTOU,
+                  signal.SIGUSR1, signal.SIGUSR2, signal.SIGWINCH, signal.SIGCHLD):
+        signal.signal(sinal, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def encerrar(*_):
+        for processo in multiprocessing.active_children():
+            processo.terminate()
+        os._exit(0)
+    signal.signal(signal.SIGTERM, encerrar)
+
+    # Encerrar junto com o master, mesmo se ele morrer sem avisar
+    _vigiar_pai(pid_master)
+
+    if os.path.exists(OCR_SERVICO_SOCKET):
+        os.unlink(OCR_SERVICO_SOCKET)
+    servico = _Servico(OCR_SERVICO_PARALELO)
+    listener = Listener(OCR_SERVICO_SOCKET, family='AF_UNIX', authkey=_authkey)
+    os.chmod(OCR_SERVICO_SOCKET, 0o600)
+    logging.info(f"🧾 Serviço de OCR ouvindo em {OCR_SERVICO_SOCKET} ({OCR_SERVICO_PARALELO} processos, pid {os.getpid()})")
+
+    while True:
+        try:
+            conexao = listener.accept()
+        except Exception as e:
+            # Autenticação inválida ou cliente que caiu no handshake
+            logging.warning(f"⚠️ Serviço de OCR: conexão recusada: {e}")
+            continue
+        threading.Thread(target=_atender, args=(conexao, servico), daemon=True).start()
+
+
+def iniciar_servico():
+    """
+    Cria o processo de serviço. Chamar no master do gunicorn (when_ready), depois
+    do app carregado (preload_app) e antes dos workers: o fork herda as tarefas
+    registradas, e os workers herdam o pid e a chave do socket.
+    """
+    global _servico_pid
+    if not OCR_SERVICO_ENABLED or _servico_pid is not None:
+        return
+    if not _tarefas:
+        logging.warning("⚠️ Serviço de OCR não iniciado: nenhuma tarefa registrada (app não pré-carregado?)")
+        return
+
+    pid_master = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _main_servico(pid_master)
+        except Exception as e:
+            logging.error(f"❌ Serviço de OCR encerrado: {e}")
+        finally:
+            os._exit(0)
+
+    _servico_pid = pid
+    # Esperar o socket existir para os primeiros workers já o encontrarem
+    limite = time.time() + 5
+    while not os.path.exists(OCR_SERVICO_SOCKET) and time.time() < limite:
+        time.sleep(0.05)
+
+
+def encerrar_servico():
+    """Encerra o serviço (hook on_exit do gunicorn)."""
+    global _servico_pid
+    if _servico_pid is None:
+        return
+    try:
+        os.kill(_servico_pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    _servico_pid = None
+    try:
+        os.unlink(OCR_SERVICO_SOCKET)
+    except OSError:
+        pass
+
+
+# ============= LADO DO CLIENTE (WORKERS) =============
+
+def _conectar():
+    if not disponivel():
+        raise ServicoOcrIndisponivel("serviço de OCR não iniciado")
+    try:
+        return Client(OCR_SERVICO_SOCKET, family='AF_UNIX', authkey=_authkey)
+    except Exception as e:
+        raise ServicoOcrIndisponivel(f"serviço de OCR inacessível: {e}")
+
+
+def executar_lote(nome, lista_args, prazo_segundos=None):
+    """
+    Executa tarefas de OCR no serviço, respeitando o limite global de paralelismo.
+
+    Args:
+        nome: tarefa registrada com registrar_tarefa()
+        lista_args: uma tupla de argumentos por tarefa
+        prazo_segundos: prazo (fila + execução) de cada tarefa
+
+    Returns:
+        list: por tarefa, na ordem, ("ok", valor) ou ("erro", tipo, mensagem)
+
+    Raises:
+        ServicoOcrIndisponivel: sem comunicação com o serviço (conexão recusada ou perdida)
+        PrazoOcrExpirado: o serviço não respondeu dentro do prazo
+    """
+    prazo_segundos = prazo_segundos or OCR_SERVICO_PRAZO
+    conexao = _conectar()
+    try:
+        conexao.send(("lote", nome, list(lista_args), time.time() + prazo_segundos))
+        # Folga para o serviço responder as tarefas vencidas
+        if not conexao.poll(prazo_segundos + 5):
+            raise PrazoOcrExpirado("serviço de OCR não respondeu no prazo")
+        return conexao.recv()
+    except PrazoOcrExpirado:
+        raise  # TimeoutError é subclasse de OSError
+    except (EOFError, OSError) as e:
+        raise ServicoOcrIndisponivel(f"conexão com o serviço de OCR perdida: {e}")
+    finally:
+        conexao.close()
+
+
+def estatisticas():
+    """Fila, execução e tempos do serviço (para /health em modo debug)."""
+    if not disponivel():
+        return {"ativo": False}
+    try:
+        conexao = _conectar()
+        try:
+            conexao.send(("status",))
+            if conexao.poll(2):
+                return conexao.recv()
+            return {"ativo": True, "erro": "sem resposta"}
+        finally:
+            conexao.close()
+    except Exception as e:
+        return {"ativo": False, "erro": str(e)[:100]}
@@ -0,0 +1,772 @@
+"""
+Pipeline de OCR: pré-processamento (OpenCV), tesseract e cache de OCR
+
+Tudo o que roda nos processos de OCR (pool local do worker e serviço
+compartilhado, ocr_servico.py) fica aqui, fora do app.py: os pools usam o
+contexto forkserver com este módulo pré-carregado, e os processos filhos não
+importam o Flask, o banco nem as threads de limpeza do app.
+"""
+import io
+import os
+import re
+import time
+import bisect
+import hashlib
+import logging
+import subprocess
+import multiprocessing
+
+import fitz
+import numpy as np
+from PIL import Image, ImageEnhance
+
+import cache_compartilhado
+import motor_ocr
+
+# Tentativa de importar OpenCV
+try:
+    import cv2
+    CV2_AVAILABLE = True
+    logging.info("OpenCV disponível para processamento avançado de imagens")
+except ImportError:
+    CV2_AVAILABLE = False
+    logging.warning("OpenCV não disponível - usando processamento básico")
+
+
+# ============= PROCESSOS DE OCR =============
+
+def contexto_processos_ocr():
+    """
+    Contexto multiprocessing dos pools de OCR. forkserver: os processos nascem
+    de um servidor de fork sem threads (só com este módulo importado), e não do
+    worker do gunicorn - um fork feito enquanto outra thread segura o lock do
+    logging ou do sqlite deixaria o filho travado.
+    """
+    contexto = multiprocessing.get_context("forkserver")
+    contexto.set_forkserver_preload([__name__])
+    return contexto
+
+
+def iniciar_processo_ocr():
+    """Initializer dos processos do pool: o forkserver não herda a configuração de logging."""
+    logging.basicConfig(level=logging.INFO)
+
+
+# ============= TESSERACT =============
+
+def verificar_tesseract():
+    """Verifica se o Tesseract está disponível e qual motor de OCR está ativo
+    (tesserocr com handles persistentes ou pytesseract/CLI)"""
+    if motor_ocr.motor_ativo() == "tesserocr":
+        try:
+            motor, version, langs = motor_ocr.info_motor()
+            logging.info(f"Tesseract detectado: {version} (motor: {motor})")
+            logging.info(f"Idiomas disponíveis: {langs}")
+            if 'por' not in langs:
+                logging.warning("Português não disponível no Tesseract")
+            return True, version, langs, motor
+        except Exception as e:
+            logging.warning(f"⚠️ tesserocr indisponível ({e}) - usando pytesseract")
+            motor_ocr.OCR_MOTOR = "pytesseract"
+
+    try:
+        result = subprocess.run(['tesseract', '--version'],
+                              capture_output=True, text=True, check=True, timeout=10)
+        version = result.stdout.split('\n')[0]
+        logging.info(f"Tesseract detectado: {version}")
+
+        langs_result = subprocess.run(['tesseract', '--list-langs'],
+                                    capture_output=True, text=True, check=True, timeout=10)
+        langs = langs_result.stdout.strip().split('\n')[1:]
+        logging.info(f"Idiomas disponíveis: {langs}")
+
+        if 'por' not in langs:
+            logging.warning("Português não disponível no Tesseract")
+
+        logging.info("Motor de OCR: pytesseract (CLI por imagem)")
+        return True, version, langs, "pytesseract"
+    except Exception as e:
+        logging.error(f"Tesseract não está disponível: {e}")
+        return False, None, [], None
+
+TESSERACT_AVAILABLE, TESSERACT_VERSION, TESSERACT_LANGS, TESSERACT_MOTOR = verificar_tesseract()
+
+
+# ============= PRAZO DO OCR =============
+
+# Orçamento de OCR do documento inteiro: o que sobra do timeout de 120s do
+# gunicorn fica para o Gemini. Esgotado o prazo, as páginas restantes são
+# puladas e a análise segue com as já reconhecidas (metadados["paginas_puladas"]).
+OCR_PRAZO_DOCUMENTO = int(os.getenv("OCR_PRAZO_DOCUMENTO", "60"))
+OCR_TESSERACT_TIMEOUT = 45  # teto por chamada ao tesseract
+
+
+def prazo_ocr_documento():
+    """Prazo (timestamp) do OCR de um documento, criado no início da extração"""
+    return time.time() + OCR_PRAZO_DOCUMENTO
+
+
+def timeout_tesseract(prazo=None):
+    """Timeout de uma chamada ao tesseract: o que resta do prazo, até OCR_TESSERACT_TIMEOUT.
+
+    Raises:
+        TimeoutError: prazo já esgotado
+    """
+    if prazo is None:
+        return OCR_TESSERACT_TIMEOUT
+    restante = prazo - time.time()
+    if restante <= 1:
+        raise TimeoutError("prazo de OCR do documento esgotado")
+    return min(OCR_TESSERACT_TIMEOUT, restante)
+
+
+# ============= CACHE E OCR DE IMAGENS =============
+
+# Cache de OCR por página/imagem (cache_compartilhado, tabela cache_ocr): a chave
+# é o hash dos pixels/bytes + configuração do OCR - reenvios do mesmo documento
+# (erro, rate limit, CPF errado) não refazem OpenCV + Tesseract.
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "true").lower() == "true"
+OCR_CACHE_VERSAO = 1  # incrementar quando o pipeline de OCR mudar o resultado
+
+def configuracao_ocr():
+    """Parâmetros que mudam o texto do OCR (entram nas chaves de cache)"""
+    idioma = 'por+eng' if 'por' in TESSERACT_LANGS else 'eng'
+    duas_passadas = f"{OCR_DPI_RAPIDO}-{OCR_DPI_ALTA}-{OCR_CONFIANCA_MINIMA}" if OCR_DUAS_PASSADAS else "off"
+    return f"{TESSERACT_MOTOR}|{TESSERACT_VERSION}|{idioma}|oem3|psm3|{OCR_NIVEL_PREPROCESSAMENTO}|2p{duas_passadas}|v{OCR_CACHE_VERSAO}"
+
+def chave_cache_ocr(dados, *extras):
+    """Chave do cache de OCR: sha256 dos dados + extras + configuração do OCR"""
+    h = hashlib.sha256(dados)
+    for extra in (*extras, configuracao_ocr()):
+        h.update(b"|" + str(extra).encode())
+    return "ocr:" + h.hexdigest()
+
+def buscar_ocr_cache(chave):
+    """(texto, metadados) do cache de OCR ou None"""
+    if not OCR_CACHE_ENABLED:
+        return None
+    resultado = cache_compartilhado.obter_ocr(chave)
+    if resultado is None:
+        return None
+    logging.info("♻️ OCR reaproveitado do cache")
+    resultado["metadados"]["cache_ocr"] = True
+    return resultado["texto"], resultado["metadados"]
+
+def salvar_ocr_cache(chave, texto, metadados):
+    # TIFF cortado pelo prazo ou por IMAGEM_MAX_QUADROS não vai para o cache: o
+    # reenvio tenta as páginas de novo (como em salvar_extracao_cache)
+    if OCR_CACHE_ENABLED and not metadados.get("paginas_puladas"):
+        cache_compartilhado.salvar_ocr(chave, {"texto": texto, "metadados": metadados})
+
+# Ingestão de imagens com memória limitada: fotos de celular (12-48 MP) decodificadas
+# inteiras em RGB e redimensionadas com LANCZOS somam várias cópias de dezenas de MB
+# no worker. O cabeçalho é checado contra um orçamento de pixels antes de decodificar,
+# JPEGs são decodificados já reduzidos e em tons de cinza (Image.draft) e TIFFs
+# multipágina são processados um quadro por vez.
+IMAGEM_MAX_PIXELS = int(os.getenv("IMAGEM_MAX_PIXELS", str(50_000_000)))
+# Rede de segurança do Pillow (DecompressionBombError acima do dobro, em qualquer Image.open)
+Image.MAX_IMAGE_PIXELS = IMAGEM_MAX_PIXELS
+IMAGEM_MAX_QUADROS = int(os.getenv("IMAGEM_MAX_QUADROS", "30"))  # páginas de um TIFF
+
+def _ler_memoria_status(campo):
+    """Campo de /proc/self/status em MB (VmRSS, VmHWM) ou None fora do Linux"""
+    try:
+        with open("/proc/self/status") as f:
+            for linha in f:
+                if linha.startswith(campo + ":"):
+                    return int(linha.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def iniciar_medicao_memoria():
+    """Zera o pico de RSS do processo (/proc/self/clear_refs) e retorna o RSS atual em MB"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    return _ler_memoria_status("VmRSS")
+
+def classificar_qualidade_ocr(texto):
+    tamanho = len(texto.strip())
+    if tamanho < 50:
+        return "baixa"
+    if tamanho < 200:
+        return "média"
+    return "boa"
+
+def decodificar_para_ocr(img):
+    """
+    Decodifica o quadro atual já perto da resolução do OCR (escala_para_ocr),
+    sem passar por uma cópia RGB em tamanho cheio quando possível.
+
+    Returns:
+        PIL Image em tons de cinza ('L')
+
+    Raises:
+        ValueError: acima do orçamento de pixels (IMAGEM_MAX_PIXELS)
+    """
+    largura, altura = img.size
+    if largura * altura > IMAGEM_MAX_PIXELS:
+        raise ValueError(f"Imagem muito grande ({largura * altura / 1e6:.0f} MP). Envie uma foto com resolução menor.")
+
+    escala = escala_para_ocr(largura, altura)
+    if img.format == "JPEG" and img.mode in ("RGB", "L"):
+        # Decodificação DCT reduzida (1/2, 1/4, 1/8) direto em cinza, sem a cópia RGB
+        img.draft("L", (max(1, int(largura * escala)), max(1, int(altura * escala))))
+
+    # Redução inteira (média de blocos) até perto do alvo; o ajuste fino fica com o OCR
+    fator = int(1 / escala_para_ocr(*img.size))
+    if fator >= 2:
+        img = img.reduce(fator)
+    if img.mode != "L":
+        img = img.convert("L")
+    return img
+
+def processar_imagem_local(image_bytes, formato='PNG', prazo=None):
+    """OCR de imagem enviada, no processo atual (consultando antes o cache de OCR).
+    TIFFs multipágina: um quadro por vez, dentro do prazo (metadados["paginas_puladas"])"""
+    chave_cache = chave_cache_ocr(image_bytes)
+    em_cache = buscar_ocr_cache(chave_cache)
+    if em_cache is not None:
+        return em_cache
+
+    metadados = {
+        "tipo": "imagem",
+        "formato": formato,
+        "usou_ocr": True,
+        "dimensoes": None,
+        "qualidade_ocr": "indefinida",
+        "tesseract_disponivel": TESSERACT_AVAILABLE
+    }
+
+    if not TESSERACT_AVAILABLE:
+        raise ValueError("OCR não está disponível neste servidor")
+
+    memoria_inicial = iniciar_medicao_memoria()
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            metadados["dimensoes"] = f"{img.width}x{img.height}"
+            total_quadros = getattr(img, "n_frames", 1) if img.format == "TIFF" else 1
+
+            if total_quadros == 1:
+                quadro = decodificar_para_ocr(img)
+                metadados["dimensoes_ocr"] = f"{quadro.width}x{quadro.height}"
+                texto = ocr_imagem(quadro, metadados, prazo=prazo)
+            else:
+                textos = []
+                metadados.update(total_paginas=total_quadros, paginas_com_ocr=[], paginas_puladas=[],
+                                 ocr_preprocessamento=[])
+                for i in range(total_quadros):
+                    if i >= IMAGEM_MAX_QUADROS:
+                        metadados["paginas_puladas"].extend(range(i + 1, total_quadros + 1))
+                        break
+                    metadados_quadro = {}
+                    try:
+                        img.seek(i)
+                        quadro = decodificar_para_ocr(img)
+                        textos.append(ocr_imagem(quadro, metadados_quadro, prazo=prazo))
+                        metadados["paginas_com_ocr"].append(i + 1)
+                    except TimeoutError:
+                        metadados["paginas_puladas"].extend(range(i + 1, total_quadros + 1))
+                        logging.warning(f"⏱️ Prazo de OCR esgotado no quadro {i + 1}/{total_quadros} do TIFF")
+                        break
+                    except ValueError as e:
+                        metadados["paginas_puladas"].append(i + 1)
+                        logging.error(f"Erro no quadro {i + 1} do TIFF: {e}")
+                    finally:
+                        quadro = None  # libera o quadro antes de decodificar o próximo
+                    metadados["ocr_preprocessamento"].append({"pagina": i + 1, **metadados_quadro.get("preprocessamento", {})})
+                texto = "\n\n".join(t for t in textos if t)
+                if not metadados["paginas_com_ocr"]:
+                    raise ValueError("Nenhuma página do TIFF pôde ser reconhecida")
+                metadados["qualidade_ocr"] = classificar_qualidade_ocr(texto)
+
+    except Exception as e:
+        logging.error(f"Erro ao processar imagem: {e}")
+        raise
+
+    pico = _ler_memoria_status("VmHWM")
+    if pico is not None:
+        metadados["memoria_pico_mb"] = pico
+        logging.info(f"🧠 Ingestão da imagem ({metadados['dimensoes']}, pid {os.getpid()}): pico de memória {pico} MB (antes: {memoria_inicial} MB)")
+
+    salvar_ocr_cache(chave_cache, texto, metadados)
+    return texto, metadados
+
+def pixmap_para_array(pix):
+    """Vista numpy (sem cópia) sobre as amostras de um pixmap do fitz em tons de cinza.
+    O array só é válido enquanto o pixmap existir."""
+    return np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+def processar_pixmap_para_texto(pix, renderizar_regiao=None, prazo=None):
+    """OCR direto de um pixmap em tons de cinza (páginas escaneadas de PDF),
+    sem codificar/decodificar PNG nem converter para RGB (consultando antes o cache de OCR).
+    renderizar_regiao, prazo: ver ocr_imagem()"""
+    chave_cache = chave_cache_ocr(pix.samples_mv, pix.width, pix.height)
+    em_cache = buscar_ocr_cache(chave_cache)
+    if em_cache is not None:
+        return em_cache
+
+    metadados = {
+        "tipo": "imagem",
+        "formato": "pixmap",
+        "usou_ocr": True,
+        "dimensoes": f"{pix.width}x{pix.height}",
+        "qualidade_ocr": "indefinida",
+        "tesseract_disponivel": TESSERACT_AVAILABLE
+    }
+
+    if not TESSERACT_AVAILABLE:
+        raise ValueError("OCR não está disponível neste servidor")
+
+    try:
+        texto = ocr_imagem(pixmap_para_array(pix), metadados, renderizar_regiao, prazo)
+    except Exception as e:
+        logging.error(f"Erro ao processar página escaneada: {e}")
+        raise
+
+    salvar_ocr_cache(chave_cache, texto, metadados)
+    return texto, metadados
+
+def escala_para_ocr(largura, altura):
+    """Fator único de redimensionamento: amplia imagens pequenas (mínimo 2000px,
+    ~300 DPI) e limita a 4000px, com um só resize"""
+    escala = 1.0
+    min_dimension = 2000
+    if largura < min_dimension or altura < min_dimension:
+        escala = max(min_dimension / largura, min_dimension / altura, 1.0)
+    if largura * escala > 4000 or altura * escala > 4000:
+        escala *= min(4000 / (largura * escala), 4000 / (altura * escala))
+    return escala
+
+# Pré-processamento adaptativo do OCR: uma amostra reduzida decide o nível
+# (nenhum / leve / completo), já que o denoise custa segundos por página e é
+# desnecessário em digitalizações limpas. "auto" (padrão) ou nível fixo.
+OCR_NIVEL_PREPROCESSAMENTO = os.getenv("OCR_NIVEL_PREPROCESSAMENTO", "auto").lower()
+OCR_AMOSTRA_LADO = 800  # px do maior lado da amostra usada na estimativa
+
+# OCR em duas passadas: página inteira em resolução reduzida (image_to_data, com
+# confiança por palavra) e nova passada só nas linhas fracas, em resolução alta
+# (páginas de PDF são re-rasterizadas no trecho). Páginas limpas param na primeira.
+OCR_DUAS_PASSADAS = os.getenv("OCR_DUAS_PASSADAS", "true").lower() == "true"
+OCR_DPI_RAPIDO = int(os.getenv("OCR_DPI_RAPIDO", "200"))  # primeira passada (equivalente em DPI)
+OCR_DPI_ALTA = int(os.getenv("OCR_DPI_ALTA", "400"))  # linhas fracas re-rasterizadas do PDF
+OCR_CONFIANCA_MINIMA = int(os.getenv("OCR_CONFIANCA_MINIMA", "70"))  # confiança média da linha (0-100)
+OCR_FRACAO_MAX_LINHAS_FRACAS = 0.4  # acima disso a página inteira é refeita em resolução cheia
+
+def amostra_cinza(gray):
+    """Amostra por salto de pixels (vista, sem cópia nem suavização: ruído e tinta
+    mantêm a intensidade original) e o passo usado"""
+    passo = max(1, -(-max(gray.shape) // OCR_AMOSTRA_LADO))
+    return gray[::passo, ::passo], passo
+
+def estimar_qualidade_imagem(amostra):
+    """
+    Ruído, contraste e área de conteúdo estimados na amostra.
+
+    Returns:
+        dict: ruido (MAD do resíduo da mediana 3x3 - o texto é minoria e não pesa),
+              contraste (papel p50 menos tinta p1), inclinacao (graus), caixa
+              (y0, y1, x0, x1 na escala da amostra, ou None) e em_branco
+    """
+    amostra = np.ascontiguousarray(amostra)
+    p1, p50 = np.percentile(amostra, (1, 50))
+    residuo = np.abs(amostra.astype(np.int16) - cv2.medianBlur(amostra, 3))
+    ruido = 1.4826 * float(np.median(residuo))
+
+    conteudo = amostra < p50 - 60
+    caixa = None
+    if conteudo.any():
+        linhas = np.flatnonzero(conteudo.any(axis=1))
+        colunas = np.flatnonzero(conteudo.any(axis=0))
+        caixa = (int(linhas[0]), int(linhas[-1]) + 1, int(colunas[0]), int(colunas[-1]) + 1)
+
+    return {
+        "ruido": round(ruido, 2),
+        "contraste": int(p50 - p1),
+        "inclinacao": estimar_inclinacao(amostra),
+        "caixa": caixa,
+        "em_branco": conteudo.mean() < 0.0005 and p50 - p1 < 40
+    }
+
+def estimar_inclinacao(amostra):
+    """
+    Inclinação do texto (graus, convenção de cv2.getRotationMatrix2D) por perfil
+    de projeção na amostra reduzida: o ângulo que concentra os pixels de tinta no
+    menor número de linhas horizontais. Busca grossa de 1° em ±15° e fina de 0,1°.
+    Trabalha só com os pontos da amostra - memória limitada em qualquer resolução.
+    """
+    _, binaria = cv2.threshold(np.ascontiguousarray(amostra), 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ys, xs = np.nonzero(binaria)
+    if len(ys) < 100:
+        return 0.0
+    salto = max(1, len(ys) // 100000)
+    ys = ys[::salto].astype(np.float32)
+    xs = xs[::salto].astype(np.float32)
+    xs -= xs.mean()
+
+    def pontuacao(angulo):
+        projecao = ys - xs * np.float32(np.tan(np.radians(angulo)))
+        perfil = np.bincount(np.round(projecao - projecao.min()).astype(np.int64)).astype(np.float64)
+        return float(np.dot(perfil, perfil))
+
+    melhor = max(np.arange(-15.0, 15.5, 1.0), key=pontuacao)
+    melhor = max(np.arange(melhor - 1.0, melhor + 1.05, 0.1), key=pontuacao)
+    return round(float(melhor), 1)
+
+def escolher_nivel_preprocessamento(qualidade):
+    """nenhum: digitalização limpa e reta (o tesseract binariza sozinho);
+    leve: deskew + binarização adaptativa; completo: denoise + deskew + binarização"""
+    if OCR_NIVEL_PREPROCESSAMENTO in ("nenhum", "leve", "completo"):
+        return OCR_NIVEL_PREPROCESSAMENTO
+    if qualidade["ruido"] >= 6:
+        return "completo"
+    if qualidade["ruido"] >= 2 or qualidade["contraste"] < 100 or abs(qualidade["inclinacao"]) > 0.5:
+        return "leve"
+    return "nenhum"
+
+def recortar_margens(gray, caixa, passo):
+    """Recorta as margens em branco (caixa da amostra levada à resolução cheia,
+    com folga de 2%). Retorna uma vista, sem cópia, e o deslocamento (y, x) do recorte."""
+    if caixa is None:
+        return gray, (0, 0)
+    altura, largura = gray.shape
+    folga = int(0.02 * max(altura, largura))
+    y0, y1, x0, x1 = (v * passo for v in caixa)
+    y0, x0 = max(0, y0 - folga), max(0, x0 - folga)
+    return gray[y0:min(altura, y1 + folga), x0:min(largura, x1 + folga)], (y0, x0)
+
+def preparar_para_ocr(gray, escala, nivel, inclinacao, tempos):
+    """Redimensionamento + etapas do nível escolhido (denoise, deskew, binarização).
+    Soma o tempo de cada etapa em `tempos` (ms)."""
+    inicio = time.perf_counter()
+
+    def marcar(etapa):
+        nonlocal inicio
+        tempos[etapa] = tempos.get(etapa, 0) + int((time.perf_counter() - inicio) * 1000)
+        inicio = time.perf_counter()
+
+    if escala != 1.0:
+        new_size = (max(1, int(gray.shape[1] * escala)), max(1, int(gray.shape[0] * escala)))
+        interpolacao = cv2.INTER_LANCZOS4 if escala > 1 else cv2.INTER_AREA
+        gray = cv2.resize(gray, new_size, interpolation=interpolacao)
+        marcar("redimensionamento")
+
+    if nivel == "completo":
+        # Noise removal
+        gray = cv2.fastNlMeansDenoising(gray, None, 10, 7, 21)
+        marcar("denoise")
+
+    # Deskew: ângulo já estimado na amostra, rotação única na resolução cheia
+    if nivel in ("leve", "completo") and 0.5 < abs(inclinacao) < 15:
+        (h, w) = gray.shape[:2]
+        center = (w // 2, h // 2)
+        M = cv2.getRotationMatrix2D(center, inclinacao, 1.0)
+        gray = cv2.warpAffine(gray, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        logging.info(f"📐 Deskew aplicado: {inclinacao:.1f}°")
+        marcar("deskew")
+
+    if nivel in ("leve", "completo"):
+        # Adaptive thresholding (binarization)
+        gray = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+        marcar("binarizacao")
+
+    return gray
+
+def agrupar_linhas_ocr(palavras):
+    """Palavras do image_to_data agrupadas por linha (bloco, parágrafo, linha), na ordem de leitura"""
+    linhas = {}
+    for palavra in palavras:
+        linhas.setdefault((palavra["bloco"], palavra["paragrafo"], palavra["linha"]), []).append(palavra)
+    return linhas
+
+def confianca_media(palavras):
+    return sum(p["conf"] for p in palavras) / len(palavras) if palavras else 0.0
+
+def montar_texto_ocr(linhas, substituicoes=None):
+    """Texto a partir das linhas agrupadas: quebra simples entre linhas e linha em
+    branco entre parágrafos/blocos (como o image_to_string)"""
+    substituicoes = substituicoes or {}
+    partes = []
+    anterior = None
+    for chave, palavras in linhas.items():
+        if anterior is not None:
+            partes.append("\n" if chave[:2] == anterior[:2] else "\n\n")
+        partes.append(substituicoes.get(chave) or " ".join(p["texto"] for p in palavras))
+        anterior = chave
+    return "".join(partes)
+
+def refazer_linhas_fracas(regioes, nivel, idioma, tempos, prazo=None):
+    """
+    Segunda passada: trechos (arrays em tons de cinza já em resolução alta) empilhados
+    numa única imagem - uma chamada ao tesseract para todas as linhas fracas.
+
+    Returns:
+        list: por trecho, (texto, confiança média) - ("", 0.0) se nada foi reconhecido
+    """
+    espaco = 24
+    trechos = [preparar_para_ocr(regiao, 1.0, nivel, 0.0, tempos) for regiao in regioes]
+    largura = max(t.shape[1] for t in trechos) + 2 * espaco
+    altura = sum(t.shape[0] + espaco for t in trechos) + espaco
+    pilha = np.full((altura, largura), 255, dtype=np.uint8)
+    limites = []
+    y = espaco
+    for trecho in trechos:
+        pilha[y:y + trecho.shape[0], espaco:espaco + trecho.shape[1]] = trecho
+        limites.append(y + trecho.shape[0] + espaco // 2)
+        y += trecho.shape[0] + espaco
+
+    inicio = time.perf_counter()
+    palavras = motor_ocr.reconhecer_palavras(Image.fromarray(pilha), lang=idioma, psm=6, oem=3,
+                                             timeout=timeout_tesseract(prazo))
+    tempos["tesseract_linhas"] = int((time.perf_counter() - inicio) * 1000)
+
+    por_trecho = [[] for _ in trechos]
+    for palavra in palavras:
+        centro = palavra["y"] + palavra["h"] / 2
+        por_trecho[min(bisect.bisect_left(limites, centro), len(trechos) - 1)].append(palavra)
+    return [(" ".join(p["texto"] for p in grupo), confianca_media(grupo)) for grupo in por_trecho]
+
+def ocr_em_duas_passadas(gray, recorte, deslocamento, escala, nivel, idioma, preprocessamento, renderizar_regiao=None,
+                         prazo=None):
+    """
+    Primeira passada em OCR_DPI_RAPIDO; linhas com confiança abaixo de
+    OCR_CONFIANCA_MINIMA são refeitas em resolução alta (re-rasterizadas do PDF
+    por renderizar_regiao, ou recortadas da imagem original na escala cheia),
+    desde que essa resolução seja maior que a da primeira passada.
+
+    Returns:
+        str ou None - None quando há linhas fracas demais (refazer a página inteira)
+    """
+    tempos = preprocessamento["tempos_ms"]
+    escala_rapida = escala * OCR_DPI_RAPIDO / 300
+    rapida = preparar_para_ocr(recorte, escala_rapida, nivel, 0.0, tempos)
+    inicio = time.perf_counter()
+    palavras = motor_ocr.reconhecer_palavras(Image.fromarray(rapida), lang=idioma, psm=3, oem=3,
+                                             timeout=timeout_tesseract(prazo))
+    tempos["tesseract_rapido"] = int((time.perf_counter() - inicio) * 1000)
+
+    linhas = agrupar_linhas_ocr(palavras)
+    fracas = [chave for chave, ps in linhas.items() if confianca_media(ps) < OCR_CONFIANCA_MINIMA]
+    passadas = {"modo": "rapida", "linhas": len(linhas), "fracas": len(fracas), "refeitas": 0,
+                "confianca_media": round(confianca_media(palavras), 1)}
+    preprocessamento["passadas"] = passadas
+
+    if not linhas or len(fracas) > OCR_FRACAO_MAX_LINHAS_FRACAS * len(linhas):
+        passadas["modo"] = "completa"
+        return None
+    if not fracas:
+        return montar_texto_ocr(linhas)
+    # Recortes pequenos já são ampliados na primeira passada além de OCR_DPI_ALTA:
+    # refazer as linhas numa escala que não é maior não ganha nada
+    escala_alta = OCR_DPI_ALTA / 300 if renderizar_regiao is not None else escala
+    if escala_alta <= escala_rapida:
+        return montar_texto_ocr(linhas)
+
+    # Caixas das linhas fracas nas coordenadas da imagem original (com folga vertical)
+    oy, ox = deslocamento
+    altura, largura = gray.shape
+    regioes = []
+    for chave in fracas:
+        ps = linhas[chave]
+        y0 = min(p["y"] for p in ps) / escala_rapida
+        y1 = max(p["y"] + p["h"] for p in ps) / escala_rapida
+        x0 = min(p["x"] for p in ps) / escala_rapida
+        x1 = max(p["x"] + p["w"] for p in ps) / escala_rapida
+        folga = 0.2 * (y1 - y0) + 2
+        caixa = (max(0, int(ox + x0 - folga)), max(0, int(oy + y0 - folga)),
+                 min(largura, int(ox + x1 + folga) + 1), min(altura, int(oy + y1 + folga) + 1))
+        if renderizar_regiao is not None:
+            regioes.append(renderizar_regiao(*caixa))
+        else:
+            regiao = gray[caixa[1]:caixa[3], caixa[0]:caixa[2]]
+            if escala != 1.0:
+                regiao = cv2.resize(regiao, (max(1, int(regiao.shape[1] * escala)), max(1, int(regiao.shape[0] * escala))),
+                                    interpolation=cv2.INTER_LANCZOS4)
+            regioes.append(regiao)
+
+    substituicoes = {}
+    for chave, (texto, confianca) in zip(fracas, refazer_linhas_fracas(regioes, nivel, idioma, tempos, prazo)):
+        if texto and confianca > confianca_media(linhas[chave]):
+            substituicoes[chave] = texto
+    passadas.update(modo="rapida+linhas", refeitas=len(substituicoes))
+    return montar_texto_ocr(linhas, substituicoes)
+
+def ocr_imagem(img, metadados, renderizar_regiao=None, prazo=None):
+    """
+    Pré-processamento + tesseract. Preenche metadados["qualidade_ocr"] e
+    metadados["preprocessamento"] (nível escolhido, tempos por etapa em ms e,
+    no OCR em duas passadas, linhas fracas/refeitas).
+
+    Args:
+        img: PIL Image (RGB ou L) ou array numpy 2D uint8 (tons de cinza)
+        renderizar_regiao: opcional, (x0, y0, x1, y1) em pixels de `img` -> array
+            em tons de cinza do trecho re-rasterizado em OCR_DPI_ALTA (páginas de PDF)
+        prazo: opcional, timestamp limite do OCR do documento (limita o timeout do tesseract)
+
+    Raises:
+        ValueError: tempo limite do tesseract excedido
+        TimeoutError: prazo do documento esgotado antes de uma chamada ao tesseract
+    """
+    if isinstance(img, np.ndarray) and not CV2_AVAILABLE:
+        img = Image.fromarray(img)
+
+    if isinstance(img, np.ndarray):
+        altura, largura = img.shape
+    else:
+        largura, altura = img.size
+
+    tempos = {}
+    preprocessamento = {"nivel": "pil", "tempos_ms": tempos}
+    metadados["preprocessamento"] = preprocessamento
+
+    def marcar(etapa, inicio):
+        tempos[etapa] = int((time.perf_counter() - inicio) * 1000)
+        return time.perf_counter()
+
+    inicio = time.perf_counter()
+    escala = escala_para_ocr(largura, altura)
+    idioma = 'por+eng' if 'por' in TESSERACT_LANGS else 'eng'
+    texto = None
+
+    if CV2_AVAILABLE:
+        if isinstance(img, np.ndarray):
+            gray = img
+        elif img.mode == 'L':
+            gray = np.asarray(img)
+        else:
+            gray = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2GRAY)
+
+        amostra, passo = amostra_cinza(gray)
+        qualidade = estimar_qualidade_imagem(amostra)
+        nivel = escolher_nivel_preprocessamento(qualidade)
+        preprocessamento.update(nivel=nivel, ruido=qualidade["ruido"], contraste=qualidade["contraste"],
+                                inclinacao=qualidade["inclinacao"])
+        inicio = marcar("estimativa", inicio)
+
+        if qualidade["em_branco"]:
+            logging.info("📄 Imagem em branco - OCR dispensado")
+            metadados["qualidade_ocr"] = "baixa"
+            return ""
+
+        # Recortar antes das etapas pesadas (a escala continua a da imagem inteira)
+        recorte, deslocamento = recortar_margens(gray, qualidade["caixa"], passo)
+        preprocessamento["recorte"] = f"{recorte.shape[1]}x{recorte.shape[0]}"
+        inicio = marcar("recorte", inicio)
+
+        # Duas passadas só sem deskew: as caixas das linhas voltam à imagem original por escala + deslocamento
+        if OCR_DUAS_PASSADAS and abs(qualidade["inclinacao"]) <= 0.5:
+            try:
+                texto = ocr_em_duas_passadas(gray, recorte, deslocamento, escala, nivel, idioma,
+                                             preprocessamento, renderizar_regiao, prazo)
+            except RuntimeError as e:
+                logging.error(f"⏱️ OCR timeout ({e}) — imagem muito complexa ou grande")
+                raise ValueError("Tempo limite do OCR excedido. Envie uma imagem mais nítida ou menor.")
+
+        if texto is None:
+            if escala > 1:
+                logging.info(f"📐 Imagem ampliada (escala {escala:.1f}x)")
+            if nivel == "completo":
+                logging.info("🔬 Usando OpenCV para pré-processamento avançado")
+            img = Image.fromarray(preparar_para_ocr(recorte, escala, nivel, qualidade["inclinacao"], tempos))
+            inicio = time.perf_counter()
+    else:
+        if escala != 1.0:
+            new_size = (int(largura * escala), int(altura * escala))
+            img = img.resize(new_size, Image.Resampling.LANCZOS)
+            if escala > 1:
+                logging.info(f"📐 Imagem ampliada para {new_size[0]}x{new_size[1]} (escala {escala:.1f}x)")
+
+        # Basic preprocessing with PIL only
+        enhancer = ImageEnhance.Contrast(img)
+        img = enhancer.enhance(1.8)
+        enhancer = ImageEnhance.Sharpness(img)
+        img = enhancer.enhance(2.0)
+        img = img.convert('L')
+        # Simple thresholding
+        img = img.point(lambda x: 0 if x < 140 else 255, '1')
+        img = img.convert('L')
+        inicio = marcar("pil", inicio)
+
+    # OCR com timeout rígido — imagens muito grandes podem travar o worker por minutos
+    if texto is None:
+        try:
+            texto = motor_ocr.reconhecer_texto(img, lang=idioma, psm=3, oem=3, timeout=timeout_tesseract(prazo))
+        except RuntimeError as e:
+            # Os dois motores lançam RuntimeError quando o timeout estoura
+            logging.error(f"⏱️ OCR timeout ({e}) — imagem muito complexa ou grande")
+            raise ValueError("Tempo limite do OCR excedido. Envie uma imagem mais nítida ou menor.")
+        marcar("tesseract", inicio)
+    texto = pos_processar_texto_ocr(texto)
+    metadados["qualidade_ocr"] = classificar_qualidade_ocr(texto)
+
+    logging.info(f"OCR concluído. Qualidade: {metadados['qualidade_ocr']}, pré-processamento: {preprocessamento['nivel']} {tempos}")
+
+    return texto
+
+def pos_processar_texto_ocr(texto):
+    """Pós-processamento de texto OCR para corrigir erros comuns"""
+    if not texto:
+        return texto
+
+    # Remove non-printable characters except newlines and tabs
+    texto = re.sub(r'[^\x20-\x7E\xA0-\xFF\n\t]', '', texto)
+
+    # Fix common OCR artifacts
+    texto = re.sub(r'[|]{2,}', '', texto)  # Remove pipe sequences
+    texto = re.sub(r'[_]{3,}', '', texto)  # Remove underscore sequences
+    texto = re.sub(r'[\.]{4,}', '...', texto)  # Normalize dot sequences
+
+    # Fix broken hyphenation at end of lines (common in legal docs)
+    texto = re.sub(r'(\w)-\n(\w)', r'\1\2', texto)
+
+    # Normalize multiple spaces
+    texto = re.sub(r'[ \t]{2,}', ' ', texto)
+
+    # Normalize multiple blank lines
+    texto = re.sub(r'\n{3,}', '\n\n', texto)
+
+    return texto.strip()
+
+
+# ============= PÁGINAS DE PDF =============
+
+def ocr_pagina_pdf(pdf_bytes, indice, regioes=None, prazo=None):
+    """Rasteriza e faz OCR de uma página do PDF (roda nos processos do pool).
+
+    Args:
+        regioes: opcional, retângulos (pontos) das imagens a reconhecer - só esses
+                 trechos são rasterizados (páginas híbridas); None = página inteira
+        prazo: opcional, timestamp limite do OCR do documento
+
+    Returns:
+        tuple: (texto, preprocessamento) - nível e tempos do pré-processamento
+               (em páginas híbridas, {"regioes": [...]} com um item por imagem)
+    """
+    timeout_tesseract(prazo)  # página que começaria com o prazo esgotado nem é rasterizada
+    textos = []
+    preprocessamentos = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page = doc[indice]
+        for clip in ([fitz.Rect(r) for r in regioes] if regioes else [None]):
+            # Tons de cinza direto do renderizador: 1/3 da memória do RGB e sem PNG intermediário
+            pix = page.get_pixmap(dpi=300, colorspace=fitz.csGRAY, clip=clip)
+            origem = clip.tl if clip is not None else fitz.Point(0, 0)
+
+            def renderizar_regiao(x0, y0, x1, y1):
+                """Linha fraca do OCR re-rasterizada em OCR_DPI_ALTA (coordenadas do pixmap de 300 DPI)"""
+                fator = 72 / 300
+                trecho = fitz.Rect(x0 * fator, y0 * fator, x1 * fator, y1 * fator) + (origem.x, origem.y, origem.x, origem.y)
+                regiao = page.get_pixmap(dpi=OCR_DPI_ALTA, colorspace=fitz.csGRAY, clip=trecho)
+                return np.array(pixmap_para_array(regiao))
+
+            # Em páginas rotacionadas o clip não corresponde ao pixmap: recorte da própria imagem
+            texto, metadados = processar_pixmap_para_texto(pix, renderizar_regiao if page.rotation == 0 else None, prazo)
+            textos.append(texto)
+            preprocessamentos.append(metadados.get("preprocessamento"))
+
+    if regioes:
+        return "\n".join(t for t in textos if t), {"regioes": preprocessamentos}
+    return textos[0], preprocessamentos[0]
@@ -99,6 +99,12 @@
             `in: ${fmtNumero(c30.tokens_input_medio_por_doc || 0)} · out: ${fmtNumero(c30.tokens_output_medio_por_doc || 0)}`);
 
         setText('kpiCustoPorDoc', fmtBRL(c30.custo_medio_por_doc_brl));
+
+        // Cache anônimo (documentos emitidos em massa)
+        const ca = data.cache_anonimo_30d || {};
+        const caTotal = (ca.hits || 0) + (ca.misses || 0);
+        setText('kpiCacheAnonimo', caTotal ? `${ca.taxa_acerto_pct}%` : '—');
+        setText('kpiCacheAnonimoFoot', `hits: ${fmtNumero(ca.hits || 0)} · misses: ${fmtNumero(ca.misses || 0)}`);
     }
 
     function preencherSeguranca(data) {
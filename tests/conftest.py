@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Cache compartilhado dos testes fora do /dev/shm da aplicação (o módulo abre o banco no import)
+os.environ.setdefault("RESULT_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="entenda_aqui_testes_"), "cache.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,43 @@
+import app
+
+CABECALHO = "PODER JUDICIÁRIO - TRIBUNAL DE JUSTIÇA - Página {}\n"
+ASSINATURA = "Assinado eletronicamente por: FULANO - {}\n"
+
+
+def pagina(numero, corpo):
+    return [
+        (CABECALHO.format(numero), True),
+        (corpo, False),
+        (ASSINATURA.format(f"2024-01-0{numero}"), False),
+    ]
+
+
+def test_remove_cabecalho_e_assinatura_repetidos_mantendo_a_primeira_ocorrencia():
+    paginas = [pagina(i, f"Conteúdo próprio da página {i}.\n") for i in range(1, 5)]
+
+    textos, removidos, chars = app.remover_boilerplate_paginas(paginas)
+
+    assert textos[0] == CABECALHO.format(1) + "Conteúdo próprio da página 1.\n" + ASSINATURA.format("2024-01-01")
+    for i, texto in enumerate(textos[1:], 2):
+        assert texto == f"Conteúdo próprio da página {i}.\n"
+    assert removidos == 6
+    assert chars == sum(len(CABECALHO.format(i)) + len(ASSINATURA.format(f"2024-01-0{i}")) for i in range(2, 5))
+
+
+def test_bloco_repetido_no_corpo_que_nao_e_ruido_e_mantido():
+    paginas = [[("Cláusula repetida sem marca de assinatura.\n", False)] for _ in range(4)]
+
+    textos, removidos, _ = app.remover_boilerplate_paginas(paginas)
+
+    assert textos == ["Cláusula repetida sem marca de assinatura.\n"] * 4
+    assert removidos == 0
+
+
+def test_paginas_de_ocr_passam_intactas_e_documento_curto_usa_duas_repeticoes():
+    paginas = [pagina(1, "Primeira.\n"), None, pagina(2, "Segunda.\n")]
+
+    textos, removidos, _ = app.remover_boilerplate_paginas(paginas)
+
+    assert textos[1] is None
+    assert textos[2] == "Segunda.\n"
+    assert removidos == 2
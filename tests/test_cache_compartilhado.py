@@ -0,0 +1,46 @@
+import base64
+
+import pytest
+from cryptography.fernet import Fernet
+
+import cache_compartilhado
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_compartilhado, "CACHE_DB_PATH", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(cache_compartilhado, "CACHE_DISPONIVEL", True)
+    cache_compartilhado.init_cache()
+    return cache_compartilhado
+
+
+def usar_chave(monkeypatch, chave):
+    monkeypatch.setattr(cache_compartilhado, "_fernet", Fernet(base64.urlsafe_b64encode(chave)))
+
+
+def test_chave_derivada_da_secret_key_e_estavel():
+    chave_a, compartilhada = cache_compartilhado.derivar_chave("", "segredo-do-flask")
+    chave_b, _ = cache_compartilhado.derivar_chave("", "segredo-do-flask")
+    assert compartilhada and chave_a == chave_b
+    assert chave_a != cache_compartilhado.derivar_chave("", "outro-segredo")[0]
+    assert cache_compartilhado.derivar_chave("chave-do-cache", "segredo-do-flask")[0] != chave_a
+
+
+def test_sem_chaves_configuradas_a_chave_nao_e_compartilhada():
+    chave_a, compartilhada = cache_compartilhado.derivar_chave("", "")
+    assert not compartilhada
+    assert chave_a != cache_compartilhado.derivar_chave("", "")[0]
+
+
+def test_entrada_de_outra_chave_nao_e_lida_nem_apagada(cache, monkeypatch):
+    usar_chave(monkeypatch, b"a" * 32)
+    cache.salvar_extracao("chave", {"texto": "conteúdo"})
+    assert cache.salvar_pdf("pdf", b"%PDF-1.4 ...")
+
+    usar_chave(monkeypatch, b"b" * 32)
+    assert cache.obter_extracao("chave") is None
+    assert cache.obter_pdf("pdf") is None
+
+    usar_chave(monkeypatch, b"a" * 32)
+    assert cache.obter_extracao("chave") == {"texto": "conteúdo"}
+    assert cache.obter_pdf("pdf") == b"%PDF-1.4 ..."
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+import app
+
+MODELO = "modelo-de-teste"
+
+
+@pytest.fixture
+def circuito(monkeypatch):
+    monkeypatch.setattr(app, "circuit_breakers", {
+        MODELO: {
+            "estado": "fechado",
+            "falhas_consecutivas": 0,
+            "aberto_ate": 0.0,
+            "cooldown": app.CIRCUIT_COOLDOWN,
+            "sonda_desde": None,
+            "aberturas": 0,
+            "motivo": None,
+        }
+    })
+    return app.circuit_breakers[MODELO]
+
+
+def vencer_janela(cb):
+    cb["aberto_ate"] = time.time() - 1
+
+
+def test_erros_de_servidor_abrem_apos_o_limite_de_falhas_seguidas(circuito):
+    for _ in range(app.CIRCUIT_FALHAS_PARA_ABRIR - 1):
+        app.registrar_erro_circuito(MODELO, "503 UNAVAILABLE")
+        assert circuito["estado"] == "fechado"
+        assert app.circuito_permite_chamada(MODELO)
+
+    app.registrar_erro_circuito(MODELO, "503 UNAVAILABLE")
+
+    assert circuito["estado"] == "aberto"
+    assert circuito["motivo"] == "servidor"
+    assert not app.circuito_permite_chamada(MODELO)
+    assert not app.circuito_disponivel(MODELO)
+
+
+def test_quota_abre_na_hora_pela_janela_sugerida_pela_api(circuito):
+    app.registrar_erro_circuito(MODELO, "429 RESOURCE_EXHAUSTED. Please retry in 42.5s")
+
+    assert circuito["estado"] == "aberto"
+    assert circuito["motivo"] == "quota"
+    assert circuito["aberto_ate"] - time.time() == pytest.approx(42.5, abs=1)
+
+
+def test_erro_de_formato_nao_conta_como_falha(circuito):
+    for _ in range(app.CIRCUIT_FALHAS_PARA_ABRIR + 1):
+        app.registrar_erro_circuito(MODELO, "JSON inválido na resposta")
+    assert circuito["estado"] == "fechado"
+    assert circuito["falhas_consecutivas"] == 0
+
+
+def test_janela_vencida_libera_uma_unica_sonda_e_sucesso_fecha(circuito):
+    app.registrar_erro_circuito(MODELO, "429 quota exceeded")
+    vencer_janela(circuito)
+
+    assert app.circuito_permite_chamada(MODELO)
+    assert circuito["estado"] == "meio_aberto"
+    assert not app.circuito_permite_chamada(MODELO)  # sonda já reservada
+
+    app.registrar_sucesso_circuito(MODELO)
+
+    assert circuito["estado"] == "fechado"
+    assert circuito["falhas_consecutivas"] == 0
+    assert app.circuito_permite_chamada(MODELO)
+
+
+def test_sonda_que_falha_reabre_com_cooldown_dobrado(circuito):
+    app.registrar_erro_circuito(MODELO, "429 quota exceeded")
+    vencer_janela(circuito)
+    assert app.circuito_permite_chamada(MODELO)
+
+    app.registrar_erro_circuito(MODELO, "500 internal error")
+
+    assert circuito["estado"] == "aberto"
+    assert circuito["cooldown"] == min(app.CIRCUIT_COOLDOWN * 2, app.CIRCUIT_COOLDOWN_MAX)
+    assert circuito["aberto_ate"] - time.time() == pytest.approx(circuito["cooldown"], abs=1)
+    assert circuito["aberturas"] == 2
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import pipeline_ocr
+
+cv2 = pytest.importorskip("cv2")
+
+
+def pagina_sintetica():
+    """Linhas de "palavras" pretas em fundo branco, retas."""
+    pagina = np.full((800, 800), 255, np.uint8)
+    for y in range(100, 700, 40):
+        for x in range(80, 720, 60):
+            cv2.rectangle(pagina, (x, y), (x + 45, y + 14), 0, -1)
+    return pagina
+
+
+def girar(imagem, angulo):
+    altura, largura = imagem.shape
+    matriz = cv2.getRotationMatrix2D((largura / 2, altura / 2), angulo, 1.0)
+    return cv2.warpAffine(imagem, matriz, (largura, altura), borderValue=255)
+
+
+@pytest.mark.parametrize("angulo", [0.0, 3.0, -5.0, 8.5])
+def test_estima_o_angulo_que_endireita_a_pagina(angulo):
+    inclinacao = pipeline_ocr.estimar_inclinacao(girar(pagina_sintetica(), angulo))
+    assert inclinacao == pytest.approx(-angulo, abs=0.2)
+
+    endireitada = girar(girar(pagina_sintetica(), angulo), inclinacao)
+    assert abs(pipeline_ocr.estimar_inclinacao(endireitada)) <= 0.2
+
+
+def test_pagina_sem_tinta_nao_tem_inclinacao():
+    assert pipeline_ocr.estimar_inclinacao(np.full((200, 200), 255, np.uint8)) == 0.0
@@ -0,0 +1,29 @@
+import app
+
+
+def test_texto_dentro_do_orcamento_nao_e_cortado():
+    texto = "Relatório curto.\n\nJULGO PROCEDENTE o pedido."
+    assert app.selecionar_secoes_relevantes(texto, max_tokens=1000) == (texto, None)
+
+
+def test_texto_vazio_ou_so_espacos_nao_quebra():
+    assert app.selecionar_secoes_relevantes("", max_tokens=10) == ("", None)
+    espacos = " " * (app.SELECAO_MAX_TOKENS * 4 + 10)
+    assert app.selecionar_secoes_relevantes(espacos) == ("", None)
+    assert app.selecionar_secoes_relevantes("\n\n  \n\n" * 50, max_tokens=10) == ("", None)
+
+
+def test_mantem_cabecalho_e_dispositivo_na_ordem_original():
+    cabecalho = "PODER JUDICIÁRIO - Processo nº 0001234-56.2024.8.26.0100"
+    enchimento = ["Lorem ipsum dolor sit amet. " * 100 for _ in range(6)]
+    dispositivo = "Ante o exposto, JULGO PROCEDENTE o pedido e CONDENO o réu."
+    texto = "\n\n".join([cabecalho, *enchimento, dispositivo])
+
+    selecionado, info = app.selecionar_secoes_relevantes(texto, max_tokens=1500)
+
+    assert info["secoes_enviadas"] < info["secoes_total"]
+    assert info["chars_enviados"] < info["chars_original"]
+    assert selecionado.startswith(cabecalho)
+    assert dispositivo in selecionado
+    assert selecionado.index(cabecalho) < selecionado.index(dispositivo)
+    assert "[... trechos de menor relevância omitidos ...]" in selecionado